@@ -1,6 +1,8 @@
 import os
 import time
+import hashlib
 import datetime
+from urllib.parse import urljoin
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
@@ -11,19 +13,181 @@ from selenium.common.exceptions import TimeoutException, NoSuchElementException,
 from sqlalchemy.orm import Session
 from database import SessionLocal
 from models import Log
+from log_sink import get_log_sink
+from waits import PageWaiter
+from snapshots import SnapshotRecorder, RECORD_DIR
+from metrics import SCRAPER_PHASE_SECONDS, GUIAS_SCRAPED, timed
+
+SGUCARD_BASE_URL = os.environ.get("SGUCARD_BASE_URL", "https://sgucard.unimedgoiania.coop.br/cmagnet").rstrip("/")
+CUTOFF_DAYS = 270 # Using 270 as in original
+MAX_DETAIL_TABS = 4
+
+RESULTS_TABLE_XPATH = '//*[@id="conteudo-submenu"]/table[2]'
+
+# Lean browser (SCRAPER_LEAN_BROWSER): resources extraction never needs, by SCRAPER_LEAN_BLOCK kind
+LEAN_BLOCKED_RESOURCES = {
+    "images": ("png", "jpg", "jpeg", "gif", "bmp", "ico", "svg", "webp"),
+    "css": ("css",),
+    "fonts": ("woff", "woff2", "ttf", "otf", "eot"),
+}
+# Chrome features a scraping session never uses
+LEAN_CHROME_ARGS = (
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-sync",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-notifications",
+    "--no-first-run",
+    "--mute-audio",
+    "--metrics-recording-only",
+    "--disable-features=Translate,MediaRouter,OptimizationHints",
+)
+
+DETAIL_XPATHS = {
+    "numero_guia": '//*[@id="conteudo-submenu"]/form/table/tbody/tr[3]/td[2]',
+    "data_autorizacao": '//*[@id="conteudo-submenu"]/form/table/tbody/tr[4]/td[4]',
+    "senha": '//*[@id="conteudo-submenu"]/form/table/tbody/tr[5]/td[2]',
+    "validade_senha": '//*[@id="CampoValidadeSenha"]',
+    "codigo_terapia": '/html/body/div[1]/div[13]/div/table/tbody/tr[2]/td[3]/input',
+    "qtde_solicitada": '/html/body/div[1]/div[13]/div/table/tbody/tr[2]/td[5]',
+    "qtde_autorizada": '/html/body/div[1]/div[13]/div/table/tbody/tr[2]/td[6]',
+}
+
+# Snapshot recordings (SCRAPER_RECORD_DIR) leave only these readable: what extraction
+# reads from the listing and detail pages. senha stays masked (masked in the recorded results too).
+RECORD_KEEP_XPATHS = (
+    f"{RESULTS_TABLE_XPATH}/tbody/tr/td[1]",
+    f"{RESULTS_TABLE_XPATH}/tbody/tr/td[4]/a",
+    f"{RESULTS_TABLE_XPATH}/tbody/tr/td[6]/span",
+    '//a[normalize-space(.)="Próxima"]',
+    '//*[@id="Button_Voltar"]',
+) + tuple(path for name, path in DETAIL_XPATHS.items() if name != "senha")
+
+# JS extraction mode: same XPaths as the element path, evaluated in the page so
+# a whole listing page (or detail view) costs one WebDriver round trip.
+_JS_HELPERS = """
+var xp = function (path, ctx) {
+    return document.evaluate(path, ctx || document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+};
+var txt = function (node) {
+    return node ? (node.innerText || node.textContent || '').trim() : null;
+};
+"""
+
+LIST_ROWS_JS = _JS_HELPERS + """
+var table = xp('%s');
+if (!table) { return []; }
+var total = table.getElementsByTagName('tr').length;
+var rows = [];
+for (var idx = 1; idx < total - 1; idx++) {
+    var row = xp('tbody/tr[' + (idx + 1) + ']', table);
+    if (!row) { continue; }
+    var status = xp('td[6]/span', row);
+    if (!status) { continue; }
+    var link = xp('td[4]/a', row);
+    rows.push({
+        index: idx,
+        status: txt(status),
+        date: txt(xp('td[1]', row)) || '',
+        guia: txt(link),
+        href: link ? link.getAttribute('href') : null,
+        text: txt(row)
+    });
+}
+return rows;
+""" % RESULTS_TABLE_XPATH
+
+CLICK_ROW_LINK_JS = _JS_HELPERS + """
+var link = xp('%s/tbody/tr[' + (arguments[0] + 1) + ']/td[4]/a');
+if (!link) { return false; }
+link.click();
+return true;
+""" % RESULTS_TABLE_XPATH
+
+DETAIL_JS = _JS_HELPERS + """
+var input = xp('%(codigo_terapia)s');
+return {
+    loaded: !!document.getElementById('Button_Voltar'),
+    numero_guia: txt(xp('%(numero_guia)s')),
+    data_autorizacao: txt(xp('%(data_autorizacao)s')),
+    senha: txt(xp('%(senha)s')),
+    validade_senha: txt(xp('%(validade_senha)s')),
+    codigo_terapia: input ? input.value : null,
+    qtde_solicitada: txt(xp('%(qtde_solicitada)s')),
+    qtde_autorizada: txt(xp('%(qtde_autorizada)s'))
+};
+""" % DETAIL_XPATHS
+
+# Lean mode XPath check: what extraction reads from the first data row / the detail view
+CHECK_LISTING_XPATHS = {
+    "results_table": RESULTS_TABLE_XPATH,
+    "status": f"{RESULTS_TABLE_XPATH}/tbody/tr[2]/td[6]/span",
+    "date": f"{RESULTS_TABLE_XPATH}/tbody/tr[2]/td[1]",
+}
+CHECK_DETAIL_XPATHS = dict(DETAIL_XPATHS, voltar='//*[@id="Button_Voltar"]')
+
+MISSING_XPATHS_JS = _JS_HELPERS + """
+var missing = [];
+for (var name in arguments[0]) {
+    if (!xp(arguments[0][name])) { missing.push(name); }
+}
+return missing;
+"""
+
+def blocked_url_patterns(kinds):
+    # Network.setBlockedURLs patterns (with and without a query string) for the given kinds
+    patterns = []
+    for kind in kinds:
+        for ext in LEAN_BLOCKED_RESOURCES.get(kind, ()):
+            patterns += [f"*.{ext}", f"*.{ext}?*"]
+    return patterns
+
+def fetchable(href):
+    # Links that can be loaded directly by URL (not javascript: handlers or anchors)
+    return bool(href) and not href.startswith(("javascript:", "#"))
+
+def row_fingerprint(text):
+    # Stable hash of a listing row's visible fields, compared against base_guias.list_fingerprint
+    normalized = " ".join((text or "").split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
 
 # Class to handle Scraping
 class UnimedScraper:
     def __init__(self, db: Session = None):
         self.driver = None
+        self.waits = None
         self.username = os.environ.get("SGUCARD_LOGIN", "REC2209525")
         self.password = os.environ.get("SGUCARD_PASSWORD", "Unimed@2025")
         self.headless = os.environ.get("SGUCARD_HEADLESS", "false").lower() == "true"
         self.db = db if db else SessionLocal()
+        # Guias (list numbers) whose listing row matched the dispatcher's fingerprint in the last run
+        self.seen_unchanged = []
+        # Position of the last scraped guia ({"page", "guia", "date"}); sent back as the job checkpoint
+        self.progress = None
+        # buffered: queue logs and write them in batches off-thread; sync: one commit per message;
+        # print: stdout only (offline runs against mock_portal.py)
+        self.log_mode = os.environ.get("SCRAPER_LOG_MODE", "buffered").lower()
+        self.log_sink = get_log_sink() if self.log_mode == "buffered" else None
+        # js: read each listing/detail page in one execute_script call; element: one find_element per cell
+        self.extract_mode = os.environ.get("SCRAPER_EXTRACT_MODE", "js").lower()
+        # Detail pages loaded in parallel tabs (1 = click through them one by one); capped to stay polite
+        self.detail_tabs = max(1, min(int(os.environ.get("SCRAPER_DETAIL_TABS", 1)), MAX_DETAIL_TABS))
+        # Redacted page sources of every run, for snapshot_replay.py (SCRAPER_RECORD_DIR)
+        self.recorder = SnapshotRecorder(RECORD_DIR, keep_xpaths=RECORD_KEEP_XPATHS) if RECORD_DIR else None
+        # Lean browser: no images/CSS/fonts (SCRAPER_LEAN_BLOCK), no background Chrome features,
+        # eager page loads and a fixed SCRAPER_WINDOW_SIZE window instead of a maximized one
+        self.lean = os.environ.get("SCRAPER_LEAN_BROWSER", "false").lower() == "true"
+        self.lean_block = [kind.strip() for kind in os.environ.get("SCRAPER_LEAN_BLOCK", "images,css,fonts").lower().split(",") if kind.strip()]
+        self.window_size = os.environ.get("SCRAPER_WINDOW_SIZE", "1280,900")
+        # Page kinds whose XPaths were already checked in lean mode
+        self.xpaths_checked = set()
         
     def log(self, message, level="INFO", job_id=None, carteirinha_id=None):
         print(f"[{level}] {message}")
-        if self.db:
+        if self.log_sink:
+            self.log_sink.write(message, level=level, job_id=job_id, carteirinha_id=carteirinha_id)
+        elif self.db and self.log_mode != "print":
             try:
                 log_entry = Log(
                     job_id=job_id,
@@ -36,6 +200,15 @@ class UnimedScraper:
             except Exception as e:
                 print(f"Failed to write log to DB: {e}")
 
+    def record_page(self, kind, row=None):
+        # Snapshot of the current page when recording; never fails the scrape
+        if not self.recorder:
+            return
+        try:
+            self.recorder.capture(kind, self.driver.page_source, self.driver.current_url, row=row)
+        except Exception as e:
+            self.log(f"Failed to record {kind} snapshot: {e}", level="WARNING")
+
     def funccarteira(self, carteirinha):
         # carteirinha format example: 0064.8000.400948.00-5
         # Remove punctuation for processing if needed, or split by generic delimiters
@@ -54,6 +227,7 @@ class UnimedScraper:
             # Assuming strict format was enforced upstream
             return parts[0], parts[1], parts[2], parts[3], parts[4]
 
+    @timed(SCRAPER_PHASE_SECONDS, phase="driver_start")
     def start_driver(self):
         chrome_options = Options()
         chrome_options.add_argument("--disable-blink-features=AutomationControlled")
@@ -62,20 +236,72 @@ class UnimedScraper:
         chrome_options.add_argument("--disable-gpu")
         if self.headless:
             chrome_options.add_argument("--headless")
+        if self.lean:
+            for arg in LEAN_CHROME_ARGS:
+                chrome_options.add_argument(arg)
+            chrome_options.add_argument(f"--window-size={self.window_size}")
+            # Return at DOMContentLoaded: every step already waits for the element it needs
+            chrome_options.page_load_strategy = "eager"
+            if "images" in self.lean_block:
+                # Content setting: applies to every window, including the popup's first load
+                chrome_options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
         
         self.driver = webdriver.Chrome(options=chrome_options)
-        self.driver.maximize_window()
+        self.setup_window()
+        self.waits = PageWaiter(self.driver)
+
+    def setup_window(self):
+        # Newly opened window: maximized, or in lean mode (fixed size) set to block resources
+        if self.lean:
+            self.block_resources()
+        else:
+            self.driver.maximize_window()
+
+    def block_resources(self):
+        # CDP blocking only covers the current window: runs for the main window, the popup
+        # (whose first page is already loading by then) and every detail tab
+        if not self.lean:
+            return
+        patterns = blocked_url_patterns(self.lean_block)
+        if not patterns:
+            return
+        try:
+            self.driver.execute_cdp_cmd("Network.enable", {})
+            self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+        except Exception as e:
+            self.log(f"Could not block resources in this window: {e}", level="WARNING")
+
+    def check_xpaths(self, kind, xpaths, ready, job_id=None, carteirinha_db_id=None):
+        # Lean mode: the first loaded page of each kind confirms the extraction XPaths still
+        # resolve without the blocked resources (pages where the `ready` XPath is missing are
+        # skipped). Logged only; a missing field fails its read anyway.
+        if not self.lean or kind in self.xpaths_checked:
+            return
+        try:
+            missing = self.driver.execute_script(MISSING_XPATHS_JS, xpaths)
+        except Exception as e:
+            self.xpaths_checked.add(kind)
+            self.log(f"Could not check {kind} XPaths: {e}", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
+            return
+        if ready in missing:
+            return
+        self.xpaths_checked.add(kind)
+        if missing:
+            self.log(f"Lean browser: {kind} XPaths not found: {', '.join(missing)} (check SCRAPER_LEAN_BLOCK)", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        else:
+            self.log(f"Lean browser: {kind} XPaths resolve", job_id=job_id, carteirinha_id=carteirinha_db_id)
 
     def close_driver(self):
         if self.driver:
             self.driver.quit()
 
+    @timed(SCRAPER_PHASE_SECONDS, phase="login")
     def login(self):
         if not self.driver:
             self.start_driver()
             
         try:
-            self.driver.get("https://sgucard.unimedgoiania.coop.br/cmagnet/Login.do")
+            self.driver.get(f"{SGUCARD_BASE_URL}/Login.do")
             
             WebDriverWait(self.driver, 20).until(EC.presence_of_element_located((By.ID, "passwordTemp")))
             
@@ -85,266 +311,519 @@ class UnimedScraper:
             
             login_elem.clear()
             login_elem.send_keys(self.username)
-            time.sleep(1)
             passwordTemp.clear()
             passwordTemp.send_keys(self.password)
             Button_DoLogin.click()
-            time.sleep(4)
+            try:
+                self.waits.login_done(passwordTemp)
+            except TimeoutException:
+                self.log("Login page did not navigate in time.", level="WARNING")
             self.log("Login performed")
         except Exception as e:
             self.log(f"Login failed: {e}", level="ERROR")
             raise e
         
-    # (Since I cannot easily insert methods without replacing large chunks, I will replace process_carteirinha fully)
+    @timed(SCRAPER_PHASE_SECONDS, phase="list_read")
+    def read_result_rows(self, job_id=None, carteirinha_db_id=None):
+        # One dict per data row of the results table:
+        # index (row is tbody/tr[index+1]), status, date, guia, href, fingerprint
+        if self.extract_mode == "js":
+            # Whole page in a single WebDriver round trip
+            rows = self.driver.execute_script(LIST_ROWS_JS) or []
+            for row in rows:
+                row["fingerprint"] = row_fingerprint(row.pop("text"))
+            return rows
+        
+        DataTable = self.driver.find_element(By.XPATH, RESULTS_TABLE_XPATH)
+        linhas = DataTable.find_elements(By.TAG_NAME, "tr")
+        # Skip header (tr[1]) and footer (last tr), as in the original script
+        rows = []
+        for idx in range(1, len(linhas) - 1):
+            try:
+                # Re-find element to avoid stale reference
+                row_xpath = f'{RESULTS_TABLE_XPATH}/tbody/tr[{idx+1}]'
+                status_span = self.driver.find_element(By.XPATH, f'{row_xpath}/td[6]/span')
+                
+                # Scroll into view
+                self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", status_span)
+                
+                row = {"index": idx, "status": status_span.text, "date": "", "guia": None, "href": None, "fingerprint": None}
+                if row["status"] == "Autorizado":
+                    row["date"] = self.driver.find_element(By.XPATH, f'{row_xpath}/td[1]').text.strip()
+                    row["guia"] = self.driver.find_element(By.XPATH, f'{row_xpath}/td[4]/a').text.strip()
+                    row["fingerprint"] = row_fingerprint(self.driver.find_element(By.XPATH, row_xpath).text)
+                rows.append(row)
+            except Exception as row_e:
+                self.log(f"Error processing row {idx}: {row_e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        return rows
 
-    def process_carteirinha(self, carteirinha, job_id=None, carteirinha_db_id=None):
-        # Returns list of guias dicts
-        self.log(f"Processing carteirinha: {carteirinha}", job_id=job_id, carteirinha_id=carteirinha_db_id)
+    def open_row_detail(self, row):
+        if self.extract_mode == "js":
+            if not self.driver.execute_script(CLICK_ROW_LINK_JS, row["index"]):
+                raise NoSuchElementException(f"Guia link not found on row {row['index']}")
+            return
+        link_element = self.driver.find_element(By.XPATH, f'{RESULTS_TABLE_XPATH}/tbody/tr[{row["index"]+1}]/td[4]/a')
+        link_element.click()
+
+    def read_detail(self):
+        # Returns the guia dict, or None when the detail view is not loaded
+        if self.extract_mode == "js":
+            fields = self.driver.execute_script(DETAIL_JS)
+            if not fields or not fields.pop("loaded"):
+                return None
+            missing = [name for name, value in fields.items() if value is None]
+            if missing:
+                raise NoSuchElementException(f"Detail fields not found: {', '.join(missing)}")
+            fields["status"] = "Autorizado"
+            return fields
         
+        if not self.driver.find_elements(By.XPATH, '//*[@id="Button_Voltar"]'):
+            return None
+        # Using XPaths from original
+        return {
+            "numero_guia": self.driver.find_element(By.XPATH, DETAIL_XPATHS["numero_guia"]).text,
+            "data_autorizacao": self.driver.find_element(By.XPATH, DETAIL_XPATHS["data_autorizacao"]).text,
+            "senha": self.driver.find_element(By.XPATH, DETAIL_XPATHS["senha"]).text,
+            "validade_senha": self.driver.find_element(By.XPATH, DETAIL_XPATHS["validade_senha"]).text,
+            "codigo_terapia": self.driver.find_element(By.XPATH, DETAIL_XPATHS["codigo_terapia"]).get_attribute("value"),
+            "qtde_solicitada": self.driver.find_element(By.XPATH, DETAIL_XPATHS["qtde_solicitada"]).text.strip(),
+            "qtde_autorizada": self.driver.find_element(By.XPATH, DETAIL_XPATHS["qtde_autorizada"]).text.strip(),
+            "status": "Autorizado"
+        }
+
+    # (Since I cannot easily insert methods without replacing large chunks, I will replace process_carteirinha fully)
+
+    def row_date(self, row):
+        try:
+            return datetime.datetime.strptime(row["date"], "%d/%m/%Y").date()
+        except:
+            return datetime.datetime.now().date()
+
+    def cutoff_date(self):
+        # Rows older than this end the scrape (listing is sorted newest first)
+        return datetime.datetime.now().date() - datetime.timedelta(days=CUTOFF_DAYS)
+
+    def prepare_watermark(self, watermark):
+        # Incremental sync: the dispatcher sends the newest known data_autorizacao
+        # and the guias it already has around it. Full resync: only the fingerprints
+        # of the stored guias (since None: no row is out of scope). None: plain full scrape.
+        if not watermark:
+            return None
+        fingerprints = watermark.get("fingerprints") or {}
+        full = {"since": None, "known": set(), "fingerprints": fingerprints} if fingerprints else None
+        if watermark.get("full_resync") or not watermark.get("data_autorizacao"):
+            return full
+        try:
+            newest = datetime.datetime.strptime(watermark["data_autorizacao"], "%d/%m/%Y").date()
+        except ValueError:
+            return full
+        overlap = datetime.timedelta(days=int(watermark.get("overlap_days") or 0))
+        return {
+            "since": newest - overlap,
+            "known": set(watermark.get("guias") or []),
+            "fingerprints": watermark.get("fingerprints") or {},
+        }
+
+    def classify_row(self, row, watermark=None):
+        # open: scrape its detail page; skip / known / unchanged: move on to the next row;
+        # cutoff / watermark: this row and everything after it (newest first) is out of scope
+        if row["status"] != "Autorizado":
+            return "skip"
+        guia_date = self.row_date(row)
+        # Date Filter (Old guides)
+        if guia_date < self.cutoff_date():
+            return "cutoff"
+        if watermark:
+            if watermark["since"] and guia_date < watermark["since"]:
+                return "watermark"
+            known_fingerprint = watermark["fingerprints"].get(row.get("guia"))
+            if known_fingerprint:
+                # Stored guia: only reopen it when its listing row changed
+                return "unchanged" if known_fingerprint == row.get("fingerprint") else "open"
+            if row.get("guia") in watermark["known"]:
+                return "known"
+        return "open"
+
+    def stop_message(self, row, action):
+        if action == "watermark":
+            return f"Guia date {row['date']} is before the sync watermark. Stopping."
+        return f"Guia date {row['date']} is older than limit. Stopping."
+
+    @timed(SCRAPER_PHASE_SECONDS, phase="header_sort")
+    def sort_results_by_date(self, job_id=None, carteirinha_db_id=None):
+        # Sort by Date (click header twice)
+        self.log("Sorting table by date (Clicking header twice)...", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        try:
+            # Based on original script: //*[@id="conteudo-submenu"]/table[2]/tbody/tr[1]/td[1]/a
+            header_xpath = f'{RESULTS_TABLE_XPATH}/tbody/tr[1]/td[1]/a'
+            headers = self.driver.find_elements(By.XPATH, header_xpath)
+            if headers:
+                for click in ("once", "twice"):
+                    # Re-find element to avoid stale reference
+                    header = headers[0] if click == "once" else self.driver.find_element(By.XPATH, header_xpath)
+                    header.click()
+                    try:
+                        self.waits.table_rerendered(header)
+                        self.log(f"Clicked header {click}. Table re-rendered.", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                    except TimeoutException:
+                        self.log(f"Clicked header {click}. Table did not re-render in time.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
+            else:
+                self.log("Sort header not found. Proceeding without explicit sort.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        except Exception as sort_e:
+            self.log(f"Error while sorting table: {sort_e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
+
+    def go_back_to_list(self):
+        voltar = self.driver.find_element(By.XPATH, '//*[@id="Button_Voltar"]')
+        voltar.click()
+        try:
+            self.waits.back_done(voltar)
+        except TimeoutException:
+            # Click went through; the next row lookup will surface a real failure
+            self.log("Listing did not reload in time after 'Voltar'.", level="WARNING")
+
+    def open_results(self, carteirinha, job_id=None, carteirinha_db_id=None, reuse_popup=False):
+        # From the logged-in main window to the sorted results listing in the popup.
+        # Returns False when the results table never shows up (popup already closed).
+        # reuse_popup: batch mode, fill the form of the popup left open by the previous job.
         handles = self.driver.window_handles
+        if reuse_popup and len(handles) > 1:
+            self.driver.switch_to.window(handles[-1])
+            if self.driver.find_elements(By.NAME, 'nr_via'):
+                self.log("Reusing open popup", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                return self.submit_carteirinha(carteirinha, job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+            # Popup no longer shows the form: start over
+            self.close_popup()
+            handles = self.driver.window_handles
         if len(handles) > 1:
             self.driver.switch_to.window(handles[0])
         
+        # Check if we need to login again or navigate?
+        # Assuming we are at the logged in state.
+        self.sort_results_by_date(job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+
+        self.log("Starting scraping loop...", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        popup_started = time.monotonic()
+        handles_before = len(self.driver.window_handles)
         try:
-            # Check if we need to login again or navigate?
-            # Assuming we are at the logged in state.
-            
-            # Helper to check element presence
-            def is_element_present(by, value):
-                try:
-                    self.driver.find_element(by, value)
-                    return True
-                except NoSuchElementException:
-                    return False
+            # Update XPath or try multiple?
+            # User says: "não foi clicado no elemento new_exame"
+            WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.XPATH, '//*[@id="cadastro_biometria"]/div/div[2]/span')))
+            new_exame = self.driver.find_element(By.XPATH, '//*[@id="cadastro_biometria"]/div/div[2]/span')
+            new_exame.click()
+            self.log("Clicked 'new_exame'", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        except Exception as e:
+            self.log(f"Failed to find/click 'new_exame': {str(e)}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
+            raise e
 
-            # Sort by Date (click header twice)
-            self.log("Sorting table by date (Clicking header twice)...", job_id=job_id, carteirinha_id=carteirinha_db_id)
-            try:
-                # Based on original script: //*[@id="conteudo-submenu"]/table[2]/tbody/tr[1]/td[1]/a
-                header_xpath = '//*[@id="conteudo-submenu"]/table[2]/tbody/tr[1]/td[1]/a'
-                if is_element_present(By.XPATH, header_xpath):
-                    # First Click
-                    self.driver.find_element(By.XPATH, header_xpath).click()
-                    self.log("Clicked header once. Waiting 4s...", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                    time.sleep(4)
-                    
-                    # Re-find element to avoid stale reference
-                    self.driver.find_element(By.XPATH, header_xpath).click()
-                    self.log("Clicked header twice. Waiting 2s...", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                    time.sleep(2)
-                else:
-                    self.log("Sort header not found. Proceeding without explicit sort.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
-            except Exception as sort_e:
-                self.log(f"Error while sorting table: {sort_e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        try:
+            self.waits.popup_opened(handles_before)
+        except TimeoutException:
+            pass
+        
+        if len(self.driver.window_handles) > 1:
+            self.driver.switch_to.window(self.driver.window_handles[-1])
+            self.setup_window()
+            self.log("Switched to popup window", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        else:
+            self.log("Popup window did not open!", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
+            raise Exception("Popup window not found")
+        SCRAPER_PHASE_SECONDS.observe(time.monotonic() - popup_started, phase="popup_open")
+        
+        return self.submit_carteirinha(carteirinha, job_id=job_id, carteirinha_db_id=carteirinha_db_id)
 
-            self.log("Starting scraping loop...", job_id=job_id, carteirinha_id=carteirinha_db_id)
-            try:
-                # Update XPath or try multiple?
-                # User says: "não foi clicado no elemento new_exame"
-                WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.XPATH, '//*[@id="cadastro_biometria"]/div/div[2]/span')))
-                new_exame = self.driver.find_element(By.XPATH, '//*[@id="cadastro_biometria"]/div/div[2]/span')
-                new_exame.click()
-                self.log("Clicked 'new_exame'", job_id=job_id, carteirinha_id=carteirinha_db_id)
-            except Exception as e:
-                self.log(f"Failed to find/click 'new_exame': {str(e)}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                raise e
+    def submit_carteirinha(self, carteirinha, job_id=None, carteirinha_db_id=None):
+        # Fill the popup form and wait for the (sorted) results listing
+        form_started = time.monotonic()
+        previous_results = self.driver.find_elements(By.XPATH, '//*[@id="s_NR_GUIA"]')
+        x1, x2, x3, x4, x5 = self.funccarteira(carteirinha)
+        cartCompleto = x1 + x2 + x3 + x4 + x5      
+        cartaoParcial = x2 + x3 + x4 + x5
+        
+        self.log("Filling form...", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        self.waits.form_ready()
+        self.record_page("form")
+        # Form Filling
+        element7 = self.driver.find_element(By.NAME, 'nr_via')
+        element6 = self.driver.find_element(By.NAME, 'DS_CARTAO')
+        element3 = self.driver.find_element(By.NAME, 'CD_DEPENDENCIA')
+        
+        self.driver.execute_script("arguments[0].setAttribute('type', 'text');", element7)
+        element7.clear()
+        element7.send_keys(cartCompleto)
+        
+        self.driver.execute_script("arguments[0].setAttribute('type', 'text');", element6)
+        element6.clear()
+        element6.send_keys(cartaoParcial)
+        
+        self.driver.execute_script("arguments[0].setAttribute('type', 'text');", element3)
+        element3.clear()
+        element3.send_keys(x3)
+        
+        if x1 != "0064":
+             self.log(f"Carteirinha prefix {x1} != 0064. Checking Validade...", job_id=job_id, carteirinha_id=carteirinha_db_id)
+             if len(self.driver.find_elements(By.XPATH, '//*[@id="Button_Consulta"]')) > 0:
+                  self.driver.find_element(By.XPATH, '//*[@id="Button_Consulta"]').click()
+        
+        SCRAPER_PHASE_SECONDS.observe(time.monotonic() - form_started, phase="form_fill")
+        
+        # Wait for results table
+        self.log("Waiting for Results Table...", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        try:
+            with SCRAPER_PHASE_SECONDS.time(phase="results_wait"):
+                self.waits.results_loaded(previous_results[0] if previous_results else None)
+        except TimeoutException:
+             self.log("Timeout waiting for results table. Maybe no guias or connection error.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
+             # Close popup and return empty
+             self.close_popup()
+             return False
+        
+        self.sort_results_by_date(job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+        return True
 
-            time.sleep(3)
-            
-            if len(self.driver.window_handles) > 1:
-                self.driver.switch_to.window(self.driver.window_handles[-1])
-                self.driver.maximize_window()
-                self.log("Switched to popup window", job_id=job_id, carteirinha_id=carteirinha_db_id)
-            else:
-                self.log("Popup window did not open!", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                raise Exception("Popup window not found")
-            
-            x1, x2, x3, x4, x5 = self.funccarteira(carteirinha)
-            cartCompleto = x1 + x2 + x3 + x4 + x5      
-            cartaoParcial = x2 + x3 + x4 + x5
-            
-            self.log("Filling form...", job_id=job_id, carteirinha_id=carteirinha_db_id)
-            # Form Filling
-            element7 = self.driver.find_element(By.NAME, 'nr_via')
-            element6 = self.driver.find_element(By.NAME, 'DS_CARTAO')
-            element3 = self.driver.find_element(By.NAME, 'CD_DEPENDENCIA')
-            
-            self.driver.execute_script("arguments[0].setAttribute('type', 'text');", element7)
-            element7.clear()
-            element7.send_keys(cartCompleto)
-            
-            self.driver.execute_script("arguments[0].setAttribute('type', 'text');", element6)
-            element6.clear()
-            element6.send_keys(cartaoParcial)
-            
-            self.driver.execute_script("arguments[0].setAttribute('type', 'text');", element3)
-            element3.clear()
-            element3.send_keys(x3)
-            
-            if x1 != "0064":
-                 self.log(f"Carteirinha prefix {x1} != 0064. Checking Validade...", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                 if len(self.driver.find_elements(By.XPATH, '//*[@id="Button_Consulta"]')) > 0:
-                      self.driver.find_element(By.XPATH, '//*[@id="Button_Consulta"]').click()
-                      time.sleep(2)
-            
-            # Wait for results table
-            self.log("Waiting for Results Table...", job_id=job_id, carteirinha_id=carteirinha_db_id)
+    def close_popup(self):
+        if len(self.driver.window_handles) > 1:
+            self.driver.close()
+            self.driver.switch_to.window(self.driver.window_handles[0])
+
+    def resume_targets(self, rows, targets, page, checkpoint=None, job_id=None, carteirinha_db_id=None):
+        # Retried job: drop the targets already scraped before the checkpoint.
+        # Pages before the checkpoint page are only paged through.
+        if not checkpoint:
+            return targets
+        checkpoint_page = checkpoint.get("page") or 1
+        if page < checkpoint_page:
+            self.log(f"Resuming from checkpoint: skipping page {page}.", job_id=job_id, carteirinha_id=carteirinha_db_id)
+            return []
+        if page > checkpoint_page or not checkpoint.get("guia"):
+            return targets
+        done = [row["index"] for row in rows if row.get("guia") == checkpoint["guia"]]
+        if not done:
+            # Listing shifted since the last attempt: redo the whole page
+            self.log(f"Checkpoint guia {checkpoint['guia']} not found on page {page}. Scraping the whole page.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
+            return targets
+        self.log(f"Resuming after guia {checkpoint['guia']} on page {page}.", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        return [row for row in targets if row["index"] > done[0]]
+
+    def track_progress(self, guia_data, page):
+        GUIAS_SCRAPED.inc()
+        self.progress = {"page": page, "guia": guia_data.get("numero_guia"), "date": guia_data.get("data_autorizacao")}
+
+    def select_targets(self, rows, watermark=None, job_id=None, carteirinha_db_id=None):
+        # Rows of one listing page whose detail pages must be opened, and whether
+        # the scrape stops after this page (cutoff/watermark reached)
+        targets = []
+        for row in rows:
+            action = self.classify_row(row, watermark)
+            if action == "unchanged":
+                self.seen_unchanged.append(row["guia"])
+            elif action in ("cutoff", "watermark"):
+                self.log(self.stop_message(row, action), job_id=job_id, carteirinha_id=carteirinha_db_id)
+                return targets, True
+            elif action == "open":
+                targets.append(row)
+        return targets, False
+
+    def scrape_details(self, targets, job_id=None, carteirinha_db_id=None):
+        # Yields one guia dict per target row, in listing order
+        if self.detail_tabs > 1 and len(targets) > 1 and all(fetchable(row["href"]) for row in targets):
+            yield from self.scrape_details_in_tabs(targets, job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+            return
+        for row in targets:
+            guia_data = self.scrape_detail_inline(row, job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+            if guia_data:
+                yield guia_data
+
+    @timed(SCRAPER_PHASE_SECONDS, phase="detail")
+    def scrape_detail_inline(self, row, job_id=None, carteirinha_db_id=None):
+        # Click the row, read the detail view and come back to the listing
+        try:
+            # Click to details
+            self.open_row_detail(row)
             try:
-                WebDriverWait(self.driver, 20).until(EC.presence_of_element_located((By.XPATH, '//*[@id="s_NR_GUIA"]')))
+                self.waits.detail_loaded()
             except TimeoutException:
-                 self.log("Timeout waiting for results table. Maybe no guias or connection error.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                 # Close popup and return empty
-                 self.driver.close()
-                 self.driver.switch_to.window(self.driver.window_handles[0])
-                 return []
-
-            collected_data = [] 
+                pass
             
-            # Helper to check element presence
-            def is_element_present(by, value):
-                try:
-                    self.driver.find_element(by, value)
-                    return True
-                except NoSuchElementException:
-                    return False
-
-            # Sort by Date (click header twice)
-            self.log("Sorting table by date (Clicking header twice)...", job_id=job_id, carteirinha_id=carteirinha_db_id)
+            # Extract Details
             try:
-                # Based on original script: //*[@id="conteudo-submenu"]/table[2]/tbody/tr[1]/td[1]/a
-                header_xpath = '//*[@id="conteudo-submenu"]/table[2]/tbody/tr[1]/td[1]/a'
-                if is_element_present(By.XPATH, header_xpath):
-                    # First Click
-                    self.driver.find_element(By.XPATH, header_xpath).click()
-                    self.log("Clicked header once. Waiting 4s...", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                    time.sleep(4)
+                self.record_page("detail", row=row)
+                self.check_xpaths("detail", CHECK_DETAIL_XPATHS, "voltar", job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+                guia_data = self.read_detail()
+                if guia_data:
+                    guia_data["list_fingerprint"] = row["fingerprint"]
+                    self.log(f"Scraped Guia {guia_data['numero_guia']}", job_id=job_id, carteirinha_id=carteirinha_db_id)
                     
-                    # Re-find element to avoid stale reference
-                    self.driver.find_element(By.XPATH, header_xpath).click()
-                    self.log("Clicked header twice. Waiting 2s...", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                    time.sleep(2)
+                    # Go Back
+                    self.go_back_to_list()
+                    return guia_data
                 else:
-                    self.log("Sort header not found. Proceeding without explicit sort.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
-            except Exception as sort_e:
-                self.log(f"Error while sorting table: {sort_e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                     self.log("Detail view not loaded correctly.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                     self.driver.back() # Try browser back? or just loop
+            except Exception as inner_e:
+                self.log(f"Error extracting details: {inner_e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                # Try to recover navigation
+                try:
+                    self.driver.execute_script("window.history.go(-1)")
+                    WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.XPATH, RESULTS_TABLE_XPATH)))
+                except: pass
+
+        except Exception as row_e:
+            self.log(f"Error processing row {row['index']}: {row_e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        return None
+
+    def scrape_details_in_tabs(self, targets, job_id=None, carteirinha_db_id=None):
+        # Round-robin pipeline over K tabs of the same logged-in driver: every tab
+        # is loading its next detail page while the others are being read.
+        listing = self.driver.current_window_handle
+        base_url = self.driver.current_url
+        pending = list(enumerate(targets))
+        results = [None] * len(targets)
+        in_flight = {}  # tab handle -> target index
+        self.log(f"Opening {len(targets)} detail pages in {min(self.detail_tabs, len(targets))} tabs...", job_id=job_id, carteirinha_id=carteirinha_db_id)
+
+        def navigate(handle):
+            i, row = pending.pop(0)
+            # location change returns immediately; driver.get would block until loaded
+            self.driver.execute_script("window.location.href = arguments[0];", urljoin(base_url, row["href"]))
+            in_flight[handle] = i
+
+        try:
+            for _ in range(min(self.detail_tabs, len(targets))):
+                self.driver.switch_to.new_window("tab")
+                self.block_resources()
+                navigate(self.driver.current_window_handle)
+
+            while in_flight:
+                for handle in list(in_flight):
+                    i = in_flight.pop(handle)
+                    row = targets[i]
+                    self.driver.switch_to.window(handle)
+                    detail_started = time.monotonic()
+                    try:
+                        self.waits.detail_loaded()
+                        self.record_page("detail", row=row)
+                        self.check_xpaths("detail", CHECK_DETAIL_XPATHS, "voltar", job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+                        guia_data = self.read_detail()
+                        if guia_data:
+                            guia_data["list_fingerprint"] = row["fingerprint"]
+                            results[i] = guia_data
+                            self.log(f"Scraped Guia {guia_data['numero_guia']}", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                        else:
+                            self.log(f"Detail view not loaded correctly (row {row['index']}).", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                    except Exception as tab_e:
+                        self.log(f"Error extracting details of row {row['index']}: {tab_e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                    # Wait for this tab + read (its load overlapped with the other tabs)
+                    SCRAPER_PHASE_SECONDS.observe(time.monotonic() - detail_started, phase="detail")
+                    if pending:
+                        navigate(handle)
+        finally:
+            for handle in self.driver.window_handles:
+                if handle not in (listing, self.driver.window_handles[0]):
+                    self.driver.switch_to.window(handle)
+                    self.driver.close()
+            self.driver.switch_to.window(listing)
 
+        for guia_data in results:
+            if guia_data:
+                yield guia_data
+
+    @timed(SCRAPER_PHASE_SECONDS, phase="pagination")
+    def next_page(self, job_id=None, carteirinha_db_id=None):
+        # Pagination. Returns False on the last page.
+        try:
+             next_link = self.driver.find_element(By.LINK_TEXT, "Próxima")
+             old_table = self.driver.find_element(By.XPATH, RESULTS_TABLE_XPATH)
+             self.log("Navigating to next page...", job_id=job_id, carteirinha_id=carteirinha_db_id)
+             next_link.click()
+             try:
+                 self.waits.page_changed(old_table)
+             except TimeoutException:
+                 self.log("Next page did not load in time.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
+             return True
+        except NoSuchElementException:
+            self.log("No more pages.", job_id=job_id, carteirinha_id=carteirinha_db_id)
+            return False
+
+    def process_carteirinha(self, carteirinha, job_id=None, carteirinha_db_id=None, watermark=None, keep_popup=False, checkpoint=None):
+        # Returns list of guias dicts
+        # keep_popup: leave the popup open for the next carteirinha of a batch
+        # checkpoint: progress of a previous attempt of this job, to resume after
+        return list(self.iter_carteirinha(carteirinha, job_id=job_id, carteirinha_db_id=carteirinha_db_id, watermark=watermark, keep_popup=keep_popup, checkpoint=checkpoint))
+
+    def iter_carteirinha(self, carteirinha, job_id=None, carteirinha_db_id=None, watermark=None, keep_popup=False, checkpoint=None):
+        # Yields each guia dict as soon as it is scraped (streaming mode)
+        self.log(f"Processing carteirinha: {carteirinha}", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        self.waits.reset()
+        if self.recorder:
+            self.recorder.begin(carteirinha, extract_mode=self.extract_mode, watermark=watermark, checkpoint=checkpoint, cutoff_date=f"{self.cutoff_date():%d/%m/%Y}")
+        watermark = self.prepare_watermark(watermark)
+        self.seen_unchanged = []
+        self.progress = dict(checkpoint) if checkpoint else None
+        if checkpoint:
+            self.log(f"Retry: resuming from page {checkpoint.get('page')} after guia {checkpoint.get('guia')}", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        if watermark and watermark["since"]:
+            self.log(f"Incremental sync since {watermark['since']:%d/%m/%Y} ({len(watermark['known'])} known guias)", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        elif watermark:
+            self.log(f"Full resync, skipping unchanged rows of {len(watermark['fingerprints'])} stored guias", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        
+        try:
+            if not self.open_results(carteirinha, job_id=job_id, carteirinha_db_id=carteirinha_db_id, reuse_popup=keep_popup):
+                return
+            
             self.log("Starting scraping loop...", job_id=job_id, carteirinha_id=carteirinha_db_id)
             
+            page = 1
             while True:
                 try:
-                    # Re-find table elements on each iteration/page
-                    DataTable = self.driver.find_element(By.XPATH, '//*[@id="conteudo-submenu"]/table[2]')
-                    linhas = DataTable.find_elements(By.TAG_NAME, "tr")
-                    # Skip header and maybe footer? Original skipped [1:-1]
-                    # Original loop: range(1, x_count - 1) => skipping first (header) and last?
-                    # Let's inspect rows to be safe. Usually tr[0] is header.
+                    # Re-read the table on each iteration/page
+                    self.record_page("listing")
+                    self.check_xpaths("listing", CHECK_LISTING_XPATHS, "status", job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+                    rows = self.read_result_rows(job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+                    self.log(f"Found {len(rows)} rows on page.", job_id=job_id, carteirinha_id=carteirinha_db_id)
                     
-                    rows_to_process = len(linhas)
-                    self.log(f"Found {rows_to_process} rows on page.", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                    targets, stop = self.select_targets(rows, watermark, job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+                    targets = self.resume_targets(rows, targets, page, checkpoint, job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+                    for guia_data in self.scrape_details(targets, job_id=job_id, carteirinha_db_id=carteirinha_db_id):
+                        self.track_progress(guia_data, page)
+                        if self.recorder:
+                            self.recorder.result(guia_data)
+                        yield guia_data
                     
-                    # Iterate rows
-                    # Note: accessing by index is fragile if DOM changes, but following original logic
-                    for idx in range(1, rows_to_process - 1):
-                        try:
-                            # Re-find element to avoid stale reference
-                            row_xpath = f'//*[@id="conteudo-submenu"]/table[2]/tbody/tr[{idx+1}]'
-                            status_span = self.driver.find_element(By.XPATH, f'{row_xpath}/td[6]/span')
-                            
-                            # Scroll into view
-                            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", status_span)
-                            
-                            if status_span.text == "Autorizado":
-                                date_element = self.driver.find_element(By.XPATH, f'{row_xpath}/td[1]')
-                                date_text = date_element.text.strip()
-                                
-                                try:
-                                    guia_date = datetime.datetime.strptime(date_text, "%d/%m/%Y").date()
-                                except:
-                                    guia_date = datetime.datetime.now().date()
-                                
-                                # Date Filter (Old guides)
-                                cutoff_date = datetime.datetime.now().date() - datetime.timedelta(days=270) # Using 270 as in original
-                                if guia_date < cutoff_date:
-                                    self.log(f"Guia date {date_text} is older than limit. Stopping.", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                                    # Close popup and return what we have
-                                    self.driver.close()
-                                    self.driver.switch_to.window(self.driver.window_handles[0])
-                                    return collected_data
-
-                                # Click to details
-                                link_element = self.driver.find_element(By.XPATH, f'{row_xpath}/td[4]/a')
-                                link_element.click()
-                                time.sleep(2)
-                                
-                                # Extract Details
-                                try:
-                                    # Wait for detail view
-                                    if is_element_present(By.XPATH, '//*[@id="Button_Voltar"]'):
-                                        # Scrape details
-                                        # Using XPaths from original
-                                        new_num_guia = self.driver.find_element(By.XPATH, '//*[@id="conteudo-submenu"]/form/table/tbody/tr[3]/td[2]').text
-                                        data_auth = self.driver.find_element(By.XPATH, '//*[@id="conteudo-submenu"]/form/table/tbody/tr[4]/td[4]').text
-                                        senha = self.driver.find_element(By.XPATH, '//*[@id="conteudo-submenu"]/form/table/tbody/tr[5]/td[2]').text
-                                        data_valid = self.driver.find_element(By.XPATH, '//*[@id="CampoValidadeSenha"]').text
-                                        cod_terapia = self.driver.find_element(By.XPATH, '/html/body/div[1]/div[13]/div/table/tbody/tr[2]/td[3]/input').get_attribute("value")
-                                        qtde_solic = self.driver.find_element(By.XPATH, '/html/body/div[1]/div[13]/div/table/tbody/tr[2]/td[5]').text.strip()
-                                        qtde_aut = self.driver.find_element(By.XPATH, '/html/body/div[1]/div[13]/div/table/tbody/tr[2]/td[6]').text.strip()
-                                        
-                                        guia_data = {
-                                            "numero_guia": new_num_guia,
-                                            "data_autorizacao": data_auth,
-                                            "senha": senha,
-                                            "validade_senha": data_valid,
-                                            "codigo_terapia": cod_terapia,
-                                            "qtde_solicitada": qtde_solic,
-                                            "qtde_autorizada": qtde_aut,
-                                            "status": "Autorizado"
-                                        }
-                                        collected_data.append(guia_data)
-                                        self.log(f"Scraped Guia {new_num_guia}", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                                        
-                                        # Go Back
-                                        self.driver.find_element(By.XPATH, '//*[@id="Button_Voltar"]').click()
-                                        time.sleep(1)
-                                    else:
-                                         self.log("Detail view not loaded correctly.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                                         self.driver.back() # Try browser back? or just loop
-                                except Exception as inner_e:
-                                    self.log(f"Error extracting details: {inner_e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                                    # Try to recover navigation
-                                    try:
-                                        self.driver.execute_script("window.history.go(-1)")
-                                    except: pass
-
-                        except Exception as row_e:
-                            self.log(f"Error processing row {idx}: {row_e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                            continue
-
-                    # Pagination
-                    try:
-                         next_link = self.driver.find_element(By.LINK_TEXT, "Próxima")
-                         self.log("Navigating to next page...", job_id=job_id, carteirinha_id=carteirinha_db_id)
-                         next_link.click()
-                         time.sleep(2)
-                    except NoSuchElementException:
-                        self.log("No more pages.", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                    if stop or not self.next_page(job_id=job_id, carteirinha_db_id=carteirinha_db_id):
                         break
+                    page += 1
 
                 except Exception as table_e:
                     self.log(f"Error validating table loop: {table_e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
                     break
             
-            self.driver.close()
-            self.driver.switch_to.window(self.driver.window_handles[0])
-            
-            return collected_data 
+            self.log_wait_stats(job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+            if not keep_popup:
+                self.close_popup()
 
+        except GeneratorExit:
+            # Consumer went away mid-scrape (e.g. stream client disconnected)
+            self.close_popup()
+            if self.recorder:
+                self.recorder.finish(error="Stopped by the consumer")
+            raise
         except Exception as e:
             self.log(f"Error processing carteirinha: {e}", level="ERROR", job_id=job_id, carteirinha_id=carteirinha_db_id)
-            if len(self.driver.window_handles) > 1:
-                self.driver.close()
-                self.driver.switch_to.window(self.driver.window_handles[0])
+            self.close_popup()
+            if self.recorder:
+                self.recorder.finish(error=e)
             raise e
+        finally:
+            if self.recorder:
+                self.recorder.finish()
+
+    def log_wait_stats(self, job_id=None, carteirinha_db_id=None):
+        summary = ", ".join(
+            f"{name}: {s['count']}x avg {s['avg']}s max {s['max']}s"
+            for name, s in self.waits.stats().items()
+        )
+        if summary:
+            self.log(f"Wait timings - {summary}", job_id=job_id, carteirinha_id=carteirinha_db_id)
 
 # Main execution if run directly
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+"""
+Asyncio dispatcher mode
+One shared keep-alive HTTP client and a fixed number of dispatch slots. Each
+slot asks the router for the worker expected to finish a job first, claims
+for it, and loops back as soon as the job completes.
+"""
+import os
+import asyncio
+import httpx
+
+from metrics import DISPATCHER_PHASE_SECONDS
+
+from database import thread_session
+from dispatcher import (
+    SERVERS,
+    ROUTER,
+    WAKEUP,
+    WORKER_CONCURRENCY,
+    DISPATCH_STAGGER,
+    LISTEN_FALLBACK_POLL_SECONDS,
+    BATCH_SIZE,
+    STREAM_RESULTS,
+    StreamConsumer,
+    logger,
+    claim_jobs,
+    idle_wait,
+    build_payload,
+    log_event,
+    decode_response,
+    handle_response,
+    handle_batch_response,
+    fail_job,
+    start_background,
+)
+
+# How long an idle slot waits before polling the queue again
+IDLE_POLL_SECONDS = float(os.environ.get("ASYNC_IDLE_POLL_SECONDS", DISPATCH_STAGGER))
+REQUEST_TIMEOUT = float(os.environ.get("WORKER_REQUEST_TIMEOUT", 300))
+
+
+async def wait_for_jobs(wake):
+    # Idle until a job notification, the next retry coming due, or the fallback poll interval
+    timeout = IDLE_POLL_SECONDS
+    if WAKEUP.connected:
+        try:
+            timeout = await asyncio.to_thread(retry_wait)
+        except Exception as e:
+            logger.error(f"Could not read the next retry time: {e}")
+            timeout = LISTEN_FALLBACK_POLL_SECONDS
+    try:
+        await asyncio.wait_for(wake.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+def retry_wait():
+    with thread_session() as db:
+        timeout = idle_wait(db)
+        db.commit()
+        return timeout
+
+
+def claim(server_url):
+    with thread_session() as db:
+        return claim_jobs(db, server_url, limit=BATCH_SIZE)
+
+
+async def run_job(client, url, job):
+    # Returns (per-job success flags, error) for the router
+    job_id, carteirinha_id = job["job_id"], job["carteirinha_id"]
+    try:
+        payload = await asyncio.to_thread(build_payload, job_id, job["carteirinha"], carteirinha_id)
+        await asyncio.to_thread(log_event, job_id, carteirinha_id, "INFO", f"Dispatching to {url}")
+
+        with DISPATCHER_PHASE_SECONDS.time(phase="http_call"):
+            resp = await client.post(f"{url}/process_job", json=payload)
+        data = decode_response(job_id, carteirinha_id, resp.status_code, resp.text, resp.json)
+        # DB persistence stays synchronous (SQLAlchemy sessions), off the event loop
+        ok = await asyncio.to_thread(handle_response, job_id, carteirinha_id, data, payload["watermark"]["full_resync"], watermark=payload["watermark"])
+        return [ok], None if ok else data.get("message")
+
+    except Exception as e:
+        logger.error(f"Error calling server {url}: {e}")
+        await asyncio.to_thread(fail_job, job_id, carteirinha_id, e)
+        return [False], e
+
+
+async def run_job_stream(client, url, job):
+    job_id, carteirinha_id = job["job_id"], job["carteirinha_id"]
+    consumer = None
+    try:
+        payload = await asyncio.to_thread(build_payload, job_id, job["carteirinha"], carteirinha_id)
+        await asyncio.to_thread(log_event, job_id, carteirinha_id, "INFO", f"Dispatching to {url} (stream)")
+        consumer = StreamConsumer(job_id, carteirinha_id, watermark=payload["watermark"])
+
+        with DISPATCHER_PHASE_SECONDS.time(phase="http_stream"):
+            async with client.stream("POST", f"{url}/process_job_stream", json=payload) as resp:
+                if resp.status_code != 200:
+                    await resp.aread()
+                    data = decode_response(job_id, carteirinha_id, resp.status_code, resp.text, resp.json)
+                    await asyncio.to_thread(handle_response, job_id, carteirinha_id, data)
+                    return [False], data.get("message") or data.get("detail")
+                async for line in resp.aiter_lines():
+                    if consumer.add(line):
+                        await asyncio.to_thread(consumer.flush)
+        ok = await asyncio.to_thread(consumer.finish)
+        return [ok], None if ok else (consumer.result or {}).get("message")
+
+    except Exception as e:
+        logger.error(f"Error calling server {url} (stream): {e}")
+        if consumer:
+            await asyncio.to_thread(consumer.abort, e)
+        else:
+            await asyncio.to_thread(fail_job, job_id, carteirinha_id, e)
+        return [False], e
+
+
+def prepare_batch(url, jobs):
+    payloads = {job["job_id"]: build_payload(job["job_id"], job["carteirinha"], job["carteirinha_id"]) for job in jobs}
+    for job in jobs:
+        log_event(job["job_id"], job["carteirinha_id"], "INFO", f"Dispatching to {url} (batch of {len(jobs)})")
+    return payloads
+
+
+def fail_batch(jobs, error):
+    for job in jobs:
+        fail_job(job["job_id"], job["carteirinha_id"], error)
+
+
+async def run_batch(client, url, jobs):
+    try:
+        payloads = await asyncio.to_thread(prepare_batch, url, jobs)
+        with DISPATCHER_PHASE_SECONDS.time(phase="http_call"):
+            resp = await client.post(f"{url}/process_batch", json={"jobs": list(payloads.values())}, timeout=REQUEST_TIMEOUT * len(jobs))
+        data = decode_response(jobs[0]["job_id"], jobs[0]["carteirinha_id"], resp.status_code, resp.text, resp.json)
+        outcomes = await asyncio.to_thread(handle_batch_response, jobs, payloads, data)
+        return outcomes, None
+
+    except Exception as e:
+        logger.error(f"Error calling server {url} (batch): {e}")
+        await asyncio.to_thread(fail_batch, jobs, e)
+        return [False] * len(jobs), e
+
+
+async def dispatch_slot(client, slot, wake):
+    # One slot = at most one in-flight request, to whichever worker the router picks.
+    # Completion of a job immediately loops back to claim the next one.
+    while True:
+        url = ROUTER.choose()
+        if not url:
+            await asyncio.sleep(IDLE_POLL_SECONDS)
+            continue
+
+        ROUTER.start(url)
+        try:
+            # Cleared before the claim, not after the wait: a wakeup during the claim
+            # keeps the event set and the next wait_for_jobs returns at once
+            wake.clear()
+            try:
+                jobs = await asyncio.to_thread(claim, url)
+            except Exception as e:
+                logger.error(f"Claim failed for {url} (slot {slot}): {e}")
+                await asyncio.sleep(IDLE_POLL_SECONDS)
+                continue
+
+            if not jobs:
+                ROUTER.release(url)
+                url = None
+                await wait_for_jobs(wake)
+                continue
+
+            logger.info(f"Assigning Job(s) {[job['job_id'] for job in jobs]} to {url} (slot {slot})")
+            if len(jobs) > 1:
+                outcomes, error = await run_batch(client, url, jobs)
+            elif STREAM_RESULTS:
+                outcomes, error = await run_job_stream(client, url, jobs[0])
+            else:
+                outcomes, error = await run_job(client, url, jobs[0])
+            for ok in outcomes:
+                ROUTER.record(url, ok, error)
+        finally:
+            if url:
+                ROUTER.release(url)
+
+
+async def main():
+    # Enough slots to fill every worker up to WORKER_CONCURRENCY; the router keeps
+    # each one within the pool size it reports on /health
+    logger.info(f"Starting Async Dispatcher ({len(SERVERS)} workers, up to {WORKER_CONCURRENCY} requests each)...")
+    limits = httpx.Limits(
+        max_connections=len(SERVERS) * WORKER_CONCURRENCY,
+        max_keepalive_connections=len(SERVERS) * WORKER_CONCURRENCY,
+    )
+    timeout = httpx.Timeout(REQUEST_TIMEOUT, connect=10)
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        # Job notifications arrive on the listener thread
+        wake = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        WAKEUP.add_callback(lambda: loop.call_soon_threadsafe(wake.set))
+
+        slots = [dispatch_slot(client, slot, wake) for slot in range(len(SERVERS) * WORKER_CONCURRENCY)]
+        await asyncio.gather(*slots)
+
+
+def dispatch_async():
+    start_background()
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    dispatch_async()
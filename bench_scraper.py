@@ -0,0 +1,174 @@
+"""
+End-to-end scraping benchmark against the mock portal (mock_portal.py)
+Starts the mock portal in-process (or uses --portal-url), logs in once with a
+headless Chrome and runs process_carteirinha for N carteirinhas. Reports
+carteirinhas/hour, guias/second and per-phase timings (scraper phase
+histograms and PageWaiter waits); --out writes the same report as JSON so runs
+can be compared.
+
+    python bench_scraper.py --carteirinhas 20 --guias 40 --page-size 10 --latency-ms 100 --out bench.json
+    SCRAPER_EXTRACT_MODE=element SCRAPER_DETAIL_TABS=4 python bench_scraper.py --engine http
+    SCRAPER_LEAN_BROWSER=true python bench_scraper.py  # same guias as without it = XPaths still resolve
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import datetime
+import statistics
+import threading
+import contextlib
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_portal(args):
+    # Mock portal on a background thread of this process; returns its base URL
+    import mock_portal
+    mock_portal.CONFIG.update(
+        guias=args.guias,
+        page_size=args.page_size,
+        latency_ms=args.latency_ms,
+        detail_latency_ms=args.latency_ms if args.detail_latency_ms is None else args.detail_latency_ms,
+    )
+    port = free_port()
+    threading.Thread(target=mock_portal.run, args=(port,), daemon=True).start()
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return f"http://127.0.0.1:{port}{mock_portal.BASE_PATH}"
+        time.sleep(0.1)
+    raise RuntimeError("Mock portal did not start")
+
+
+def expected_guias(carteirinha, cutoff_days):
+    # Autorizado guias newer than the scraper's cutoff, per the mock portal's data
+    import mock_portal
+    cutoff = datetime.date.today() - datetime.timedelta(days=cutoff_days)
+    return sum(1 for g in mock_portal.guias_for(carteirinha) if g["status"] == "Autorizado" and g["date"] >= cutoff)
+
+
+def summarize(values):
+    if not values:
+        return {}
+    return {
+        "avg": round(statistics.mean(values), 3),
+        "p50": round(statistics.median(values), 3),
+        "max": round(max(values), 3),
+    }
+
+
+def run(args):
+    in_process = not args.portal_url
+    portal_url = start_portal(args) if in_process else args.portal_url.rstrip("/")
+    os.environ["SGUCARD_BASE_URL"] = portal_url
+    os.environ.setdefault("SGUCARD_HEADLESS", "true")
+    os.environ.setdefault("SCRAPER_LOG_MODE", "print")
+
+    # Imported after the env is set: ImportBaseGuias reads SGUCARD_BASE_URL at import time
+    import metrics
+    from ImportBaseGuias import UnimedScraper, CUTOFF_DAYS
+    if args.engine == "http":
+        from http_scraper import HttpUnimedScraper as scraper_class
+    else:
+        scraper_class = UnimedScraper
+
+    quiet = open(os.devnull, "w") if args.quiet else None
+    scraper = scraper_class()
+    carteirinhas = [f"0064.8000.{i + 1:06d}.00-5" for i in range(args.carteirinhas)]
+    per_carteirinha, guias_found, mismatches = [], 0, []
+    wait_totals = {}
+
+    with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+        login_started = time.monotonic()
+        scraper.start_driver()
+        scraper.login()
+        login_seconds = time.monotonic() - login_started
+        metrics.SCRAPER_PHASE_SECONDS.reset()
+
+        started = time.monotonic()
+        try:
+            for carteirinha in carteirinhas:
+                t0 = time.monotonic()
+                guias = scraper.process_carteirinha(carteirinha)
+                per_carteirinha.append(time.monotonic() - t0)
+                guias_found += len(guias)
+                for name, stats in scraper.waits.stats().items():
+                    total = wait_totals.setdefault(name, {"count": 0, "total": 0.0})
+                    total["count"] += stats["count"]
+                    total["total"] += stats["total"]
+                if in_process:
+                    expected = expected_guias(carteirinha, CUTOFF_DAYS)
+                    if expected != len(guias):
+                        mismatches.append({"carteirinha": carteirinha, "expected": expected, "scraped": len(guias)})
+        finally:
+            elapsed = time.monotonic() - started
+            scraper.close_driver()
+
+    phases = {
+        labels[0]: {"count": count, "total": round(total, 3), "avg": round(total / count, 4) if count else 0}
+        for labels, (count, total) in sorted(metrics.SCRAPER_PHASE_SECONDS.snapshot().items())
+    }
+    done = len(per_carteirinha)
+    return {
+        "run_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "portal": portal_url,
+        "engine": args.engine,
+        "extract_mode": scraper.extract_mode,
+        "detail_tabs": scraper.detail_tabs,
+        "lean_browser": scraper.lean,
+        "mock": {"guias": args.guias, "page_size": args.page_size, "latency_ms": args.latency_ms} if in_process else None,
+        "carteirinhas": done,
+        "guias": guias_found,
+        "login_seconds": round(login_seconds, 3),
+        "seconds": round(elapsed, 3),
+        "carteirinhas_per_hour": round(done / elapsed * 3600, 1) if elapsed else None,
+        "guias_per_second": round(guias_found / elapsed, 2) if elapsed else None,
+        "per_carteirinha_seconds": summarize(per_carteirinha),
+        "phases": phases,
+        "waits": {name: {"count": w["count"], "total": round(w["total"], 3)} for name, w in sorted(wait_totals.items())},
+        "mismatches": mismatches,
+    }
+
+
+def print_report(report):
+    print(f"\n{report['engine']} engine, extract={report['extract_mode']}, tabs={report['detail_tabs']}, lean={report['lean_browser']}, portal={report['portal']}")
+    print(f"{report['carteirinhas']} carteirinhas, {report['guias']} guias in {report['seconds']}s (login {report['login_seconds']}s)")
+    print(f"  {report['carteirinhas_per_hour']} carteirinhas/hour, {report['guias_per_second']} guias/s")
+    print(f"  per carteirinha: {report['per_carteirinha_seconds']}")
+    print(f"\n  {'phase':<16}{'count':>8}{'total s':>12}{'avg s':>10}")
+    for name, phase in report["phases"].items():
+        print(f"  {name:<16}{phase['count']:>8}{phase['total']:>12}{phase['avg']:>10}")
+    if report["waits"]:
+        print(f"\n  {'wait':<16}{'count':>8}{'total s':>12}")
+        for name, wait in report["waits"].items():
+            print(f"  {name:<16}{wait['count']:>8}{wait['total']:>12}")
+    if report["mismatches"]:
+        print(f"\n  WARNING: scraped counts differ from the mock data: {report['mismatches']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scraper benchmark against the mock SGUCard portal")
+    parser.add_argument("--carteirinhas", type=int, default=10)
+    parser.add_argument("--engine", choices=["selenium", "http"], default=os.environ.get("SCRAPER_ENGINE", "selenium").lower())
+    parser.add_argument("--portal-url", help="Use a running portal (e.g. mock_portal.py) instead of starting one")
+    parser.add_argument("--guias", type=int, default=40, help="Guias per carteirinha (in-process portal)")
+    parser.add_argument("--page-size", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--detail-latency-ms", type=float, default=None)
+    parser.add_argument("--out", help="Write the report as JSON to this file")
+    parser.add_argument("--quiet", action="store_true", help="Hide the scraper's log output")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if report["mismatches"] else 0)
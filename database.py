@@ -3,11 +3,18 @@ Independent database connection for Worker
 Connects directly to Supabase without depending on backend code
 """
 import os
-from sqlalchemy import create_engine
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, NullPool
 from dotenv import load_dotenv
 
+from metrics import Counter, Gauge, Histogram
+
 # Load .env from Worker directory or parent directory
 load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
@@ -20,10 +27,106 @@ DB_NAME = os.getenv("SUPABASE_DB_NAME", "postgres")
 
 SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Connection pool (per process). Size it from the db_pool_* metrics on /metrics:
+# checked-out connections near size + overflow, or a growing checkout wait, mean it is too small.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+# Reconnect connections older than this (seconds), before Supabase/pgbouncer drops them idle; -1 disables
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+# Test each connection on checkout (one cheap round trip) instead of failing on a stale one
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Connecting through pgbouncer in transaction mode: no client-side pool (pgbouncer is the pool),
+# so no connection is ever held between transactions
+DB_PGBOUNCER_TRANSACTION = os.getenv("DB_PGBOUNCER_TRANSACTION", "false").lower() == "true"
+
+DB_POOL_WAIT_SECONDS = Histogram(
+    "sgucard_db_pool_wait_seconds", "Time spent waiting for a pooled connection",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+DB_CONNECTIONS_OPENED = Counter("sgucard_db_connections_opened_total", "New database connections opened by the pool")
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that records how long each checkout waited for a free connection
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.monotonic() - start)
+
+
+if DB_PGBOUNCER_TRANSACTION:
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=NullPool, pool_pre_ping=DB_POOL_PRE_PING)
+else:
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+event.listen(engine.pool, "connect", lambda *args: DB_CONNECTIONS_OPENED.inc())
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# One session per thread, shared by everything a dispatcher thread does for a job
+ScopedSession = scoped_session(SessionLocal)
+_session_scope = threading.local()
+
+
+@contextmanager
+def thread_session():
+    # The calling thread's session. Nested scopes share it; the outermost one
+    # removes it. An exception rolls the session back before propagating.
+    depth = getattr(_session_scope, "depth", 0)
+    _session_scope.depth = depth + 1
+    session = ScopedSession()
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        _session_scope.depth = depth
+        if depth == 0:
+            ScopedSession.remove()
+
+
+def in_thread_session(func):
+    # Decorator for thread targets: everything the call does shares one session
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with thread_session():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def pool_stats():
+    # Current pool state (NullPool: nothing is pooled, only the counters apply)
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_out=pool.checkedout(), checked_in=pool.checkedin(), overflow=max(0, pool.overflow()))
+    waits = DB_POOL_WAIT_SECONDS.snapshot().get((), (0, 0.0))
+    stats.update(
+        connections_opened=DB_CONNECTIONS_OPENED.value(),
+        checkouts=waits[0],
+        wait_seconds_total=round(waits[1], 3),
+    )
+    return stats
+
+
+if isinstance(engine.pool, QueuePool):
+    Gauge("sgucard_db_pool_size", "Connections kept open by the pool", lambda: engine.pool.size())
+    Gauge("sgucard_db_pool_checked_out", "Pooled connections currently in use", lambda: engine.pool.checkedout())
+    Gauge("sgucard_db_pool_overflow", "Connections open beyond the pool size", lambda: max(0, engine.pool.overflow()))
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -1,21 +1,73 @@
 import sys
 import os
+import json
 import time
+import random
+import threading
 import requests
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import select, update, or_, and_, func, case, tuple_
 
 # Use local Worker modules (independent of backend)
-from database import SessionLocal
+from database import SessionLocal, thread_session, in_thread_session, pool_stats
 from models import Job, BaseGuia, Log, Carteirinha
+from guias import upsert_guias
+from routing import WorkerRouter
+from job_wakeup import JobWakeup
+from metrics import DISPATCHER_PHASE_SECONDS, JOBS_TOTAL
+import metrics
 
 # Configure Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 SERVERS = [url.strip() for url in os.environ.get("API_SERVER_URLS", "http://127.0.0.1:8000").split(",")]
-SERVER_STATUS = {url: {"status": "idle", "last_job": None} for url in SERVERS}
+# Concurrent requests per worker URL, on top of the pool size each worker reports on /health
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 4))
+ROUTER = WorkerRouter(SERVERS, max_in_flight=WORKER_CONCURRENCY)
+# Dispatcher status/metrics listener (GET /routing, /metrics); 0 disables it
+STATUS_PORT = int(os.environ.get("DISPATCHER_STATUS_PORT", 0))
+# A claimed job is owned for LEASE_SECONDS (jobs.timeout); the dispatcher renews the
+# lease while the job is in flight and expired leases are reclaimed by check_stuck_jobs
+LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 600))
+HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", LEASE_SECONDS / 3))
+REAPER_INTERVAL_SECONDS = float(os.environ.get("REAPER_INTERVAL_SECONDS", 60))
 DISPATCH_STAGGER = int(os.environ.get("DISPATCH_STAGGER_SECONDS", 15))
+# Wake on Postgres NOTIFY (migration 007) instead of polling every DISPATCH_STAGGER;
+# while listening, the queue is still polled every LISTEN_FALLBACK_POLL_SECONDS
+DISPATCH_LISTEN = os.environ.get("DISPATCH_LISTEN", "true").lower() == "true"
+LISTEN_FALLBACK_POLL_SECONDS = float(os.environ.get("LISTEN_FALLBACK_POLL_SECONDS", 60))
+# Retry backoff: RETRY_AFTER_MINUTES after the 1st failure, doubling per attempt up to
+# RETRY_MAX_MINUTES, each delay stretched by up to RETRY_JITTER (fraction) at random
+RETRY_AFTER_MINUTES = int(os.environ.get("RETRY_AFTER_MINUTES", 5))
+RETRY_MAX_MINUTES = int(os.environ.get("RETRY_MAX_MINUTES", 240))
+RETRY_JITTER = float(os.environ.get("RETRY_JITTER", 0.2))
+# Failed jobs go to the "dead" status (dead-letter) after MAX_ATTEMPTS attempts
+MAX_ATTEMPTS = int(os.environ.get("MAX_ATTEMPTS", 5))
+DISPATCH_MODE = os.environ.get("DISPATCH_MODE", "thread").lower()  # thread, async
+# Incremental sync: only scrape guias newer than what base_guias already has
+INCREMENTAL_SYNC = os.environ.get("INCREMENTAL_SYNC", "true").lower() == "true"
+WATERMARK_OVERLAP_DAYS = int(os.environ.get("WATERMARK_OVERLAP_DAYS", 7))
+FULL_RESYNC_HOURS = int(os.environ.get("FULL_RESYNC_HOURS", 168))
+# Jobs claimed and sent per worker request (> 1 uses the worker's /process_batch)
+BATCH_SIZE = int(os.environ.get("DISPATCH_BATCH_SIZE", 1))
+# Other queued jobs of a carteirinha being dispatched are merged into that job ("coalesced")
+COALESCE_JOBS = os.environ.get("COALESCE_JOBS", "true").lower() == "true"
+# A job for a carteirinha synced successfully less than this many minutes ago is completed
+# from base_guias without a worker; 0 disables it
+RESULT_FRESHNESS_MINUTES = int(os.environ.get("RESULT_FRESHNESS_MINUTES", 0))
+WORKER_REQUEST_TIMEOUT = 300
+
+# job_id -> attempts at claim time, for jobs this process has in flight
+ACTIVE_LEASES = {}
+LEASES_LOCK = threading.Lock()
+WAKEUP = JobWakeup()
+# Stream results from the worker's /process_job_stream and save them as they arrive
+STREAM_RESULTS = os.environ.get("STREAM_RESULTS", "false").lower() == "true"
+# Streamed guias buffered before each upsert
+STREAM_FLUSH_SIZE = int(os.environ.get("STREAM_FLUSH_SIZE", 20))
 
 def get_db():
     db = SessionLocal()
@@ -25,249 +77,732 @@ def get_db():
         db.close()
 
 def check_stuck_jobs(db):
-    # logic to release jobs that are processing for too long or server crashed?
-    # User said: "JOB com status(pending, error[caso data update_at do jobtenha mais de 5minutos ])"
-    # So we pick up errors > 5 mins too?
-    pass
+    # Return processing jobs whose lease expired (dispatcher died, or lost the job)
+    # to the queue in one UPDATE. Jobs without a lease (claimed before leases existed)
+    # expire LEASE_SECONDS after their last update. Out of attempts -> dead.
+    # Returns the number of jobs reclaimed.
+    expired = or_(
+        Job.timeout < func.now(),
+        and_(Job.timeout.is_(None), Job.updated_at < func.now() - timedelta(seconds=LEASE_SECONDS)),
+    )
+    stmt = (
+        update(Job)
+        .where(Job.status == "processing", expired)
+        .values(
+            status=case((func.coalesce(Job.attempts, 0) < MAX_ATTEMPTS, "pending"), else_="dead"),
+            locked_by=None,
+            timeout=None,
+            next_run_at=func.now(),
+            updated_at=func.now(),
+        )
+    )
+    try:
+        reclaimed = db.execute(stmt).rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if reclaimed:
+        logger.warning(f"Reaper reclaimed {reclaimed} job(s) with an expired lease")
+        # Jobs merged into one that just went dead share its fate
+        dead = select(Job.id).where(Job.status == "dead").scalar_subquery()
+        try:
+            db.execute(update(Job).where(Job.status == "coalesced", Job.coalesced_into.in_(dead)).values(status="dead", updated_at=func.now()))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return reclaimed
+
+def hold_lease(job_id, attempts):
+    with LEASES_LOCK:
+        ACTIVE_LEASES[job_id] = attempts
+
+def drop_lease(job_id):
+    with LEASES_LOCK:
+        ACTIVE_LEASES.pop(job_id, None)
+
+def owned_job(db, job_id):
+    # The job row, locked, while this process still owns it: processing at the attempt
+    # it was claimed with. None once it was reaped (and maybe claimed again elsewhere).
+    with LEASES_LOCK:
+        attempts = ACTIVE_LEASES.get(job_id)
+    if attempts is None:
+        return None
+    return (
+        db.query(Job)
+        .filter(Job.id == job_id, Job.status == "processing", Job.attempts == attempts)
+        .with_for_update()
+        .first()
+    )
+
+def renew_leases(db):
+    # Heartbeat: extend the lease of every job in flight in one UPDATE. Matching on
+    # attempts leaves alone a job that was reaped and claimed again elsewhere.
+    with LEASES_LOCK:
+        held = list(ACTIVE_LEASES.items())
+    if not held:
+        return 0
+    stmt = (
+        update(Job)
+        .where(Job.status == "processing", tuple_(Job.id, Job.attempts).in_(held))
+        .values(timeout=func.now() + timedelta(seconds=LEASE_SECONDS))
+    )
+    try:
+        renewed = db.execute(stmt).rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return renewed
+
+def lease_keeper():
+    # Background thread: heartbeats for our jobs, reaper for everyone's
+    last_reap = 0.0
+    while True:
+        try:
+            with thread_session() as db:
+                renew_leases(db)
+                if time.monotonic() - last_reap >= REAPER_INTERVAL_SECONDS:
+                    check_stuck_jobs(db)
+                    last_reap = time.monotonic()
+        except Exception as e:
+            logger.error(f"Lease keeper error: {e}")
+        time.sleep(min(HEARTBEAT_SECONDS, REAPER_INTERVAL_SECONDS))
+
+def due_jobs():
+    # The job queue: pending jobs and failed jobs whose retry time has come, in one
+    # scan of the partial index ix_jobs_queue (status, next_run_at, priority, created_at)
+    return (
+        select(Job.id)
+        .where(Job.status.in_(("pending", "error")), Job.next_run_at <= func.now())
+        .order_by(Job.priority.desc(), Job.created_at.asc())
+    )
+
+def idle_wait(db, cap=LISTEN_FALLBACK_POLL_SECONDS):
+    # How long an idle dispatcher may sleep: NOTIFY only fires for pending jobs
+    # (migration 009), so wake up when the earliest retry comes due, at most `cap`.
+    # A retry that is already due but unclaimed is waiting for a worker, whose
+    # release pokes the wakeup: no need to poll for it.
+    seconds = db.execute(
+        select(func.extract("epoch", func.min(Job.next_run_at) - func.now())).where(Job.status == "error")
+    ).scalar()
+    if seconds is None or seconds <= 0:
+        return cap
+    return min(cap, float(seconds))
 
 def get_pending_job(db):
-    # Priority: pending, or error > 5 mins
-    # Sort by priority desc, created_at asc
+    # Next due job (priority desc, created_at asc), without claiming it
+    job_id = db.execute(due_jobs().limit(1)).scalar()
+    return db.get(Job, job_id) if job_id else None
+
+def retry_delay(attempts):
+    # Seconds before the next attempt after `attempts` failed ones
+    base = min(RETRY_MAX_MINUTES * 60, RETRY_AFTER_MINUTES * 60 * 2 ** max(0, attempts - 1))
+    return base * (1 + random.uniform(0, RETRY_JITTER))
+
+def settle_coalesced(db, job_ids, status):
+    # Jobs merged into job_ids end with their final status (success or dead)
+    if not job_ids:
+        return
+    db.execute(
+        update(Job)
+        .where(Job.status == "coalesced", Job.coalesced_into.in_(job_ids))
+        .values(status=status, updated_at=func.now())
+    )
+
+def schedule_retry(db, job):
+    # Failed attempt: back off, or dead-letter the job once it is out of attempts
+    attempts = job.attempts or 0
+    if attempts >= MAX_ATTEMPTS:
+        job.status = "dead"
+        db.add(Log(job_id=job.id, carteirinha_id=job.carteirinha_id, level="ERROR", message=f"Moved to dead-letter after {attempts} attempts"))
+        settle_coalesced(db, [job.id], "dead")
+        return
+    job.status = "error"
+    job.next_run_at = datetime.now(timezone.utc) + timedelta(seconds=retry_delay(attempts))
+
+def fresh_result():
+    # Claim-time condition: the job's carteirinha was synced within RESULT_FRESHNESS_MINUTES
+    if not RESULT_FRESHNESS_MINUTES:
+        return None
+    last_sync = select(Carteirinha.last_sync_at).where(Carteirinha.id == Job.carteirinha_id).scalar_subquery()
+    return last_sync > func.now() - timedelta(minutes=RESULT_FRESHNESS_MINUTES)
+
+def coalesce_duplicates(db, claimed):
+    # Merge the other queued jobs of each claimed carteirinha into the claimed job.
+    # Two jobs of one carteirinha claimed together are merged the same way.
+    # Returns the ids of claimed jobs that were merged (not to be dispatched).
+    keep, extra = {}, []
+    for row in claimed:
+        if row.carteirinha_id in keep:
+            extra.append(row.id)
+        else:
+            keep[row.carteirinha_id] = row.id
+    queued = Job.status.in_(("pending", "error"))
+    if extra:
+        queued = or_(queued, Job.id.in_(extra))
+    stmt = (
+        update(Job)
+        .where(
+            Job.carteirinha_id.in_(list(keep)),
+            Job.id.not_in(list(keep.values())),
+            queued,
+        )
+        .values(
+            status="coalesced",
+            coalesced_into=case(keep, value=Job.carteirinha_id),
+            locked_by=None,
+            timeout=None,
+            updated_at=func.now(),
+        )
+        .returning(Job.id, Job.carteirinha_id, Job.coalesced_into)
+    )
+    merged = db.execute(stmt).all()
+    for row in merged:
+        db.add(Log(job_id=row.id, carteirinha_id=row.carteirinha_id, level="INFO", message=f"Coalesced into Job {row.coalesced_into}"))
+    if merged:
+        logger.info(f"Coalesced {len(merged)} duplicate job(s) into {sorted({row.coalesced_into for row in merged})}")
+    return {row.id for row in merged}
+
+def claim_jobs(db, locked_by, limit=1):
+    # Atomically claim up to `limit` jobs for `locked_by` in one round trip.
+    # Rows locked by another dispatcher are skipped (FOR UPDATE SKIP LOCKED), so
+    # several dispatchers can share the same jobs table without double-assigning.
+    # Eligibility and order come from due_jobs.
+    # Jobs whose carteirinha has a fresh result are completed by the same statement
+    # instead of being dispatched, and duplicates are coalesced right after.
+    candidates = (
+        due_jobs()
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .cte("candidates")
+    )
+
+    values = dict(
+        status="processing",
+        locked_by=locked_by,
+        attempts=func.coalesce(Job.attempts, 0) + 1,
+        timeout=func.now() + timedelta(seconds=LEASE_SECONDS),
+        updated_at=func.now(),
+    )
+    fresh = fresh_result()
+    if fresh is not None:
+        values.update(
+            status=case((fresh, "success"), else_="processing"),
+            locked_by=case((fresh, None), else_=locked_by),
+            timeout=case((fresh, None), else_=values["timeout"]),
+        )
+
+    stmt = (
+        update(Job)
+        .where(Job.id.in_(select(candidates.c.id)))
+        .values(**values)
+        .returning(
+            Job.id,
+            Job.carteirinha_id,
+            Job.attempts,
+            Job.status,
+            select(Carteirinha.carteirinha)
+            .where(Carteirinha.id == Job.carteirinha_id)
+            .scalar_subquery()
+            .label("carteirinha"),
+        )
+    )
+
+    try:
+        # Queue scan + claim UPDATE are one statement
+        with DISPATCHER_PHASE_SECONDS.time(phase="queue_query"):
+            claimed = db.execute(stmt).all()
+        with DISPATCHER_PHASE_SECONDS.time(phase="claim_commit"):
+            db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    served = [row for row in claimed if row.status == "success"]
+    dispatch = [row for row in claimed if row.status != "success"]
+    for row in dispatch:
+        hold_lease(row.id, row.attempts)
+
+    if claimed and (COALESCE_JOBS or served):
+        # Separate transaction: the claim is already committed, so a failure here
+        # only leaves duplicates queued
+        try:
+            with DISPATCHER_PHASE_SECONDS.time(phase="coalesce"):
+                merged = coalesce_duplicates(db, claimed) if COALESCE_JOBS else set()
+                for row in served:
+                    db.add(Log(job_id=row.id, carteirinha_id=row.carteirinha_id, level="INFO", message=f"Served from base_guias: synced less than {RESULT_FRESHNESS_MINUTES} min ago"))
+                    JOBS_TOTAL.inc(outcome="fresh")
+                settle_coalesced(db, [row.id for row in served], "success")
+                db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error coalescing jobs {[row.id for row in claimed]}: {e}")
+            merged = set()
+        for job_id in merged:
+            drop_lease(job_id)
+        dispatch = [row for row in dispatch if row.id not in merged]
+        if not dispatch:
+            # Nothing to send: look at the queue again instead of waiting for the next wakeup
+            WAKEUP.poke()
+
+    return [
+        {"job_id": row.id, "carteirinha_id": row.carteirinha_id, "carteirinha": row.carteirinha}
+        for row in dispatch
+    ]
+
+def get_watermark(db, carteirinha_id):
+    # Newest known data_autorizacao plus the guias within the overlap window before it.
+    # Full resync when disabled, never fully synced, or the last full sync is too old.
+    def full():
+        # Every listing row is visited: fingerprints of every stored guia, so rows
+        # that did not change are not reopened
+        known = db.query(BaseGuia.guia, BaseGuia.list_fingerprint).filter(
+            BaseGuia.carteirinha_id == carteirinha_id,
+            BaseGuia.list_fingerprint.is_not(None),
+        ).all()
+        return {"full_resync": True, "fingerprints": {guia: fingerprint for guia, fingerprint in known if guia}}
+
+    if not INCREMENTAL_SYNC:
+        return full()
     
-    five_min_ago = datetime.utcnow() - timedelta(minutes=5)
+    cart = db.get(Carteirinha, carteirinha_id)
+    resync_before = datetime.now(timezone.utc) - timedelta(hours=FULL_RESYNC_HOURS)
+    if not cart or not cart.last_full_sync_at or cart.last_full_sync_at < resync_before:
+        return full()
     
-    # Try pending first
-    job = db.query(Job).filter(Job.status == "pending").order_by(Job.priority.desc(), Job.created_at.asc()).first()
-    if job:
-        return job
-        
-    # Try error > 5 mins and attempts < 5
-    job = db.query(Job).filter(
-        Job.status == "error", 
-        Job.updated_at < five_min_ago,
-        Job.attempts < 5
-    ).order_by(Job.priority.desc(), Job.created_at.asc()).first()
+    newest = db.query(func.max(BaseGuia.data_autorizacao)).filter(BaseGuia.carteirinha_id == carteirinha_id).scalar()
+    if not newest:
+        return full()
     
-    return job
+    since = newest - timedelta(days=WATERMARK_OVERLAP_DAYS)
+    known = db.query(BaseGuia.guia, BaseGuia.list_fingerprint).filter(
+        BaseGuia.carteirinha_id == carteirinha_id,
+        BaseGuia.data_autorizacao >= since
+    ).all()
+    return {
+        "data_autorizacao": newest.strftime("%d/%m/%Y"),
+        "overlap_days": WATERMARK_OVERLAP_DAYS,
+        "guias": [guia for guia, _ in known if guia],
+        # Worker reopens a known guia only if its listing row no longer matches
+        "fingerprints": {guia: fingerprint for guia, fingerprint in known if guia and fingerprint},
+        "full_resync": False,
+    }
+
+def checkpoint_value(progress, watermark):
+    # Stored with the watermark of the attempt: guias saved by that attempt move
+    # the newest data_autorizacao, and a recomputed watermark would stop the retry early
+    return {**progress, "watermark": watermark}
+
+def build_payload(job_id, carteirinha, carteirinha_id):
+    with thread_session() as db:
+        checkpoint = db.query(Job.checkpoint).filter(Job.id == job_id).scalar()
+        if checkpoint and checkpoint.get("watermark"):
+            watermark = checkpoint["watermark"]
+        else:
+            watermark = get_watermark(db, carteirinha_id)
+        # Read-only: end the transaction so the connection goes back to the pool
+        db.commit()
+    with LEASES_LOCK:
+        attempts = ACTIVE_LEASES.get(job_id)
+    payload = {
+        "job_id": job_id,
+        "carteirinha_id": carteirinha_id,
+        "carteirinha": carteirinha,
+        "paciente": "",
+        "watermark": watermark,
+        # The attempt this request is for: the worker only writes the job row while it still matches
+        "attempts": attempts,
+    }
+    if checkpoint:
+        payload["checkpoint"] = {key: checkpoint.get(key) for key in ("page", "guia", "date")}
+    return payload
+
+def timed_upsert(db, carteirinha_id, items):
+    with DISPATCHER_PHASE_SECONDS.time(phase="upsert"):
+        return upsert_guias(db, carteirinha_id, items)
+
+def log_event(job_id, carteirinha_id, level, message):
+    # Best-effort log row, committed right away in the thread's session.
+    # Callers log between their own transactions, never with changes pending.
+    try:
+        with thread_session() as db:
+            db.add(Log(job_id=job_id, carteirinha_id=carteirinha_id, level=level, message=message))
+            db.commit()
+    except: pass
+
+def handle_response(job_id, carteirinha_id, data, full_resync=False, streamed=(0, 0), watermark=None):
+    # Persist a worker response (already decoded JSON) and settle the job status.
+    # streamed: (inserted, updated) already saved from a result stream
+    # (data["saved"]: the same, saved by the worker itself as the scrape advanced)
+    # watermark: the one sent to the worker, kept with the checkpoint of a failed job
+    # Returns True when the job ended in success
+    saved = data.get("saved") or (0, 0)
+    with thread_session() as thread_db:
+        current_job = owned_job(thread_db, job_id)
+        partial_saved = None
+        if current_job is None:
+            # Lease expired: the row belongs to the reaper or to a newer attempt
+            thread_db.rollback()
+            logger.warning(f"Job {job_id} is no longer ours (lease expired); ignoring the late worker response")
+            drop_lease(job_id)
+            return False
+
+        if data.get("status") == "success":
+            current_job.status = "success"
+            results = data.get("data", [])
+            # Save results to BaseGuia (single bulk upsert)
+            try:
+                logger.info(f"Processing {len(results)} items from worker response.")
+                count_inserted, count_updated = timed_upsert(thread_db, carteirinha_id, results)
+                count_inserted += streamed[0] + saved[0]
+                count_updated += streamed[1] + saved[1]
+                synced = {Carteirinha.last_sync_at: func.now()}
+                if full_resync:
+                    synced[Carteirinha.last_full_sync_at] = func.now()
+                thread_db.query(Carteirinha).filter(Carteirinha.id == carteirinha_id).update(synced, synchronize_session=False)
+                current_job.checkpoint = None
+                settle_coalesced(thread_db, [job_id], "success")
+                thread_db.commit()
+
+                count_unchanged = len(data.get("seen_unchanged") or [])
+                log_event(job_id, carteirinha_id, "INFO", f"Sync complete. Inserted: {count_inserted}, Updated: {count_updated}, Unchanged: {count_unchanged}")
+            except Exception as save_e:
+                logger.error(f"Exception during save: {save_e}")
+                thread_db.rollback()
+                log_event(job_id, carteirinha_id, "ERROR", f"Error saving results: {save_e}")
+                current_job.status = "error"
+        else:
+            current_job.status = "error"
+            # Keep what the failed attempt scraped; the retry resumes after its checkpoint
+            partial = data.get("data") or []
+            if partial or data.get("checkpoint"):
+                try:
+                    # Savepoint, not a commit: the job stays locked (and processing for
+                    # everyone else) until it is settled below, in the same transaction
+                    with thread_db.begin_nested():
+                        count_inserted, count_updated = timed_upsert(thread_db, carteirinha_id, partial)
+                        if data.get("checkpoint"):
+                            current_job.checkpoint = checkpoint_value(data["checkpoint"], watermark)
+                    partial_saved = f"Partial results saved. Inserted: {count_inserted + saved[0]}, Updated: {count_updated + saved[1]}, Checkpoint: {data.get('checkpoint')}"
+                except Exception as save_e:
+                    logger.error(f"Exception during partial save: {save_e}")
+            # Log error from server
+            err_msg = data.get("message") or data.get("detail") or "Unknown error from server"
+            thread_db.add(Log(job_id=job_id, carteirinha_id=carteirinha_id, level="ERROR", message=f"Worker Error: {err_msg}"))
+
+        ok = current_job.status == "success"
+        if not ok:
+            schedule_retry(thread_db, current_job)
+        JOBS_TOTAL.inc(outcome=current_job.status)
+        current_job.locked_by = None
+        current_job.timeout = None
+        current_job.updated_at = datetime.utcnow()
+        thread_db.commit()
+    drop_lease(job_id)
+    if partial_saved:
+        log_event(job_id, carteirinha_id, "INFO", partial_saved)
+    return ok
+
+def fail_job(job_id, carteirinha_id, error):
+    # Release a job after a transport/protocol failure talking to the worker.
+    # jobs.checkpoint is left as is: the worker (or the stream consumer) kept it
+    # up to date with the guias it saved, so the retry still resumes.
+    with thread_session() as thread_db:
+        current_job = owned_job(thread_db, job_id)
+        if current_job is None:
+            thread_db.rollback()
+            logger.warning(f"Job {job_id} is no longer ours (lease expired); not settling it after: {error}")
+        else:
+            schedule_retry(thread_db, current_job)
+            JOBS_TOTAL.inc(outcome=current_job.status)
+            current_job.locked_by = None
+            current_job.timeout = None
+            current_job.updated_at = datetime.utcnow()
+
+            # Log dispatcher error
+            try:
+                thread_db.add(Log(job_id=job_id, carteirinha_id=carteirinha_id, level="ERROR", message=f"Dispatcher Failed: {str(error)}"))
+            except: pass
+
+            thread_db.commit()
+    drop_lease(job_id)
+
+def decode_response(job_id, carteirinha_id, status_code, text, json_loader):
+    try:
+        return json_loader()
+    except ValueError:
+        # JSONDecodeError
+        err_msg = f"Invalid JSON ({status_code}): {text[:200]}"
+        log_event(job_id, carteirinha_id, "ERROR", f"Worker Protocol Error: {err_msg}")
+        raise Exception(err_msg)
+
+def release_worker(url):
+    # Worker has room again: let the dispatch loop assign without waiting for the next poll
+    ROUTER.release(url)
+    WAKEUP.poke()
+
+@in_thread_session
+def call_server(url, job_id, carteirinha, carteirinha_id):
+    ok, error = False, None
+    try:
+        payload = build_payload(job_id, carteirinha, carteirinha_id)
+        # Log attempt
+        log_event(job_id, carteirinha_id, "INFO", f"Dispatching to {url}")
+        
+        with DISPATCHER_PHASE_SECONDS.time(phase="http_call"):
+            resp = requests.post(f"{url}/process_job", json=payload, timeout=WORKER_REQUEST_TIMEOUT)
+        data = decode_response(job_id, carteirinha_id, resp.status_code, resp.text, resp.json)
+        ok = handle_response(job_id, carteirinha_id, data, full_resync=payload["watermark"]["full_resync"], watermark=payload["watermark"])
+        error = None if ok else data.get("message")
+        
+    except Exception as e:
+        logger.error(f"Error calling server {url}: {e}")
+        error = e
+        fail_job(job_id, carteirinha_id, e)
+        
+    finally:
+        ROUTER.record(url, ok, error)
+        release_worker(url)
+
+class StreamConsumer:
+    # Saves guias from a worker NDJSON stream in chunks while the scrape is still running.
+    # Lines: {"type": "guia", "data": {...}} ... then {"type": "done"} or {"type": "error"}.
+    def __init__(self, job_id, carteirinha_id, watermark=None):
+        self.job_id = job_id
+        self.carteirinha_id = carteirinha_id
+        self.watermark = watermark
+        self.full_resync = bool(watermark and watermark.get("full_resync"))
+        self.pending = []
+        self.checkpoint = None  # Progress up to the last buffered guia
+        self.inserted = 0
+        self.updated = 0
+        self.result = None
+
+    def add(self, line):
+        # Returns True when enough guias are buffered to flush
+        if not line:
+            return False
+        try:
+            event = json.loads(line)
+        except ValueError:
+            raise Exception(f"Invalid stream line: {line[:200]}")
+        if event.get("type") == "guia":
+            self.pending.append(event["data"])
+            self.checkpoint = event.get("checkpoint") or self.checkpoint
+            return len(self.pending) >= STREAM_FLUSH_SIZE
+        self.result = event
+        return False
+
+    def flush(self):
+        if not self.pending:
+            return
+        with thread_session() as thread_db:
+            inserted, updated = timed_upsert(thread_db, self.carteirinha_id, self.pending)
+            with LEASES_LOCK:
+                attempts = ACTIVE_LEASES.get(self.job_id)
+            if self.checkpoint and attempts is not None:
+                # Same transaction as the guias it covers; only while the attempt still owns the job
+                thread_db.query(Job).filter(Job.id == self.job_id, Job.status == "processing", Job.attempts == attempts).update(
+                    {Job.checkpoint: checkpoint_value(self.checkpoint, self.watermark)}, synchronize_session=False
+                )
+            thread_db.commit()
+        self.inserted += inserted
+        self.updated += updated
+        self.pending = []
+
+    def finish(self):
+        # Settle the job: what is still buffered is saved with the final status.
+        # Returns True when the job ended in success.
+        if self.result and self.result.get("type") == "done":
+            data = {"status": "success", "data": self.pending, "seen_unchanged": self.result.get("seen_unchanged")}
+            return handle_response(self.job_id, self.carteirinha_id, data, full_resync=self.full_resync, streamed=(self.inserted, self.updated))
+        # Guias scraped before the failure are kept; the job is retried
+        self.flush()
+        message = self.result.get("message") if self.result else "Stream ended without a result"
+        return handle_response(self.job_id, self.carteirinha_id, {"status": "error", "message": message})
+
+    def abort(self, error):
+        # Connection lost mid-stream: keep the guias (and checkpoint) that did arrive
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Error saving streamed guias of Job {self.job_id}: {e}")
+        fail_job(self.job_id, self.carteirinha_id, error)
+
+@in_thread_session
+def call_server_stream(url, job_id, carteirinha, carteirinha_id):
+    consumer = None
+    ok, error = False, None
+    try:
+        payload = build_payload(job_id, carteirinha, carteirinha_id)
+        log_event(job_id, carteirinha_id, "INFO", f"Dispatching to {url} (stream)")
+        consumer = StreamConsumer(job_id, carteirinha_id, watermark=payload["watermark"])
+
+        # Read timeout applies between lines, not to the whole scrape.
+        # http_stream covers the whole stream, chunk upserts included.
+        with DISPATCHER_PHASE_SECONDS.time(phase="http_stream"), \
+                requests.post(f"{url}/process_job_stream", json=payload, stream=True, timeout=(10, WORKER_REQUEST_TIMEOUT)) as resp:
+            if resp.status_code != 200:
+                data = decode_response(job_id, carteirinha_id, resp.status_code, resp.text, resp.json)
+                error = data.get("message") or data.get("detail")
+                handle_response(job_id, carteirinha_id, data)
+                return
+            for line in resp.iter_lines(decode_unicode=True):
+                if consumer.add(line):
+                    consumer.flush()
+        ok = consumer.finish()
+        error = None if ok else (consumer.result or {}).get("message")
+
+    except Exception as e:
+        logger.error(f"Error calling server {url} (stream): {e}")
+        error = e
+        if consumer:
+            consumer.abort(e)
+        else:
+            fail_job(job_id, carteirinha_id, e)
+
+    finally:
+        ROUTER.record(url, ok, error)
+        release_worker(url)
+
+def handle_batch_response(jobs, payloads, data):
+    # Settle every job of a batch individually from the worker's per-job results.
+    # Returns one success flag per job, in order.
+    results = {result.get("job_id"): result for result in data.get("results") or []}
+    batch_error = data.get("message") or data.get("detail") or "Job missing from batch response"
+    outcomes = []
+    for job in jobs:
+        job_id, carteirinha_id = job["job_id"], job["carteirinha_id"]
+        result = results.get(job_id)
+        if result is None:
+            fail_job(job_id, carteirinha_id, batch_error)
+            outcomes.append(False)
+            continue
+        try:
+            outcomes.append(handle_response(job_id, carteirinha_id, result, full_resync=payloads[job_id]["watermark"]["full_resync"], watermark=payloads[job_id]["watermark"]))
+        except Exception as e:
+            logger.error(f"Error settling Job {job_id}: {e}")
+            fail_job(job_id, carteirinha_id, e)
+            outcomes.append(False)
+    return outcomes
+
+@in_thread_session
+def call_server_batch(url, jobs):
+    outcomes, error = [False] * len(jobs), None
+    try:
+        payloads = {job["job_id"]: build_payload(job["job_id"], job["carteirinha"], job["carteirinha_id"]) for job in jobs}
+        for job in jobs:
+            log_event(job["job_id"], job["carteirinha_id"], "INFO", f"Dispatching to {url} (batch of {len(jobs)})")
+        
+        with DISPATCHER_PHASE_SECONDS.time(phase="http_call"):
+            resp = requests.post(f"{url}/process_batch", json={"jobs": list(payloads.values())}, timeout=WORKER_REQUEST_TIMEOUT * len(jobs))
+        data = decode_response(jobs[0]["job_id"], jobs[0]["carteirinha_id"], resp.status_code, resp.text, resp.json)
+        outcomes = handle_batch_response(jobs, payloads, data)
+        
+    except Exception as e:
+        logger.error(f"Error calling server {url} (batch): {e}")
+        error = e
+        for job in jobs:
+            fail_job(job["job_id"], job["carteirinha_id"], e)
+        
+    finally:
+        for ok in outcomes:
+            ROUTER.record(url, ok, error)
+        release_worker(url)
+
+class StatusHandler(BaseHTTPRequestHandler):
+    # GET /routing: the router's view of every worker (capacity, expected time, backoff) and the DB pool
+    # GET /metrics: dispatcher phase histograms and jobs by outcome (Prometheus text)
+    def do_GET(self):
+        if self.path.rstrip("/") == "/routing":
+            body = json.dumps({"workers": ROUTER.table(), "db_pool": pool_stats()}, default=str).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+        elif self.path.rstrip("/") == "/metrics":
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", metrics.CONTENT_TYPE)
+        else:
+            body = b"Not found"
+            self.send_response(404)
+            self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_background():
+    # Worker health polling, lease heartbeats/reaper, job notifications and the
+    # status listener, shared by both dispatch modes
+    threading.Thread(target=ROUTER.poll_forever, daemon=True).start()
+    threading.Thread(target=lease_keeper, daemon=True).start()
+    if DISPATCH_LISTEN:
+        WAKEUP.start()
+    if STATUS_PORT:
+        server = ThreadingHTTPServer(("0.0.0.0", STATUS_PORT), StatusHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Dispatcher status on port {STATUS_PORT} (/routing, /metrics)")
 
 def dispatch():
     logger.info("Starting Dispatcher...")
+    start_background()
     while True:
         try:
-            db = SessionLocal()
-            
-            # 1. Check available servers
-            available_servers = [url for url, meta in SERVER_STATUS.items() if meta["status"] == "idle"]
-            
-            if not available_servers:
-                logger.info("No servers available. Waiting...")
-            else:
-                for server_url in available_servers:
-                    # Get Job
-                    job = get_pending_job(db)
-                    if not job:
+            # Signals from here on wake the wait at the end of this pass
+            WAKEUP.clear()
+            with thread_session() as db:
+                # 1. Pick workers by expected completion time until none has room
+                while True:
+                    server_url = ROUTER.choose()
+                    if not server_url:
+                        logger.info("No servers available. Waiting...")
+                        break
+
+                    # Claim Job(s) (atomic: select + lock + mark processing)
+                    ROUTER.start(server_url)
+                    try:
+                        claimed = claim_jobs(db, server_url, limit=BATCH_SIZE)
+                    except Exception:
+                        ROUTER.release(server_url)
+                        raise
+                    if not claimed:
+                        ROUTER.release(server_url)
                         logger.info("No pending jobs.")
                         break
-                    
-                    logger.info(f"Assigning Job {job.id} to {server_url}")
-                    
-                    # Lock Job
-                    job.status = "processing"
-                    job.locked_by = server_url
-                    job.attempts += 1
-                    job.updated_at = datetime.utcnow()
-                    db.commit()
-                    
-                    # Update Local Server Status (Mocking async dispatch for now)
-                    SERVER_STATUS[server_url]["status"] = "busy"
-                    SERVER_STATUS[server_url]["last_job"] = job.id
-                    
-                    # Call Server (Blocking for simplicity in this MVP, but ideally async)
-                    # To respect "Avoid concurrency immediate", maybe we sleep here?
-                    # But if we block, we effectively limit throughput.
-                    # The requirement says "independent servers" running script.
-                    # We can use threading to make the request non-blocking.
-                    
-                    import threading
-                    def call_server(url, job_id, carteirinha, carteirinha_id):
-                        try:
-                            payload = {
-                                "job_id": job_id,
-                                "carteirinha_id": carteirinha_id,
-                                "carteirinha": carteirinha,
-                                "paciente": "" 
-                            }
-                            # Log attempt
-                            try:
-                                temp_log_session = SessionLocal()
-                                temp_log_session.add(Log(job_id=job_id, carteirinha_id=carteirinha_id, level="INFO", message=f"Dispatching to {url}"))
-                                temp_log_session.commit()
-                                temp_log_session.close()
-                            except: pass
-
-                            
-                            resp = requests.post(f"{url}/process_job", json=payload, timeout=300)
-                            
-                            try:
-                                data = resp.json()
-                            except ValueError: 
-                                # JSONDecodeError
-                                err_msg = f"Invalid JSON ({resp.status_code}): {resp.text[:200]}"
-                                thread_db.add(Log(job_id=job_id, carteirinha_id=carteirinha_id, level="ERROR", message=f"Worker Protocol Error: {err_msg}"))
-                                thread_db.commit()
-                                raise Exception(err_msg)
-
-                            # New DB Session for thread
-                            thread_db = SessionLocal()
-                            current_job = thread_db.query(Job).filter(Job.id == job_id).first()
-                            
-                            if data.get("status") == "success":
-                                current_job.status = "success"
-                                results = data.get("data", [])
-                                # Save results to BaseGuia
-                                try:
-                                    count_inserted = 0
-                                    count_updated = 0
-                                    
-                                    def parse_date(date_str):
-                                        if not date_str or not isinstance(date_str, str):
-                                            return None
-                                        try:
-                                            return datetime.strptime(date_str.strip(), "%d/%m/%Y").date()
-                                        except:
-                                            return None
-
-                                    logger.info(f"Processing {len(results)} items from worker response.")
-                                    for item in results:
-                                        logger.info(f"Processing item: {item}")
-                                        # Map scraper keys to BaseGuia columns
-                                        # Conversion helpers
-                                        try:
-                                            qtd_solic_val = int(item.get("qtde_solicitada"))
-                                        except:
-                                            qtd_solic_val = 0
-                                            
-                                        try:
-                                            qtd_aut_val = int(item.get("qtde_autorizada"))
-                                        except:
-                                            qtd_aut_val = 0
-                                            
-                                        guia_num = item.get("numero_guia")
-                                        
-                                        data_auth_parsed = parse_date(item.get("data_autorizacao"))
-                                        validade_parsed = parse_date(item.get("validade_senha"))
-                                        
-                                        logger.info(f"Parsed values - Guia: {guia_num}, DatAuth: {data_auth_parsed}, Val: {validade_parsed}, QtdSol: {qtd_solic_val}, QtdAut: {qtd_aut_val}")
-                                        
-                                        # UPSERT Logic: Check if exists
-                                        logger.info("Checking if guia exists in DB...")
-                                        try:
-                                            existing_guia = thread_db.query(BaseGuia).filter(
-                                                BaseGuia.carteirinha_id == carteirinha_id,
-                                                BaseGuia.guia == guia_num
-                                            ).first()
-                                            logger.info(f"DB Query result: {existing_guia}")
-                                        except Exception as db_q_err:
-                                            logger.error(f"DB Query Failed: {db_q_err}")
-                                            raise db_q_err
-                                        
-                                        if existing_guia:
-                                            # Update
-                                            logger.info("Updating existing guia...")
-                                            existing_guia.data_autorizacao = data_auth_parsed
-                                            existing_guia.senha = item.get("senha")
-                                            existing_guia.validade = validade_parsed
-                                            existing_guia.codigo_terapia = item.get("codigo_terapia")
-                                            existing_guia.qtde_solicitada = qtd_solic_val
-                                            existing_guia.sessoes_autorizadas = qtd_aut_val
-                                            existing_guia.updated_at = datetime.utcnow()
-                                            count_updated += 1
-                                        else:
-                                            # Insert
-                                            logger.info(f"Inserting new guia: {guia_num}")
-                                            try:
-                                                new_guia = BaseGuia(
-                                                    carteirinha_id=carteirinha_id,
-                                                    guia=guia_num,
-                                                    data_autorizacao=data_auth_parsed,
-                                                    senha=item.get("senha"),
-                                                    validade=validade_parsed,
-                                                    codigo_terapia=item.get("codigo_terapia"),
-                                                    qtde_solicitada=qtd_solic_val,
-                                                    sessoes_autorizadas=qtd_aut_val,
-                                                    created_at=datetime.utcnow()
-                                                )
-                                                logger.info("BaseGuia object created successfully")
-                                                thread_db.add(new_guia)
-                                                logger.info("Added to session, incrementing count")
-                                                count_inserted += 1
-                                            except Exception as insert_err:
-                                                logger.error(f"Failed to create/add BaseGuia: {insert_err}")
-                                                raise insert_err
-                                    
-                                    # Explicit Commit Log
-                                    logger.info("Committing changes to DB...")
-                                    thread_db.commit()
-                                    logger.info("Commit successful.")
-                                    
-                                    # Create fresh session for final log
-                                    log_session = SessionLocal()
-                                    log_session.add(Log(job_id=job_id, carteirinha_id=carteirinha_id, level="INFO", message=f"Sync complete. Inserted: {count_inserted}, Updated: {count_updated}"))
-                                    log_session.commit()
-                                    log_session.close()
-                                except Exception as save_e:
-                                    logger.error(f"Exception during save: {save_e}")
-                                    # Create fresh session for error log
-                                    err_log_session = SessionLocal()
-                                    err_log_session.add(Log(job_id=job_id, carteirinha_id=carteirinha_id, level="ERROR", message=f"Error saving results: {save_e}"))
-                                    err_log_session.commit()
-                                    err_log_session.close()
-                                    current_job.status = "error"
-                            else:
-                                current_job.status = "error"
-                                # Log error from server
-                                err_msg = data.get("message") or data.get("detail") or "Unknown error from server"
-                                thread_db.add(Log(job_id=job_id, carteirinha_id=carteirinha_id, level="ERROR", message=f"Worker Error: {err_msg}"))
-                            
-                            current_job.locked_by = None
-                            current_job.updated_at = datetime.utcnow()
-                            thread_db.commit()
-                            thread_db.close()
-                            
-                        except Exception as e:
-                            logger.error(f"Error calling server {url}: {e}")
-                            thread_db = SessionLocal()
-                            current_job = thread_db.query(Job).filter(Job.id == job_id).first()
-                            if current_job:
-                                current_job.status = "error"
-                                current_job.locked_by = None
-                                current_job.updated_at = datetime.utcnow()
-                            
-                                # Log dispatcher error
-                                try:
-                                    thread_db.add(Log(job_id=job_id, carteirinha_id=carteirinha_id, level="ERROR", message=f"Dispatcher Failed: {str(e)}"))
-                                except: pass
-                                
-                                thread_db.commit()
-                            thread_db.close()
-                            
-                        finally:
-                            SERVER_STATUS[url]["status"] = "idle"
-
-                    # Fetch carteirinha
-                    cart_obj = job.carteirinha_rel
-                    t = threading.Thread(target=call_server, args=(server_url, job.id, cart_obj.carteirinha, cart_obj.id))
+                    job = claimed[0]
+
+                    logger.info(f"Assigning Job(s) {[c['job_id'] for c in claimed]} to {server_url}")
+
+                    # Call Server in a thread so the loop keeps assigning.
+                    # See async_dispatcher.py for the pooled, event-driven mode.
+                    if len(claimed) > 1:
+                        t = threading.Thread(target=call_server_batch, args=(server_url, claimed))
+                    elif STREAM_RESULTS:
+                        t = threading.Thread(target=call_server_stream, args=(server_url, job["job_id"], job["carteirinha"], job["carteirinha_id"]))
+                    else:
+                        t = threading.Thread(target=call_server, args=(server_url, job["job_id"], job["carteirinha"], job["carteirinha_id"]))
                     t.start()
-                    
+
                     # Stagger
-                    time.sleep(DISPATCH_STAGGER) 
-            
-            db.close()
-            time.sleep(DISPATCH_STAGGER)
+                    time.sleep(DISPATCH_STAGGER)
+
+                timeout = idle_wait(db)
+                db.commit()
+
+            # Until a job is enqueued, a retry comes due or a worker frees up
+            WAKEUP.wait(timeout, DISPATCH_STAGGER)
             
         except Exception as e:
             logger.error(f"Dispatcher Loop Error: {e}")
             time.sleep(15)
 
 if __name__ == "__main__":
-    dispatch()
+    if DISPATCH_MODE == "async":
+        from async_dispatcher import dispatch_async
+        dispatch_async()
+    else:
+        dispatch()
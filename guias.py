@@ -0,0 +1,74 @@
+"""
+Bulk persistence of scraped guias into base_guias
+One INSERT ... ON CONFLICT DO UPDATE per job instead of a SELECT + ORM write per item
+"""
+from datetime import datetime
+from sqlalchemy import func, literal_column
+from sqlalchemy.dialects.postgresql import insert
+
+from models import BaseGuia
+
+
+def parse_date(date_str):
+    if not date_str or not isinstance(date_str, str):
+        return None
+    try:
+        return datetime.strptime(date_str.strip(), "%d/%m/%Y").date()
+    except ValueError:
+        return None
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def build_guia_rows(carteirinha_id, items):
+    # Parse every scraped item once and map scraper keys to BaseGuia columns.
+    # Keyed by guia number: ON CONFLICT cannot touch the same row twice in one
+    # statement, so a repeated guia keeps the last scraped version.
+    rows = {}
+    for item in items:
+        guia_num = item.get("numero_guia")
+        rows[guia_num] = {
+            "carteirinha_id": carteirinha_id,
+            "guia": guia_num,
+            "data_autorizacao": parse_date(item.get("data_autorizacao")),
+            "senha": item.get("senha"),
+            "validade": parse_date(item.get("validade_senha")),
+            "codigo_terapia": item.get("codigo_terapia"),
+            "qtde_solicitada": parse_int(item.get("qtde_solicitada")),
+            "sessoes_autorizadas": parse_int(item.get("qtde_autorizada")),
+            "list_fingerprint": item.get("list_fingerprint"),
+        }
+    return list(rows.values())
+
+
+def upsert_guias(db, carteirinha_id, items):
+    # Returns (inserted, updated). Caller owns the transaction (commit/rollback).
+    rows = build_guia_rows(carteirinha_id, items)
+    if not rows:
+        return 0, 0
+
+    stmt = insert(BaseGuia).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_base_guias_carteirinha_guia",
+        set_={
+            "data_autorizacao": stmt.excluded.data_autorizacao,
+            "senha": stmt.excluded.senha,
+            "validade": stmt.excluded.validade,
+            "codigo_terapia": stmt.excluded.codigo_terapia,
+            "qtde_solicitada": stmt.excluded.qtde_solicitada,
+            "sessoes_autorizadas": stmt.excluded.sessoes_autorizadas,
+            "list_fingerprint": func.coalesce(stmt.excluded.list_fingerprint, BaseGuia.list_fingerprint),
+            "updated_at": func.now(),
+        },
+    ).returning(literal_column("(xmax = 0)").label("inserted"))
+
+    # xmax = 0 only for freshly inserted tuples; conflict-updated rows carry the updater's xid.
+    # Not timed here: callers (dispatcher, worker) label it with their own metrics.
+    flags = db.execute(stmt).scalars().all()
+    inserted = sum(1 for flag in flags if flag)
+    return inserted, len(flags) - inserted
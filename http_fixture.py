@@ -0,0 +1,179 @@
+"""
+Local stand-in server for the browserless engine (http_scraper.py)
+Serves the pages of recorded scraper runs (SCRAPER_RECORD_DIR, see snapshots.py)
+over plain HTTP at the paths the recorded links point to, and runs
+HttpUnimedScraper.iter_carteirinha_http against it with a stub driver: no
+Chrome, no login, no portal. The first listing page comes from the stub driver
+as it would from the browser; pagination and detail pages are fetched from the
+server and parsed with lxml. Each run's guias are checked against the ones
+recorded live, and a parse failure (the case that falls back to Selenium in
+production) is reported as a failure.
+
+    python http_fixture.py recordings/
+"""
+import os
+import sys
+import json
+import argparse
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin, urlsplit
+
+import requests
+
+from http_scraper import HttpUnimedScraper, HttpParseError, parse_document, parse_result_rows, next_page_href
+from snapshot_replay import differences
+from waits import PageWaiter
+
+
+def route(url):
+    # Path and query: what the handler sees, whatever the recorded origin was
+    parts = urlsplit(url)
+    return parts.path + (f"?{parts.query}" if parts.query else "")
+
+
+def recording_routes(directory, manifest):
+    # {route: file} for every page iter_carteirinha_http fetches: the detail page of each
+    # recorded row (by its link) and every listing page after the first (by "Próxima")
+    listings = [entry for entry in manifest["pages"] if entry["kind"] == "listing"]
+    details = {(entry["page"], entry["row"]): entry["file"] for entry in manifest["pages"] if entry["kind"] == "detail"}
+    routes = {}
+    for i, entry in enumerate(listings):
+        with open(os.path.join(directory, entry["file"]), "rb") as f:
+            doc = parse_document(f.read(), entry["url"])
+        for row in parse_result_rows(doc):
+            if row["href"] and (entry["page"], row["index"]) in details:
+                routes[route(urljoin(entry["url"], row["href"]))] = details[(entry["page"], row["index"])]
+        href = next_page_href(doc)
+        if href and i + 1 < len(listings):
+            routes[route(urljoin(entry["url"], href))] = listings[i + 1]["file"]
+    return routes
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    # server.directory / server.routes are set by serve()
+    def do_GET(self):
+        name = self.server.routes.get(self.path)
+        if not name:
+            self.send_error(404, "Not a recorded page")
+            return
+        with open(os.path.join(self.server.directory, name), "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory, manifest):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RecordingHandler)
+    server.directory = directory
+    server.routes = recording_routes(directory, manifest)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StubDriver:
+    # What iter_carteirinha_http asks of the browser once the results are open:
+    # the first listing page (source and URL), cookies and the user agent
+    def __init__(self, page_source, current_url):
+        self.page_source = page_source
+        self.current_url = current_url
+        self.window_handles = ["stub"]
+
+    def get_cookies(self):
+        return []
+
+    def execute_script(self, script, *args):
+        if "navigator.userAgent" in script:
+            return "http-fixture"
+        raise NotImplementedError(f"Script not supported by the stub driver: {script.strip()[:80]}")
+
+    def quit(self):
+        pass
+
+
+def fixture_scraper(driver):
+    # HttpUnimedScraper with the browser steps stubbed out: no DB writes, no log output
+    os.environ.setdefault("SCRAPER_LOG_MODE", "print")
+    scraper = HttpUnimedScraper()
+    scraper.log = lambda *args, **kwargs: None
+    scraper.recorder = None
+    scraper.driver = driver
+    scraper.waits = PageWaiter(driver)
+    scraper.open_results = lambda *args, **kwargs: True
+    scraper.close_popup = lambda: None
+    return scraper
+
+
+def run_recording(directory, manifest):
+    # Returns (guias, error): error is the exception that stopped the HTTP engine, if any
+    server = serve(directory, manifest)
+    try:
+        first = next(entry for entry in manifest["pages"] if entry["kind"] == "listing")
+        with open(os.path.join(directory, first["file"]), encoding="utf-8") as f:
+            source = f.read()
+        local_url = f"http://127.0.0.1:{server.server_address[1]}{route(first['url'])}"
+        scraper = fixture_scraper(StubDriver(source, local_url))
+        context = manifest["context"]
+        cutoff = datetime.datetime.strptime(context["cutoff_date"], "%d/%m/%Y").date()
+        scraper.cutoff_date = lambda: cutoff  # Decide as on the recording day
+        results = []
+        try:
+            for guia_data in scraper.iter_carteirinha_http("recording", watermark=context.get("watermark"), checkpoint=context.get("checkpoint")):
+                results.append(guia_data)
+        except (HttpParseError, requests.RequestException) as e:
+            return results, e
+        return results, None
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def load_manifests(root):
+    # [(directory, manifest)] of recordings with a listing page
+    found = []
+    for directory, _, files in sorted(os.walk(root)):
+        if "manifest.json" not in files:
+            continue
+        with open(os.path.join(directory, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        if any(entry["kind"] == "listing" and entry["url"] for entry in manifest["pages"]):
+            found.append((directory, manifest))
+    return found
+
+
+def run(args):
+    recordings = load_manifests(args.root)
+    if not recordings:
+        sys.exit(f"No recordings (manifest.json with a listing page) under {args.root}")
+    failures = {}
+    for directory, manifest in recordings:
+        results, error = run_recording(directory, manifest)
+        if error is not None:
+            failures[directory] = [f"HTTP engine failed: {type(error).__name__}: {error}"]
+        elif not manifest.get("error"):
+            # Runs that failed live are only checked for parse failures
+            diffs = differences(manifest["results"], results)
+            if diffs:
+                failures[directory] = diffs
+    return {"recordings": len(recordings), "failures": failures}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the HTTP engine against recorded portal pages")
+    parser.add_argument("root", help="Directory with recordings (SCRAPER_RECORD_DIR)")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(f"{report['recordings']} recordings, {len(report['failures'])} failed")
+    for directory, problems in report["failures"].items():
+        print(f"FAILED {directory}:")
+        for problem in problems[:20]:
+            print(f"  {problem}")
+    sys.exit(1 if report["failures"] else 0)
@@ -0,0 +1,206 @@
+"""
+Browserless scraping engine
+Chrome is only used to log in and submit the carteirinha form; the listing,
+pagination and detail pages are then fetched over plain HTTP with the driver's
+session cookies and parsed with lxml. Any parse failure falls back to the
+Selenium path for that carteirinha.
+"""
+import os
+import functools
+from urllib.parse import urljoin
+
+import requests
+import lxml.etree
+import lxml.html
+
+from ImportBaseGuias import UnimedScraper, RESULTS_TABLE_XPATH, DETAIL_XPATHS, fetchable, row_fingerprint
+from metrics import SCRAPER_PHASE_SECONDS
+
+HTTP_TIMEOUT = float(os.environ.get("SCRAPER_HTTP_TIMEOUT", 30))
+
+
+class HttpParseError(Exception):
+    pass
+
+
+def parser(func):
+    # Any failure on unexpected markup (empty or garbled body, missing nodes) is an
+    # HttpParseError, so the carteirinha falls back to Selenium instead of failing the job
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except HttpParseError:
+            raise
+        except (lxml.etree.LxmlError, ValueError, KeyError, TypeError, AttributeError, IndexError) as e:
+            raise HttpParseError(f"{func.__name__}: {type(e).__name__}: {e}") from e
+    return wrapper
+
+
+def _text(node):
+    # Rough equivalent of WebElement.text: collapsed whitespace
+    if node is None:
+        return None
+    return " ".join(node.text_content().split())
+
+
+def _first(doc, path):
+    found = doc.xpath(path)
+    return found[0] if found else None
+
+
+def _ensure_tbody(doc):
+    # Browsers insert <tbody> into tables that lack one, and the XPaths rely on
+    # it; lxml keeps the raw markup, so add it the same way.
+    for table in doc.iter("table"):
+        rows = [child for child in table if child.tag == "tr"]
+        if rows:
+            tbody = lxml.html.Element("tbody")
+            table.insert(table.index(rows[0]), tbody)
+            for row in rows:
+                tbody.append(row)
+    return doc
+
+
+@parser
+def parse_document(content, url):
+    doc = lxml.html.fromstring(content, base_url=url)
+    return _ensure_tbody(doc)
+
+
+@parser
+def parse_result_rows(doc):
+    # Same dict shape as UnimedScraper.read_result_rows
+    table = _first(doc, RESULTS_TABLE_XPATH)
+    if table is None:
+        raise HttpParseError("Results table not found")
+
+    total = len(table.xpath(".//tr"))
+    rows = []
+    for idx in range(1, total - 1):
+        row = _first(table, f"tbody/tr[{idx+1}]")
+        if row is None:
+            continue
+        status = _first(row, "td[6]/span")
+        if status is None:
+            continue
+        link = _first(row, "td[4]/a")
+        rows.append({
+            "index": idx,
+            "status": _text(status),
+            "date": _text(_first(row, "td[1]")) or "",
+            "guia": _text(link),
+            "href": link.get("href") if link is not None else None,
+            "fingerprint": row_fingerprint(" ".join(_text(cell) or "" for cell in row.xpath("td"))),
+        })
+    return rows
+
+
+@parser
+def parse_detail(doc):
+    if _first(doc, '//*[@id="Button_Voltar"]') is None:
+        raise HttpParseError("Detail view not found")
+
+    fields = {}
+    for name, path in DETAIL_XPATHS.items():
+        node = _first(doc, path)
+        if node is None:
+            raise HttpParseError(f"Detail field not found: {name}")
+        fields[name] = node.get("value") if name == "codigo_terapia" else _text(node)
+    fields["status"] = "Autorizado"
+    return fields
+
+
+@parser
+def next_page_href(doc):
+    link = _first(doc, '//a[normalize-space(.)="Próxima"]')
+    if link is None:
+        return None
+    href = link.get("href")
+    if not fetchable(href):
+        raise HttpParseError(f"Pagination link is not a plain URL: {href}")
+    return href
+
+
+class HttpUnimedScraper(UnimedScraper):
+    def __init__(self, db=None):
+        super().__init__(db)
+        self.http = requests.Session()
+
+    def sync_session(self):
+        # Borrow the logged-in browser session for plain HTTP requests
+        self.http.cookies.clear()
+        for cookie in self.driver.get_cookies():
+            self.http.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain"), path=cookie.get("path", "/"))
+        self.http.headers["User-Agent"] = self.driver.execute_script("return navigator.userAgent")
+
+    def fetch(self, url, referer):
+        resp = self.http.get(url, headers={"Referer": referer}, timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+        return parse_document(resp.content, resp.url), resp.url
+
+    def iter_carteirinha(self, carteirinha, job_id=None, carteirinha_db_id=None, watermark=None, keep_popup=False, checkpoint=None):
+        yielded = set()
+        try:
+            for guia_data in self.iter_carteirinha_http(carteirinha, job_id=job_id, carteirinha_db_id=carteirinha_db_id, watermark=watermark, keep_popup=keep_popup, checkpoint=checkpoint):
+                yielded.add(guia_data["numero_guia"])
+                yield guia_data
+        except (HttpParseError, requests.RequestException) as e:
+            self.log(f"HTTP engine failed ({e}). Falling back to Selenium.", level="WARNING", job_id=job_id, carteirinha_id=carteirinha_db_id)
+            self.close_popup()
+            # Guias already delivered by the HTTP pass are not repeated; resume where it stopped
+            resume = self.progress
+            for guia_data in super().iter_carteirinha(carteirinha, job_id=job_id, carteirinha_db_id=carteirinha_db_id, watermark=watermark, keep_popup=keep_popup, checkpoint=resume):
+                if guia_data["numero_guia"] not in yielded:
+                    yield guia_data
+
+    def iter_carteirinha_http(self, carteirinha, job_id=None, carteirinha_db_id=None, watermark=None, keep_popup=False, checkpoint=None):
+        self.log(f"Processing carteirinha (http): {carteirinha}", job_id=job_id, carteirinha_id=carteirinha_db_id)
+        self.waits.reset()
+        watermark = self.prepare_watermark(watermark)
+        self.seen_unchanged = []
+        self.progress = dict(checkpoint) if checkpoint else None
+
+        if not self.open_results(carteirinha, job_id=job_id, carteirinha_db_id=carteirinha_db_id, reuse_popup=keep_popup):
+            return
+
+        # First listing page comes from the browser (form submit + sort clicks)
+        self.sync_session()
+        page_url = self.driver.current_url
+        doc = parse_document(self.driver.page_source, page_url)
+
+        page = 1
+        while True:
+            with SCRAPER_PHASE_SECONDS.time(phase="list_read"):
+                rows = parse_result_rows(doc)
+            self.log(f"Found {len(rows)} rows on page.", job_id=job_id, carteirinha_id=carteirinha_db_id)
+
+            targets, stop = self.select_targets(rows, watermark, job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+            targets = self.resume_targets(rows, targets, page, checkpoint, job_id=job_id, carteirinha_db_id=carteirinha_db_id)
+            for row in targets:
+                if not fetchable(row["href"]):
+                    raise HttpParseError(f"Guia link is not a plain URL: {row['href']}")
+
+                with SCRAPER_PHASE_SECONDS.time(phase="detail"):
+                    detail_doc, _ = self.fetch(urljoin(page_url, row["href"]), page_url)
+                    guia_data = parse_detail(detail_doc)
+                guia_data["list_fingerprint"] = row["fingerprint"]
+                self.log(f"Scraped Guia {guia_data['numero_guia']}", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                self.track_progress(guia_data, page)
+                yield guia_data
+
+            if stop:
+                break
+
+            href = next_page_href(doc)
+            if not href:
+                self.log("No more pages.", job_id=job_id, carteirinha_id=carteirinha_db_id)
+                break
+            self.log("Navigating to next page...", job_id=job_id, carteirinha_id=carteirinha_db_id)
+            with SCRAPER_PHASE_SECONDS.time(phase="pagination"):
+                doc, page_url = self.fetch(urljoin(page_url, href), page_url)
+            page += 1
+
+        # Browser never left the first listing page, so the popup can be reused as is
+        if not keep_popup:
+            self.close_popup()
@@ -0,0 +1,106 @@
+"""
+Push-based dispatcher wakeup
+A dedicated Postgres connection LISTENs on the channel the jobs trigger
+(migrations/007_jobs_notify.sql, 009) NOTIFYs on, so the dispatcher claims a
+new job as soon as it is inserted or requeued as pending. Retries in backoff
+are not notified: the dispatcher times its wait to the next one coming due.
+Polling stays as a slow fallback, and as the only mechanism while the listener
+is disconnected.
+
+Run directly to print notifications (check the trigger against a local Postgres):
+    python job_wakeup.py
+"""
+import os
+import select
+import threading
+import time
+import logging
+
+import psycopg2
+
+from database import SQLALCHEMY_DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "jobs_ready"
+# LISTEN needs a session connection: point this at the direct (non-pgbouncer) port when the main URL is pooled
+LISTEN_DATABASE_URL = os.environ.get("LISTEN_DATABASE_URL", SQLALCHEMY_DATABASE_URL)
+RECONNECT_SECONDS = float(os.environ.get("LISTEN_RECONNECT_SECONDS", 10))
+
+
+class JobWakeup:
+    def __init__(self, dsn=LISTEN_DATABASE_URL, channel=CHANNEL):
+        self.dsn = dsn
+        self.channel = channel
+        self.connected = False
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add_callback(self, callback):
+        # Called (from the listener thread) on every wakeup, e.g. to set an asyncio.Event
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def poke(self):
+        # Local wakeup: a worker slot freed up, a job was requeued by this process, ...
+        self._event.set()
+        with self._lock:
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Wakeup callback failed: {e}")
+
+    def clear(self):
+        # Call before looking at the queue: a signal that arrives while the queue is being
+        # read stays set, and the next wait() returns at once instead of sleeping through it
+        self._event.clear()
+
+    def wait(self, timeout, fallback_timeout):
+        # Block until a notification or `timeout`; `fallback_timeout` while not listening.
+        # Returns True when woken by a notification/poke. Does not clear (see clear()).
+        return self._event.wait(timeout if self.connected else fallback_timeout)
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel};")
+                self.connected = True
+                logger.info(f"Listening on '{self.channel}' for new jobs")
+                # Catch up on anything that changed while we were not listening
+                self.poke()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        self.poke()
+            except Exception as e:
+                logger.error(f"Job listener error: {e}. Reconnecting in {RECONNECT_SECONDS:.0f}s")
+            finally:
+                self.connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(RECONNECT_SECONDS)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    wakeup = JobWakeup()
+    wakeup.add_callback(lambda: logger.info("Wakeup"))
+    wakeup.start()
+    while True:
+        time.sleep(1)
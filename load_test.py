@@ -0,0 +1,518 @@
+"""
+Synthetic load test for the dispatcher and job pipeline
+Seeds carteirinhas/jobs in a local Postgres, starts N fake workers (/health,
+/process_job, /process_batch with configurable latency, error rate and result
+size) and runs the real dispatcher against them until the queue drains.
+Reports dispatch throughput, enqueue-to-start latency, and DB statements,
+connections and pool checkouts per job; --out saves the report and --compare
+checks it against a previous one, so dispatcher regressions show up before
+production.
+
+    python load_test.py --init-schema --jobs 100000 --workers 50 --slots 2 --latency-ms 200 --out after.json --compare before.json
+    python load_test.py --mode async --jobs 5000 --enqueue-rate 200 --error-rate 0.1
+
+Database settings come from the usual SUPABASE_* env vars (database.py) and
+must point at a local Postgres unless --allow-remote. Seeded rows use the
+LOADTEST- carteirinha prefix and are deleted at the start and end of a run.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import threading
+import statistics
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import create_engine, event, select, insert, delete, func, case, and_, or_
+
+from database import Base, SQLALCHEMY_DATABASE_URL, DB_HOST, engine as app_engine, pool_stats
+from models import Carteirinha, Job, Log
+
+PREFIX = "LOADTEST-"
+SEED_CHUNK = 5000
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Report metrics compared by --compare: name -> True when higher is better
+COMPARED = {
+    "throughput_jobs_per_second": True,
+    "enqueue_to_start_seconds.p50": False,
+    "enqueue_to_start_seconds.p95": False,
+    "statements_per_job": False,
+    "connections_per_job": False,
+    "checkouts_per_job": False,
+}
+
+
+# Fake workers
+
+class FakeWorker:
+    # Worker endpoints with the response shapes of server.py and no browser behind them
+    def __init__(self, index, args, receipts):
+        self.index = index
+        self.args = args
+        self.receipts = receipts
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handler(self):
+        worker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/health":
+                    return self.reply(404, {"detail": "Not found"})
+                self.reply(200, worker.health())
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                path = self.path.rstrip("/")
+                if path not in ("/process_job", "/process_batch"):
+                    return self.reply(404, {"detail": "Not found"})
+                jobs = (body.get("jobs") or []) if path == "/process_batch" else [body]
+                if not worker.checkout():
+                    return self.reply(503, {"detail": "No free scraper slot"})
+                try:
+                    results = [worker.run(job) for job in jobs]
+                finally:
+                    worker.checkin()
+                if path == "/process_batch":
+                    return self.reply(200, {"status": "success", "results": results})
+                self.reply(200, results[0])
+
+            def reply(self, status, data):
+                payload = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def health(self):
+        # Same fields as ScraperPool.health
+        with self.lock:
+            free = self.args.slots - self.busy
+        return {
+            "status": "ok",
+            "size": self.args.slots,
+            "free": free,
+            "waiting": 0,
+            "drivers_alive": self.args.slots,
+            "last_login_age_seconds": 60,
+            "median_job_seconds": self.args.latency_ms / 1000,
+            "jobs_sampled": 0,
+        }
+
+    def checkout(self):
+        # A full worker answers 503, as ScraperPool does on PoolTimeout
+        with self.lock:
+            if self.busy >= self.args.slots:
+                return False
+            self.busy += 1
+            return True
+
+    def checkin(self):
+        with self.lock:
+            self.busy -= 1
+
+    def run(self, job):
+        job_id, carteirinha_id = job.get("job_id"), job.get("carteirinha_id")
+        self.receipts.record(job_id)
+        latency = self.args.latency_ms / 1000
+        jitter = self.args.latency_jitter
+        time.sleep(max(0.0, latency * random.uniform(1 - jitter, 1 + jitter)))
+        if random.random() < self.args.error_rate:
+            return {"status": "error", "job_id": job_id, "message": "Simulated scraper failure", "carteirinha_id": carteirinha_id, "data": [], "checkpoint": None}
+        return {"status": "success", "job_id": job_id, "data": fake_guias(carteirinha_id, self.args.guias), "seen_unchanged": [], "carteirinha_id": carteirinha_id}
+
+
+def fake_guias(carteirinha_id, count):
+    # Stable guia numbers per carteirinha, so repeated jobs exercise the upsert's update path
+    today = datetime.date.today()
+    return [
+        {
+            "numero_guia": f"LT{carteirinha_id:08d}{i:04d}",
+            "data_autorizacao": (today - datetime.timedelta(days=i)).strftime("%d/%m/%Y"),
+            "senha": f"{carteirinha_id % 100000:05d}{i:03d}",
+            "validade_senha": (today + datetime.timedelta(days=60 - i)).strftime("%d/%m/%Y"),
+            "codigo_terapia": "50000470",
+            "qtde_solicitada": 10,
+            "qtde_autorizada": 10,
+            "list_fingerprint": f"{carteirinha_id:x}{i:x}",
+        }
+        for i in range(count)
+    ]
+
+
+class Receipts:
+    # First time each job reached a worker (epoch seconds), and total requests
+    def __init__(self):
+        self.first = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def record(self, job_id):
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            self.first.setdefault(job_id, now)
+
+
+# DB instrumentation: the dispatcher's engine only, the harness uses its own
+
+class DbCounters:
+    def __init__(self, engine):
+        self.statements = 0
+        self.connections = 0
+        self.checkouts = 0
+        self.lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", lambda *args: self.bump("statements"))
+        event.listen(engine.pool, "connect", lambda *args: self.bump("connections"))
+        event.listen(engine.pool, "checkout", lambda *args: self.bump("checkouts"))
+
+    def bump(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def reset(self):
+        with self.lock:
+            self.statements = self.connections = self.checkouts = 0
+
+
+# Seeding
+
+def loadtest_carteirinhas():
+    return select(Carteirinha.id).where(Carteirinha.carteirinha.like(f"{PREFIX}%"))
+
+
+def cleanup(db_engine):
+    with db_engine.begin() as conn:
+        ids = loadtest_carteirinhas()
+        conn.execute(delete(Log).where(or_(Log.carteirinha_id.in_(ids), Log.job_id.in_(select(Job.id).where(Job.carteirinha_id.in_(ids))))))
+        # jobs and base_guias cascade
+        conn.execute(delete(Carteirinha).where(Carteirinha.carteirinha.like(f"{PREFIX}%")))
+
+
+def init_schema(db_engine):
+    # Tables as the models define them, then the migrations' indexes and triggers.
+    # Migrations already covered by create_all (e.g. 001's constraint) are skipped.
+    Base.metadata.create_all(db_engine)
+    for name in sorted(os.listdir(MIGRATIONS_DIR)):
+        if not name.endswith(".sql"):
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+            sql = f.read()
+        try:
+            with db_engine.begin() as conn:
+                conn.exec_driver_sql(sql)
+        except Exception as e:
+            print(f"  migration {name} skipped: {str(e).splitlines()[0]}", file=sys.stderr)
+
+
+def seed_carteirinhas(db_engine, count):
+    with db_engine.begin() as conn:
+        for start in range(0, count, SEED_CHUNK):
+            rows = [{"carteirinha": f"{PREFIX}{i:07d}", "paciente": "Load Test", "status": "ativo"} for i in range(start, min(count, start + SEED_CHUNK))]
+            conn.execute(insert(Carteirinha), rows)
+        return [row.id for row in conn.execute(loadtest_carteirinhas().order_by(Carteirinha.id))]
+
+
+def enqueue(db_engine, carteirinha_ids, offset, count):
+    # Jobs round-robin over the seeded carteirinhas
+    with db_engine.begin() as conn:
+        for start in range(offset, offset + count, SEED_CHUNK):
+            rows = [
+                {"carteirinha_id": carteirinha_ids[i % len(carteirinha_ids)], "status": "pending", "attempts": 0, "priority": 0}
+                for i in range(start, min(offset + count, start + SEED_CHUNK))
+            ]
+            conn.execute(insert(Job), rows)
+
+
+def enqueue_at_rate(db_engine, carteirinha_ids, total, rate, state):
+    # Background producer: `rate` jobs/s in 100ms batches
+    enqueued, started = 0, time.monotonic()
+    while enqueued < total:
+        due = min(total, int((time.monotonic() - started) * rate))
+        if due > enqueued:
+            enqueue(db_engine, carteirinha_ids, enqueued, due - enqueued)
+            enqueued = due
+            state["enqueued"] = enqueued
+        time.sleep(0.1)
+
+
+def other_due_jobs(db_engine):
+    with db_engine.connect() as conn:
+        return conn.execute(
+            select(func.count()).select_from(Job).where(
+                Job.status.in_(("pending", "error")),
+                Job.next_run_at <= func.now(),
+                Job.carteirinha_id.not_in(loadtest_carteirinhas()),
+            )
+        ).scalar()
+
+
+def queue_counts(db_engine):
+    # Seeded jobs by status; "error" split into due and waiting for their retry time
+    status = case((and_(Job.status == "error", Job.next_run_at > func.now()), "retry_wait"), else_=Job.status)
+    with db_engine.connect() as conn:
+        rows = conn.execute(
+            select(status, func.count()).where(Job.carteirinha_id.in_(loadtest_carteirinhas())).group_by(status)
+        ).all()
+    return dict(rows)
+
+
+def coalesced_count(db_engine):
+    # Seeded jobs merged into another job, whatever status they settled in since
+    with db_engine.connect() as conn:
+        return conn.execute(
+            select(func.count()).select_from(Job).where(
+                Job.coalesced_into.is_not(None),
+                Job.carteirinha_id.in_(loadtest_carteirinhas()),
+            )
+        ).scalar()
+
+
+# Report
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        "p50": round(statistics.median(values), 3),
+        "p95": round(pick(0.95), 3),
+        "p99": round(pick(0.99), 3),
+        "max": round(values[-1], 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def lookup(report, dotted):
+    value = report
+    for key in dotted.split("."):
+        value = (value or {}).get(key)
+    return value
+
+
+def compare(report, baseline, threshold):
+    # Prints the change of each compared metric; returns the regressions beyond threshold (%)
+    print(f"\n  {'metric':<32}{'baseline':>12}{'current':>12}{'change':>10}")
+    regressions = []
+    for name, higher_is_better in COMPARED.items():
+        before, after = lookup(baseline, name), lookup(report, name)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        worse = -change if higher_is_better else change
+        flag = "  <-- regression" if worse > threshold else ""
+        if flag:
+            regressions.append(name)
+        print(f"  {name:<32}{before:>12}{after:>12}{change:>+9.1f}%{flag}")
+    return regressions
+
+
+def print_report(report):
+    config, results = report["config"], report["results"]
+    print(f"\n{config['mode']} dispatcher @ {report['revision']}: {config['jobs']} jobs, {config['workers']} workers x {config['slots']} slots, "
+          f"{config['latency_ms']}ms latency, {config['error_rate']:.0%} errors, {config['guias']} guias/job")
+    print(f"  finished {results['jobs_finished']} jobs in {results['seconds']}s ({results['throughput_jobs_per_second']} jobs/s), "
+          f"{results['worker_requests']} worker requests, statuses {results['statuses']}")
+    print(f"  coalesced {results.get('jobs_coalesced', 0)}, served fresh {results.get('jobs_fresh', 0)} (no worker request)")
+    print(f"  enqueue-to-start: {results['enqueue_to_start_seconds']}")
+    print(f"  per job: {results['statements_per_job']} statements, {results['connections_per_job']} connections, {results['checkouts_per_job']} pool checkouts")
+    print(f"  db pool: {results['db_pool']}")
+    if results["phases"]:
+        print(f"\n  {'phase':<16}{'count':>10}{'avg ms':>10}")
+        for phase, stats in results["phases"].items():
+            print(f"  {phase:<16}{stats['count']:>10}{stats['avg_ms']:>10}")
+
+
+# Run
+
+def run(args):
+    db_engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    if args.init_schema:
+        init_schema(db_engine)
+    cleanup(db_engine)
+    others = other_due_jobs(db_engine)
+    if others and not args.allow_other_jobs:
+        sys.exit(f"{others} due jobs that are not from the load test would be dispatched too (--allow-other-jobs to run anyway)")
+
+    receipts = Receipts()
+    workers = [FakeWorker(i, args, receipts) for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    # Dispatcher settings are read at import time
+    os.environ["API_SERVER_URLS"] = ",".join(worker.url for worker in workers)
+    os.environ["DISPATCH_MODE"] = args.mode
+    os.environ["DISPATCH_BATCH_SIZE"] = str(args.batch_size)
+    os.environ["DISPATCH_STAGGER_SECONDS"] = str(args.stagger)
+    os.environ["WORKER_CONCURRENCY"] = str(args.concurrency or args.slots)
+    os.environ["DISPATCHER_STATUS_PORT"] = "0"
+    # Failed attempts are retried right away so the run covers the retry path and still drains
+    os.environ.setdefault("RETRY_AFTER_MINUTES", "0")
+    os.environ.setdefault("ROUTER_HEALTH_POLL_SECONDS", "5")
+    os.environ.setdefault("ASYNC_IDLE_POLL_SECONDS", "0.5")
+    import logging
+    import metrics
+    import dispatcher
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    counters = DbCounters(app_engine)
+
+    carteirinha_ids = seed_carteirinhas(db_engine, args.carteirinhas or args.jobs)
+    state = {"enqueued": 0}
+    if args.enqueue_rate:
+        threading.Thread(target=enqueue_at_rate, args=(db_engine, carteirinha_ids, args.jobs, args.enqueue_rate, state), daemon=True).start()
+    else:
+        enqueue(db_engine, carteirinha_ids, 0, args.jobs)
+        state["enqueued"] = args.jobs
+
+    counters.reset()
+    metrics.DISPATCHER_PHASE_SECONDS.reset()
+    fresh_before = metrics.JOBS_TOTAL.value(outcome="fresh")
+    started = time.monotonic()
+    if args.mode == "async":
+        from async_dispatcher import dispatch_async
+        target = dispatch_async
+    else:
+        target = dispatcher.dispatch
+    threading.Thread(target=target, daemon=True).start()
+
+    # Until every job is settled (success/dead, or waiting for a later retry)
+    counts = {}
+    while time.monotonic() - started < args.max_seconds:
+        time.sleep(args.poll_seconds)
+        counts = queue_counts(db_engine)
+        open_jobs = sum(counts.get(status, 0) for status in ("pending", "processing", "error"))
+        if not args.quiet:
+            print(f"  {time.monotonic() - started:7.1f}s enqueued={state['enqueued']} {counts}", file=sys.stderr)
+        if state["enqueued"] >= args.jobs and not open_jobs:
+            break
+    elapsed = time.monotonic() - started
+    timed_out = state["enqueued"] < args.jobs or any(counts.get(status) for status in ("pending", "processing", "error"))
+
+    with db_engine.connect() as conn:
+        jobs = conn.execute(select(Job.id, Job.created_at).where(Job.carteirinha_id.in_(loadtest_carteirinhas()))).all()
+    with receipts.lock:
+        first = dict(receipts.first)
+        worker_requests = receipts.requests
+    latencies = [first[job.id] - job.created_at.timestamp() for job in jobs if job.id in first]
+    # Coalesced jobs are done as far as the dispatcher is concerned, even while the
+    # job they were merged into has not settled them yet
+    finished = counts.get("success", 0) + counts.get("dead", 0) + counts.get("coalesced", 0)
+    per_job = lambda value: round(value / finished, 2) if finished else None
+
+    report = {
+        "run_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "config": {
+            "mode": args.mode,
+            "jobs": args.jobs,
+            "carteirinhas": len(carteirinha_ids),
+            "workers": args.workers,
+            "slots": args.slots,
+            "concurrency": args.concurrency or args.slots,
+            "batch_size": args.batch_size,
+            "stagger": args.stagger,
+            "enqueue_rate": args.enqueue_rate,
+            "latency_ms": args.latency_ms,
+            "error_rate": args.error_rate,
+            "guias": args.guias,
+            "listen": dispatcher.DISPATCH_LISTEN and dispatcher.WAKEUP.connected,
+            "coalesce": dispatcher.COALESCE_JOBS,
+            "freshness_minutes": dispatcher.RESULT_FRESHNESS_MINUTES,
+        },
+        "results": {
+            "timed_out": timed_out,
+            "seconds": round(elapsed, 2),
+            "statuses": counts,
+            "jobs_finished": finished,
+            "jobs_coalesced": coalesced_count(db_engine),
+            "jobs_fresh": metrics.JOBS_TOTAL.value(outcome="fresh") - fresh_before,
+            "worker_requests": worker_requests,
+            "throughput_jobs_per_second": round(finished / elapsed, 2) if elapsed else None,
+            "enqueue_to_start_seconds": percentiles(latencies),
+            "statements": counters.statements,
+            "connections": counters.connections,
+            "checkouts": counters.checkouts,
+            "statements_per_job": per_job(counters.statements),
+            "connections_per_job": per_job(counters.connections),
+            "checkouts_per_job": per_job(counters.checkouts),
+            "db_pool": pool_stats(),
+            "phases": {
+                labels[0]: {"count": count, "avg_ms": round(total / count * 1000, 2) if count else 0}
+                for labels, (count, total) in sorted(metrics.DISPATCHER_PHASE_SECONDS.snapshot().items())
+            },
+        },
+    }
+    if not args.keep:
+        cleanup(db_engine)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dispatcher load test against fake workers")
+    parser.add_argument("--jobs", type=int, default=10000)
+    parser.add_argument("--carteirinhas", type=int, default=None, help="Distinct carteirinhas (default: one per job)")
+    parser.add_argument("--enqueue-rate", type=float, default=0, help="Jobs/s inserted during the run (default: all up front)")
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--slots", type=int, default=2, help="Pool size each fake worker reports")
+    parser.add_argument("--concurrency", type=int, default=None, help="WORKER_CONCURRENCY (default: --slots)")
+    parser.add_argument("--latency-ms", type=float, default=500)
+    parser.add_argument("--latency-jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--guias", type=int, default=20, help="Guias per successful result")
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--stagger", type=int, default=0, help="DISPATCH_STAGGER_SECONDS (production default 15)")
+    parser.add_argument("--max-seconds", type=float, default=3600)
+    parser.add_argument("--poll-seconds", type=float, default=2)
+    parser.add_argument("--init-schema", action="store_true", help="Create tables and apply migrations first")
+    parser.add_argument("--allow-remote", action="store_true", help="Run against a non-local database")
+    parser.add_argument("--allow-other-jobs", action="store_true")
+    parser.add_argument("--keep", action="store_true", help="Leave the seeded rows in place")
+    parser.add_argument("--out", help="Write the report as JSON to this file")
+    parser.add_argument("--compare", help="Baseline report to compare against")
+    parser.add_argument("--fail-threshold", type=float, default=10, help="Regression (%%) that fails --compare")
+    parser.add_argument("--quiet", action="store_true", help="No progress lines")
+    parser.add_argument("--verbose", action="store_true", help="Keep the dispatcher's INFO logging")
+    args = parser.parse_args()
+
+    if DB_HOST not in ("", "localhost", "127.0.0.1", "::1") and not DB_HOST.startswith("/") and not args.allow_remote:
+        sys.exit(f"Refusing to seed load test data into {DB_HOST} (--allow-remote to override)")
+
+    report = run(args)
+    print_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+    status = 1 if report["results"]["timed_out"] else 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.fail_threshold):
+            status = 2
+    sys.exit(status)
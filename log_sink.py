@@ -0,0 +1,110 @@
+"""
+Buffered log sink for the Worker
+Queues Log rows in memory and writes them to the logs table in batches from a
+background thread, so callers never wait on a database round trip.
+"""
+import os
+import queue
+import atexit
+import threading
+import time
+from datetime import datetime, timezone
+from sqlalchemy import insert
+
+from database import engine
+from models import Log
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "WARNING": 30, "ERROR": 40}
+
+# Messages below this level are only printed, never persisted
+DB_LOG_MIN_LEVEL = os.environ.get("DB_LOG_MIN_LEVEL", "INFO").upper()
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 100))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL_SECONDS", 2))
+LOG_QUEUE_MAX = int(os.environ.get("LOG_QUEUE_MAX", 10000))
+
+
+class LogSink:
+    def __init__(self, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL,
+                 min_level=DB_LOG_MIN_LEVEL, max_queue=LOG_QUEUE_MAX):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.min_level = LEVELS.get(min_level, LEVELS["INFO"])
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="log-sink", daemon=True)
+        self._thread.start()
+
+    def enabled_for(self, level):
+        return LEVELS.get(str(level).upper(), LEVELS["INFO"]) >= self.min_level
+
+    def write(self, message, level="INFO", job_id=None, carteirinha_id=None):
+        if not self.enabled_for(level):
+            return
+        record = {
+            "job_id": job_id,
+            "carteirinha_id": carteirinha_id,
+            "level": level,
+            "message": message,
+            # Event time, not flush time
+            "created_at": datetime.now(timezone.utc),
+        }
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block the scraping thread on log I/O
+            self.dropped += 1
+
+    def _next_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if self._stop.is_set():
+                # Draining: take whatever is left without waiting
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stop.is_set() and self.queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            # List of params => executemany (batched into multi-row INSERTs by SQLAlchemy)
+            with engine.begin() as conn:
+                conn.execute(insert(Log), batch)
+        except Exception as e:
+            print(f"Failed to write {len(batch)} logs to DB: {e}")
+
+    def close(self, timeout=10):
+        self._stop.set()
+        self._thread.join(timeout)
+        if self.dropped:
+            print(f"Log sink dropped {self.dropped} messages (queue full)")
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_log_sink():
+    # Process-wide sink, drained on interpreter shutdown
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = LogSink()
+            atexit.register(_sink.close)
+        return _sink
@@ -0,0 +1,12 @@
+-- Unique (carteirinha_id, guia) on base_guias, required by the bulk upsert
+-- (INSERT ... ON CONFLICT) in guias.py.
+
+-- Keep only the most recent row of any existing duplicates
+DELETE FROM base_guias a
+USING base_guias b
+WHERE a.carteirinha_id = b.carteirinha_id
+  AND a.guia = b.guia
+  AND a.id < b.id;
+
+ALTER TABLE base_guias
+    ADD CONSTRAINT uq_base_guias_carteirinha_guia UNIQUE (carteirinha_id, guia);
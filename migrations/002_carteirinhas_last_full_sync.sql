@@ -0,0 +1,3 @@
+-- Incremental sync: when the last full (non-watermarked) scrape of each
+-- carteirinha succeeded. NULL forces a full resync on the next job.
+ALTER TABLE carteirinhas ADD COLUMN IF NOT EXISTS last_full_sync_at TIMESTAMPTZ;
@@ -0,0 +1,3 @@
+-- Hash of the portal listing row each guia was last scraped from. Lets the
+-- scraper skip detail pages for guias whose listing row has not changed.
+ALTER TABLE base_guias ADD COLUMN IF NOT EXISTS list_fingerprint TEXT;
@@ -0,0 +1,4 @@
+-- Resumable scrapes: progress of the last failed attempt of a job (listing
+-- page, last scraped guia and its date, plus the watermark the attempt used).
+-- A retry skips ahead to it; cleared when the job succeeds.
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS checkpoint JSONB;
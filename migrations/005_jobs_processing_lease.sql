@@ -0,0 +1,2 @@
+-- Lease reaper: expired leases are looked up among processing jobs only.
+CREATE INDEX IF NOT EXISTS ix_jobs_processing_timeout ON jobs (timeout) WHERE status = 'processing';
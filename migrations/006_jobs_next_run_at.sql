@@ -0,0 +1,20 @@
+-- Retry scheduling: a job is picked up once next_run_at has passed. Failed
+-- jobs get it pushed back with exponential backoff; jobs out of attempts move
+-- to the "dead" status (dead-letter) instead of staying in "error".
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS next_run_at TIMESTAMPTZ;
+
+UPDATE jobs SET next_run_at = CASE
+        WHEN status = 'error' THEN COALESCE(updated_at, now()) + interval '5 minutes'
+        ELSE COALESCE(created_at, now())
+    END
+WHERE next_run_at IS NULL;
+
+-- 5 = default MAX_ATTEMPTS
+UPDATE jobs SET status = 'dead' WHERE status = 'error' AND attempts >= 5;
+
+ALTER TABLE jobs ALTER COLUMN next_run_at SET DEFAULT now();
+ALTER TABLE jobs ALTER COLUMN next_run_at SET NOT NULL;
+
+-- The queue query (dispatcher.due_jobs) only ever reads pending/error rows
+CREATE INDEX IF NOT EXISTS ix_jobs_queue ON jobs (status, next_run_at, priority DESC, created_at)
+    WHERE status IN ('pending', 'error');
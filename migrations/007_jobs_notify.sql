@@ -0,0 +1,23 @@
+-- Push-based wakeup: NOTIFY the dispatchers (job_wakeup.py) when a job is
+-- inserted or its status changes to one the queue picks up. The payload is
+-- just the status so Postgres folds a bulk insert into a single notification
+-- per transaction.
+CREATE OR REPLACE FUNCTION notify_jobs_ready() RETURNS trigger AS $$
+BEGIN
+    IF NEW.status IN ('pending', 'error') THEN
+        PERFORM pg_notify('jobs_ready', NEW.status);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS jobs_ready_insert ON jobs;
+CREATE TRIGGER jobs_ready_insert
+    AFTER INSERT ON jobs
+    FOR EACH ROW EXECUTE FUNCTION notify_jobs_ready();
+
+DROP TRIGGER IF EXISTS jobs_ready_status ON jobs;
+CREATE TRIGGER jobs_ready_status
+    AFTER UPDATE OF status ON jobs
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+    EXECUTE FUNCTION notify_jobs_ready();
@@ -0,0 +1,21 @@
+-- Job coalescing: queued jobs of a carteirinha that is being dispatched are
+-- merged into that job (status 'coalesced', coalesced_into = the job doing
+-- the work) and end with its final status.
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS coalesced_into INTEGER REFERENCES jobs(id) ON DELETE SET NULL;
+
+CREATE INDEX IF NOT EXISTS ix_jobs_coalesced_into ON jobs (coalesced_into)
+    WHERE status = 'coalesced';
+-- Finding the queued duplicates of a claimed carteirinha
+CREATE INDEX IF NOT EXISTS ix_jobs_queued_carteirinha ON jobs (carteirinha_id)
+    WHERE status IN ('pending', 'error');
+
+-- Result freshness: when the last successful scrape of each carteirinha finished
+ALTER TABLE carteirinhas ADD COLUMN IF NOT EXISTS last_sync_at TIMESTAMPTZ;
+
+UPDATE carteirinhas c SET last_sync_at = s.synced_at
+FROM (
+    SELECT carteirinha_id, max(updated_at) AS synced_at
+    FROM jobs WHERE status = 'success'
+    GROUP BY carteirinha_id
+) s
+WHERE s.carteirinha_id = c.id AND c.last_sync_at IS NULL;
@@ -0,0 +1,12 @@
+-- Wake the dispatchers only for jobs that can be claimed right away. A job
+-- that turns 'error' waits for its next_run_at (retry backoff), so notifying
+-- then only triggered empty claims; dispatchers instead time their idle wait
+-- to the earliest next_run_at of the waiting retries (dispatcher.idle_wait).
+CREATE OR REPLACE FUNCTION notify_jobs_ready() RETURNS trigger AS $$
+BEGIN
+    IF NEW.status = 'pending' THEN
+        PERFORM pg_notify('jobs_ready', NEW.status);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,274 @@
+"""
+Offline stand-in for the SGUCard portal
+Serves the pages and element ids/XPaths UnimedScraper relies on: Login.do,
+the main page with the #cadastro_biometria popup trigger, the carteirinha form
+and results listing (conteudo-submenu table[2], s_NR_GUIA, sortable date header,
+"Próxima" pagination) and the guia detail view (CampoValidadeSenha,
+Button_Voltar). Data is generated deterministically per carteirinha.
+
+    python mock_portal.py --port 8900 --guias 60 --page-size 10 --latency-ms 150
+    SGUCARD_BASE_URL=http://127.0.0.1:8900/cmagnet python server.py
+
+Settings come from MOCK_* env vars (or the CLI flags above).
+"""
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+import datetime
+from html import escape
+from urllib.parse import urlencode
+
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, RedirectResponse
+import uvicorn
+
+BASE_PATH = "/cmagnet"
+SESSION_COOKIE = "JSESSIONID"
+
+CONFIG = {
+    # Guias per carteirinha, and how many of them are not "Autorizado"
+    "guias": int(os.environ.get("MOCK_GUIAS", 40)),
+    "denied_ratio": float(os.environ.get("MOCK_DENIED_RATIO", 0.15)),
+    # Authorization dates spread over this many days back (CUTOFF_DAYS is 270)
+    "days_back": int(os.environ.get("MOCK_DAYS_BACK", 360)),
+    "page_size": int(os.environ.get("MOCK_PAGE_SIZE", 10)),
+    # Injected server latency per page (ms), +/- jitter (fraction)
+    "latency_ms": float(os.environ.get("MOCK_LATENCY_MS", 0)),
+    "detail_latency_ms": float(os.environ.get("MOCK_DETAIL_LATENCY_MS", os.environ.get("MOCK_LATENCY_MS", 0))),
+    "latency_jitter": float(os.environ.get("MOCK_LATENCY_JITTER", 0.2)),
+    # Idle time after the last form keystroke before the popup submits itself
+    "form_debounce_ms": int(os.environ.get("MOCK_FORM_DEBOUNCE_MS", 300)),
+}
+
+app = FastAPI()
+
+
+# Data
+
+def guias_for(carteirinha):
+    # Deterministic list of guia dicts for a carteirinha (unsorted, as the portal lists them)
+    seed = int(hashlib.sha1(carteirinha.encode("utf-8")).hexdigest()[:12], 16)
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+    base = seed % 900000 + 100000
+    guias = []
+    for i in range(CONFIG["guias"]):
+        date = today - datetime.timedelta(days=rnd.randint(0, CONFIG["days_back"]))
+        guias.append({
+            "guia": f"{base}{i:04d}",
+            "date": date,
+            "status": "Autorizado" if rnd.random() >= CONFIG["denied_ratio"] else rnd.choice(["Negado", "Em análise"]),
+            "senha": f"{rnd.randint(10000000, 99999999)}",
+            "validade": date + datetime.timedelta(days=60),
+            "codigo_terapia": rnd.choice(["50000470", "50000462", "20103093", "20104219"]),
+            "qtde_solicitada": rnd.randint(1, 20),
+        })
+    for guia in guias:
+        guia["qtde_autorizada"] = guia["qtde_solicitada"] if guia["status"] == "Autorizado" else 0
+    return guias
+
+
+def find_guia(carteirinha, numero):
+    for guia in guias_for(carteirinha):
+        if guia["guia"] == numero:
+            return guia
+    return None
+
+
+def fmt(date):
+    return date.strftime("%d/%m/%Y")
+
+
+# Helpers
+
+def delay(detail=False):
+    latency = CONFIG["detail_latency_ms"] if detail else CONFIG["latency_ms"]
+    if latency > 0:
+        jitter = CONFIG["latency_jitter"]
+        time.sleep(latency / 1000 * random.uniform(1 - jitter, 1 + jitter))
+
+
+def page(title, body, script=""):
+    return HTMLResponse(
+        f"<html><head><meta charset='utf-8'><title>{escape(title)}</title></head>"
+        f"<body>{body}<script>{script}</script></body></html>"
+    )
+
+
+def logged_in(request):
+    return request.cookies.get(SESSION_COOKIE) is not None
+
+
+def to_login():
+    return RedirectResponse(f"{BASE_PATH}/Login.do", status_code=303)
+
+
+# Pages
+
+@app.get(f"{BASE_PATH}/Login.do")
+def login_form():
+    delay()
+    return page("Login", f"""
+<form method="post" action="{BASE_PATH}/Login.do">
+  <input type="text" id="login" name="login">
+  <input type="password" id="passwordTemp" name="passwordTemp">
+  <input type="submit" id="Button_DoLogin" value="Entrar">
+</form>""")
+
+
+@app.post(f"{BASE_PATH}/Login.do")
+def login_submit():
+    delay()
+    response = RedirectResponse(f"{BASE_PATH}/Principal.do", status_code=303)
+    response.set_cookie(SESSION_COOKIE, hashlib.sha1(str(time.time()).encode()).hexdigest()[:24], path="/")
+    return response
+
+
+@app.get(f"{BASE_PATH}/Principal.do")
+def main_page(request: Request):
+    if not logged_in(request):
+        return to_login()
+    delay()
+    return page("SGUCard", f"""
+<div id="cadastro_biometria">
+  <div>
+    <div><span>Biometria</span></div>
+    <div><span style="cursor:pointer" onclick="window.open('{BASE_PATH}/Consulta.do', 'consulta', 'width=1000,height=700')">Novo exame</span></div>
+  </div>
+</div>""")
+
+
+def search_form(values):
+    # nr_via / DS_CARTAO / CD_DEPENDENCIA start hidden, as on the portal (the scraper unhides them).
+    # The form submits itself once typing stops, or through Button_Consulta.
+    fields = "".join(
+        f'<input type="hidden" name="{name}" value="{escape(values.get(name, ""))}" oninput="scheduleSubmit()">'
+        for name in ("nr_via", "DS_CARTAO", "CD_DEPENDENCIA")
+    )
+    return f"""
+<form id="consulta" method="get" action="{BASE_PATH}/Consulta.do">
+  {fields}
+  <input type="button" id="Button_Consulta" value="Consultar" onclick="submitNow()">
+</form>"""
+
+
+FORM_SCRIPT = """
+var timer = null;
+function submitNow() {
+    if (timer) { clearTimeout(timer); timer = null; }
+    document.getElementById('consulta').submit();
+}
+function scheduleSubmit() {
+    if (timer) { clearTimeout(timer); }
+    timer = setTimeout(function () {
+        var form = document.getElementById('consulta');
+        if (form.nr_via.value && form.DS_CARTAO.value && form.CD_DEPENDENCIA.value) { submitNow(); }
+    }, %d);
+}
+"""
+
+
+@app.get(f"{BASE_PATH}/Consulta.do")
+def consulta(request: Request, nr_via: str = "", DS_CARTAO: str = "", CD_DEPENDENCIA: str = "", sort: str = "", page_number: int = 1):
+    if not logged_in(request):
+        return to_login()
+    delay()
+    values = {"nr_via": nr_via, "DS_CARTAO": DS_CARTAO, "CD_DEPENDENCIA": CD_DEPENDENCIA}
+    script = FORM_SCRIPT % CONFIG["form_debounce_ms"]
+    if not nr_via:
+        return page("Consulta", f'<div id="conteudo-submenu">{search_form(values)}</div>', script)
+
+    guias = guias_for(nr_via)
+    if sort == "asc":
+        guias.sort(key=lambda g: g["date"])
+    elif sort == "desc":
+        guias.sort(key=lambda g: g["date"], reverse=True)
+
+    size = max(1, CONFIG["page_size"])
+    pages = max(1, -(-len(guias) // size))
+    page_number = min(max(1, page_number), pages)
+    shown = guias[(page_number - 1) * size:page_number * size]
+
+    def listing_url(**changes):
+        params = {**values, "sort": sort, "page_number": page_number, **changes}
+        return f"{BASE_PATH}/Consulta.do?{urlencode(params)}"
+
+    rows = "".join(f"""
+<tr>
+  <td>{fmt(g["date"])}</td><td>SP/SADT</td><td>Clinica Mock</td>
+  <td><a href="{escape(f"{BASE_PATH}/Guia.do?{urlencode({'carteirinha': nr_via, 'guia': g['guia']})}")}">{g["guia"]}</a></td>
+  <td>Terapia</td><td><span>{g["status"]}</span></td>
+</tr>""" for g in shown)
+    # First click sorts ascending, the second descending (the scraper clicks twice)
+    next_sort = "desc" if sort == "asc" else "asc"
+    pagination = f'<a href="{escape(listing_url(page_number=page_number + 1))}">Próxima</a>' if page_number < pages else ""
+
+    return page("Consulta", f"""
+<div id="conteudo-submenu">
+  {search_form(values)}
+  <table><tr><td>Guias de <span id="s_NR_GUIA">{escape(nr_via)}</span> - página {page_number}/{pages}</td></tr></table>
+  <table>
+    <tr><td><a href="{escape(listing_url(sort=next_sort, page_number=1))}">Data</a></td><td>Tipo</td><td>Prestador</td><td>Guia</td><td>Descrição</td><td>Situação</td></tr>
+    {rows}
+    <tr><td colspan="6">{pagination}</td></tr>
+  </table>
+</div>""", script)
+
+
+@app.get(f"{BASE_PATH}/Guia.do")
+def guia_detail(request: Request, carteirinha: str, guia: str):
+    if not logged_in(request):
+        return to_login()
+    delay(detail=True)
+    g = find_guia(carteirinha, guia)
+    if not g:
+        return page("Guia", "<p>Guia não encontrada</p>")
+
+    # Absolute XPaths in DETAIL_XPATHS: body/div[1]/div[13]/div/table for the procedure row
+    filler = "".join("<div></div>" for _ in range(11))
+    return page("Guia", f"""
+<div>
+  <div id="conteudo-submenu">
+    <form>
+      <table>
+        <tr><td>Guia</td><td></td></tr>
+        <tr><td>Beneficiário</td><td>{escape(carteirinha)}</td></tr>
+        <tr><td>Número</td><td>{g["guia"]}</td></tr>
+        <tr><td>Emissão</td><td>{fmt(g["date"])}</td><td>Autorização</td><td>{fmt(g["date"])}</td></tr>
+        <tr><td>Senha</td><td>{g["senha"]}</td></tr>
+      </table>
+    </form>
+    <span id="CampoValidadeSenha">{fmt(g["validade"])}</span>
+  </div>
+  {filler}
+  <div>
+    <div>
+      <table>
+        <tr><td>Tabela</td><td>Descrição</td><td>Código</td><td></td><td>Solicitada</td><td>Autorizada</td></tr>
+        <tr><td>22</td><td>Terapia</td><td><input type="text" value="{g["codigo_terapia"]}"></td><td></td><td>{g["qtde_solicitada"]}</td><td>{g["qtde_autorizada"]}</td></tr>
+      </table>
+    </div>
+  </div>
+</div>
+<input type="button" id="Button_Voltar" value="Voltar" onclick="history.back()">""")
+
+
+def run(port, host="127.0.0.1"):
+    uvicorn.run(app, host=host, port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=int(os.environ.get("MOCK_PORT", 8900)))
+    parser.add_argument("--guias", type=int, default=CONFIG["guias"])
+    parser.add_argument("--page-size", type=int, default=CONFIG["page_size"])
+    parser.add_argument("--latency-ms", type=float, default=CONFIG["latency_ms"])
+    parser.add_argument("--detail-latency-ms", type=float, default=None)
+    args = parser.parse_args()
+    CONFIG.update(guias=args.guias, page_size=args.page_size, latency_ms=args.latency_ms,
+                  detail_latency_ms=args.latency_ms if args.detail_latency_ms is None else args.detail_latency_ms)
+    print(f">>> Mock SGUCard portal on http://127.0.0.1:{args.port}{BASE_PATH} ({CONFIG})", file=sys.stderr)
+    run(args.port)
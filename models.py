@@ -2,7 +2,8 @@
 Independent models for Worker
 Mirrors the backend models for tables the Worker needs access to
 """
-from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Text, UniqueConstraint
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -17,6 +18,8 @@ class Carteirinha(Base):
     id_paciente = Column(Integer, index=True)
     id_pagamento = Column(Integer, index=True)
     status = Column(Text, default="ativo")
+    last_full_sync_at = Column(DateTime(timezone=True))  # Last successful full (non-incremental) scrape
+    last_sync_at = Column(DateTime(timezone=True))  # Last successful scrape of any kind (result freshness)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -30,11 +33,14 @@ class Job(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     carteirinha_id = Column(Integer, ForeignKey("carteirinhas.id", ondelete="CASCADE"))
-    status = Column(Text, nullable=False, default="pending")  # success, pending, processing, error
+    status = Column(Text, nullable=False, default="pending")  # success, pending, processing, error, dead, coalesced
     attempts = Column(Integer, default=0)
     priority = Column(Integer, default=0)
     locked_by = Column(Text)  # Server URL
     timeout = Column(DateTime(timezone=True))
+    next_run_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())  # Not picked up before this (retry backoff)
+    coalesced_into = Column(Integer, ForeignKey("jobs.id", ondelete="SET NULL"))  # Job that did this one's work (status coalesced)
+    checkpoint = Column(JSONB)  # Progress of the last failed attempt (page, guia, date, watermark); cleared on success
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -44,6 +50,9 @@ class Job(Base):
 
 class BaseGuia(Base):
     __tablename__ = "base_guias"
+    __table_args__ = (
+        UniqueConstraint("carteirinha_id", "guia", name="uq_base_guias_carteirinha_guia"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     carteirinha_id = Column(Integer, ForeignKey("carteirinhas.id", ondelete="CASCADE"))
@@ -54,6 +63,7 @@ class BaseGuia(Base):
     codigo_terapia = Column(Text)
     qtde_solicitada = Column(Integer)
     sessoes_autorizadas = Column(Integer)
+    list_fingerprint = Column(Text)  # Hash of the portal listing row (see ImportBaseGuias.row_fingerprint)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -0,0 +1,169 @@
+"""
+Capacity-aware routing of jobs to worker URLs
+Polls each worker's /health (free slots, live drivers, median job time) and
+sends the next job to the worker expected to finish it first. Workers whose
+recent error rate climbs, or whose /health stops answering, are backed off
+exponentially.
+"""
+import os
+import time
+import threading
+import logging
+from collections import deque
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+HEALTH_POLL_SECONDS = float(os.environ.get("ROUTER_HEALTH_POLL_SECONDS", 30))
+HEALTH_TIMEOUT = float(os.environ.get("ROUTER_HEALTH_TIMEOUT_SECONDS", 5))
+# Assumed job time until a worker reports a median
+DEFAULT_JOB_SECONDS = float(os.environ.get("ROUTER_DEFAULT_JOB_SECONDS", 120))
+# Extra time when no driver is alive (Chrome start + login)
+COLD_START_SECONDS = float(os.environ.get("ROUTER_COLD_START_SECONDS", 30))
+# Outcomes kept per worker for the error rate
+ERROR_WINDOW = int(os.environ.get("ROUTER_ERROR_WINDOW", 20))
+ERROR_RATE_BACKOFF = float(os.environ.get("ROUTER_ERROR_RATE_BACKOFF", 0.5))
+BACKOFF_BASE_SECONDS = float(os.environ.get("ROUTER_BACKOFF_BASE_SECONDS", 30))
+BACKOFF_MAX_SECONDS = float(os.environ.get("ROUTER_BACKOFF_MAX_SECONDS", 900))
+
+
+class WorkerState:
+    def __init__(self, url):
+        self.url = url
+        self.size = 1  # Worker pool size, from /health
+        self.free = 1
+        self.drivers_alive = 0
+        self.last_login_age = None
+        self.median_job_seconds = None
+        self.reachable = True
+        self.last_health_at = None
+        self.in_flight = 0  # Requests this dispatcher has in progress on the worker
+        self.outcomes = deque(maxlen=ERROR_WINDOW)  # True = success
+        self.failures = 0  # Consecutive failures, drives the backoff
+        self.backoff_until = 0.0
+        self.last_error = None
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+
+class WorkerRouter:
+    def __init__(self, urls, max_in_flight=None):
+        # max_in_flight: per-worker cap on top of the worker's own pool size
+        self.workers = {url: WorkerState(url) for url in urls}
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+
+    # Health polling
+
+    def refresh(self):
+        for url, worker in self.workers.items():
+            try:
+                resp = requests.get(f"{url}/health", timeout=HEALTH_TIMEOUT)
+                resp.raise_for_status()
+                health = resp.json()
+            except Exception as e:
+                with self._lock:
+                    worker.reachable = False
+                    worker.last_error = f"health: {e}"
+                    self._back_off(worker)
+                continue
+            with self._lock:
+                worker.reachable = True
+                worker.size = max(1, int(health.get("size") or 1))
+                worker.free = int(health.get("free") or 0)
+                worker.drivers_alive = int(health.get("drivers_alive") or 0)
+                worker.last_login_age = health.get("last_login_age_seconds")
+                worker.median_job_seconds = health.get("median_job_seconds")
+                worker.last_health_at = time.time()
+
+    def poll_forever(self):
+        # Background thread target
+        while True:
+            self.refresh()
+            time.sleep(HEALTH_POLL_SECONDS)
+
+    # Routing
+
+    def capacity(self, worker):
+        if self.max_in_flight:
+            return min(worker.size, self.max_in_flight)
+        return worker.size
+
+    def expected_seconds(self, worker):
+        # Time until one more job sent now would finish on this worker
+        job_seconds = worker.median_job_seconds or DEFAULT_JOB_SECONDS
+        load = max(worker.in_flight, worker.size - worker.free)
+        rounds = load // worker.size + 1
+        expected = job_seconds * rounds
+        if worker.drivers_alive == 0:
+            expected += COLD_START_SECONDS
+        # Failed jobs come back as retries: weight by the chance of success
+        return expected / max(0.1, 1 - worker.error_rate())
+
+    def choose(self):
+        # Worker URL with the lowest expected completion time, or None when all are full/backed off
+        now = time.time()
+        with self._lock:
+            # Unreachable workers come back with their next successful /health poll
+            candidates = [
+                worker for worker in self.workers.values()
+                if worker.reachable and worker.backoff_until <= now and worker.in_flight < self.capacity(worker)
+            ]
+            if not candidates:
+                return None
+            return min(candidates, key=self.expected_seconds).url
+
+    def start(self, url):
+        # Reserve a slot on the worker before claiming, so concurrent loops do not oversubscribe it
+        with self._lock:
+            self.workers[url].in_flight += 1
+
+    def release(self, url):
+        with self._lock:
+            worker = self.workers[url]
+            worker.in_flight = max(0, worker.in_flight - 1)
+
+    def record(self, url, ok, error=None):
+        # Outcome of one job on this worker
+        with self._lock:
+            worker = self.workers[url]
+            worker.outcomes.append(bool(ok))
+            if ok:
+                worker.failures = 0
+                worker.backoff_until = 0.0
+                return
+            worker.last_error = str(error) if error else "job failed"
+            if worker.error_rate() >= ERROR_RATE_BACKOFF and len(worker.outcomes) >= 3:
+                self._back_off(worker)
+
+    def _back_off(self, worker):
+        worker.failures += 1
+        delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (worker.failures - 1))
+        worker.backoff_until = time.time() + delay
+        logger.warning(f"Backing off {worker.url} for {delay:.0f}s (error rate {worker.error_rate():.0%}, {worker.last_error})")
+
+    def table(self):
+        # Routing table as exposed by the dispatcher status listener
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "url": worker.url,
+                    "reachable": worker.reachable,
+                    "size": worker.size,
+                    "free": worker.free,
+                    "in_flight": worker.in_flight,
+                    "drivers_alive": worker.drivers_alive,
+                    "last_login_age_seconds": worker.last_login_age,
+                    "median_job_seconds": worker.median_job_seconds,
+                    "error_rate": round(worker.error_rate(), 3),
+                    "expected_seconds": round(self.expected_seconds(worker), 1),
+                    "backoff_seconds": round(max(0.0, worker.backoff_until - now), 1),
+                    "last_error": worker.last_error,
+                }
+                for worker in self.workers.values()
+            ]
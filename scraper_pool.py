@@ -0,0 +1,171 @@
+"""
+Pool of scraper instances for one worker process
+Each slot owns its own UnimedScraper: Chrome driver, login state and DB session.
+A request checks out a free slot for one job and waits (bounded) when all are busy.
+"""
+import os
+import queue
+import statistics
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from metrics import DRIVER_RESTARTS
+
+# Recent job durations kept for the median reported by /health
+JOB_TIME_WINDOW = int(os.environ.get("POOL_JOB_TIME_WINDOW", 50))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ScraperSlot:
+    def __init__(self, index, scraper):
+        self.index = index
+        self.scraper = scraper
+        self.job_id = None
+        self.busy = False
+        self.last_activity = datetime.now()
+        self.jobs_done = 0
+        self.last_login = None
+
+    def ensure_driver(self):
+        # Driver may have been closed for inactivity or never started
+        if not self.scraper.driver:
+            print(f">>> Slot {self.index}: driver is closed. Starting...")
+            if self.last_login:
+                DRIVER_RESTARTS.inc()
+            self.scraper.start_driver()
+            self.scraper.login()
+            self.last_login = datetime.now()
+
+    def login_age(self):
+        # Seconds since this slot's driver logged in (None when closed)
+        if not self.scraper.driver or not self.last_login:
+            return None
+        return (datetime.now() - self.last_login).total_seconds()
+
+    def close_driver(self):
+        if self.scraper.driver:
+            try:
+                self.scraper.close_driver()
+            except Exception as e:
+                print(f"Slot {self.index}: error closing driver: {e}")
+            self.scraper.driver = None # Mark as closed
+
+
+class ScraperPool:
+    def __init__(self, factory, size=1, checkout_timeout=300):
+        self.checkout_timeout = checkout_timeout
+        self.slots = [ScraperSlot(i, factory()) for i in range(size)]
+        self._free = queue.Queue()
+        for slot in self.slots:
+            self._free.put(slot)
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.job_times = deque(maxlen=JOB_TIME_WINDOW)
+
+    def warm_up(self):
+        # Start and log in every driver in the background; requests queue on
+        # the slots meanwhile instead of blocking process startup.
+        taken = [self._free.get() for _ in self.slots]
+        for slot in taken:
+            threading.Thread(target=self._warm_slot, args=(slot,), daemon=True).start()
+
+    def _warm_slot(self, slot):
+        try:
+            slot.ensure_driver()
+        except Exception as e:
+            # Left closed; ensure_driver retries on the next checkout
+            print(f">>> Slot {slot.index}: warm-up failed: {e}")
+            slot.close_driver()
+        finally:
+            slot.last_activity = datetime.now()
+            self._free.put(slot)
+
+    @contextmanager
+    def checkout(self, job_id=None, timeout=None):
+        with self._lock:
+            self.waiting += 1
+        try:
+            slot = self._free.get(timeout=timeout or self.checkout_timeout)
+        except queue.Empty:
+            raise PoolTimeout(f"No free scraper after {timeout or self.checkout_timeout}s")
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+        slot.busy = True
+        slot.job_id = job_id
+        slot.last_activity = datetime.now()
+        try:
+            yield slot
+        finally:
+            slot.busy = False
+            slot.job_id = None
+            slot.jobs_done += 1
+            slot.last_activity = datetime.now()
+            self._free.put(slot)
+
+    def close_idle(self, limit):
+        # Close drivers of free slots idle for longer than `limit` (timedelta)
+        idle = []
+        while True:
+            try:
+                idle.append(self._free.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            for slot in idle:
+                if slot.scraper.driver and datetime.now() - slot.last_activity > limit:
+                    print(f">>> Slot {slot.index}: inactivity limit reached. Closing driver.")
+                    slot.close_driver()
+        finally:
+            for slot in idle:
+                self._free.put(slot)
+
+    def close(self):
+        for slot in self.slots:
+            slot.close_driver()
+
+    def record_job(self, seconds):
+        self.job_times.append(seconds)
+
+    def health(self):
+        # Capacity summary used by the dispatcher to route jobs
+        busy = sum(1 for slot in self.slots if slot.busy)
+        ages = [age for age in (slot.login_age() for slot in self.slots) if age is not None]
+        times = list(self.job_times)
+        return {
+            "status": "ok",
+            "size": len(self.slots),
+            "free": len(self.slots) - busy,
+            "waiting": self.waiting,
+            "drivers_alive": len(ages),
+            "last_login_age_seconds": round(min(ages), 1) if ages else None,
+            "median_job_seconds": round(statistics.median(times), 2) if times else None,
+            "jobs_sampled": len(times),
+        }
+
+    def status(self):
+        busy = sum(1 for slot in self.slots if slot.busy)
+        return {
+            "size": len(self.slots),
+            "busy": busy,
+            "free": len(self.slots) - busy,
+            "waiting": self.waiting,
+            "slots": [
+                {
+                    "index": slot.index,
+                    "busy": slot.busy,
+                    "job_id": slot.job_id,
+                    "driver_alive": slot.scraper.driver is not None,
+                    "login_age_seconds": slot.login_age(),
+                    "jobs_done": slot.jobs_done,
+                    "last_activity": slot.last_activity.isoformat(),
+                }
+                for slot in self.slots
+            ],
+        }
@@ -1,5 +1,8 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, Response
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+from typing import Dict, List, Optional
 import uvicorn
 import os
 import sys
@@ -11,116 +14,316 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 from ImportBaseGuias import UnimedScraper
+from scraper_pool import ScraperPool, PoolTimeout
+from guias import upsert_guias
+from models import Job
+import metrics
 
+import json
 import threading
 import time
-from datetime import datetime, timedelta
+from datetime import timedelta
 
-app = FastAPI()
-scraper = None
-last_activity_time = datetime.now()
-driver_lock = threading.Lock()
+SCRAPER_ENGINE = os.environ.get("SCRAPER_ENGINE", "selenium").lower()  # selenium, http
+# Browsers (one UnimedScraper each) per worker process
+SCRAPER_POOL_SIZE = int(os.environ.get("SCRAPER_POOL_SIZE", 1))
+# How long a request waits for a free browser before giving up
+POOL_CHECKOUT_TIMEOUT = float(os.environ.get("POOL_CHECKOUT_TIMEOUT_SECONDS", 300))
 INACTIVITY_LIMIT = timedelta(minutes=20)
+# /process_job and /process_batch: save the guias scraped so far, with the job checkpoint, every
+# this many guias, so the retry resumes even when the dispatcher's request dies; 0 disables
+CHECKPOINT_EVERY = int(os.environ.get("WORKER_CHECKPOINT_EVERY", 20))
+
+def build_scraper():
+    if SCRAPER_ENGINE == "http":
+        from http_scraper import HttpUnimedScraper
+        return HttpUnimedScraper()
+    return UnimedScraper()
+
+pool = None
 
 def maintain_driver_lifecycle():
-    global scraper, last_activity_time
     while True:
         time.sleep(60) # Check every minute
-        with driver_lock:
-            if scraper and scraper.driver:
-                if datetime.now() - last_activity_time > INACTIVITY_LIMIT:
-                    print(">>> Inactivity limit reached. Closing driver.")
-                    try:
-                        scraper.close_driver()
-                        scraper.driver = None # Mark as closed
-                    except Exception as e:
-                        print(f"Error closing driver: {e}")
+        if pool:
+            pool.close_idle(INACTIVITY_LIMIT)
 
 # Start background thread
 threading.Thread(target=maintain_driver_lifecycle, daemon=True).start()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global scraper, last_activity_time
-    scraper = UnimedScraper()
-    # Initial Start
-    with driver_lock:
-        scraper.start_driver()
-        scraper.login()
-        last_activity_time = datetime.now()
+    global pool
+    pool = ScraperPool(build_scraper, size=SCRAPER_POOL_SIZE, checkout_timeout=POOL_CHECKOUT_TIMEOUT)
+    # Initial Start (drivers log in in the background)
+    pool.warm_up()
     yield
-    with driver_lock:
-        scraper.close_driver()
+    pool.close()
 
 app = FastAPI(lifespan=lifespan)
 
+class Watermark(BaseModel):
+    # Newest data_autorizacao already in base_guias (dd/mm/YYYY) and the guias known around it
+    data_autorizacao: Optional[str] = None
+    overlap_days: int = 0
+    guias: List[str] = []
+    # guia -> listing row fingerprint; matching rows are reported as unchanged without opening the detail page
+    fingerprints: Dict[str, str] = {}
+    full_resync: bool = False
+
+class Checkpoint(BaseModel):
+    # Last guia scraped by a previous attempt of the job (listing page number, guia, dd/mm/YYYY)
+    page: int = 1
+    guia: Optional[str] = None
+    date: Optional[str] = None
+
 class JobRequest(BaseModel):
     job_id: int
     carteirinha_id: int
     carteirinha: str
     paciente: str = ""
+    # jobs.attempts of the claim this request belongs to (ownership check for save_progress)
+    attempts: Optional[int] = None
+    watermark: Optional[Watermark] = None
+    checkpoint: Optional[Checkpoint] = None
+
+class BatchRequest(BaseModel):
+    jobs: List[JobRequest]
+
+@app.get("/status")
+def status():
+    if not pool:
+        raise HTTPException(status_code=503, detail="Scraper pool not initialized")
+    return pool.status()
+
+@app.get("/health")
+def health():
+    # Free slots, live drivers, last login age and recent median job time (see ScraperPool.health)
+    if not pool:
+        raise HTTPException(status_code=503, detail="Scraper pool not initialized")
+    return pool.health()
+
+@app.get("/metrics")
+def get_metrics():
+    # Prometheus text format: scraper phase histograms, guias scraped, jobs by outcome, driver restarts
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+def save_progress(scraper, job: JobRequest, guias):
+    # Guias plus the checkpoint that covers them, in one transaction (as the dispatcher's
+    # stream consumer does). Stored like dispatcher.checkpoint_value. Returns (inserted, updated).
+    db = scraper.db
+    try:
+        with metrics.SCRAPER_PHASE_SECONDS.time(phase="progress_save"):
+            inserted, updated = upsert_guias(db, job.carteirinha_id, guias)
+        checkpoint = {**scraper.progress, "watermark": job.watermark.model_dump() if job.watermark else None}
+        # A job reclaimed in the meantime belongs to its new attempt (same rule as dispatcher.owned_job)
+        db.query(Job).filter(Job.id == job.job_id, Job.status == "processing", Job.attempts == job.attempts).update(
+            {Job.checkpoint: checkpoint}, synchronize_session=False
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return inserted, updated
+
+def run_job(slot, job: JobRequest, keep_popup=False):
+    # Scrape one carteirinha on a checked-out slot; errors are reported, not raised.
+    # A failed job still returns the guias scraped so far and its checkpoint.
+    # Guias already saved by save_progress are left out of "data" and counted in "saved".
+    scraper = slot.scraper
+    results = []
+    saved, counts = 0, [0, 0]
+    started = time.monotonic()
+    try:
+        for guia_data in scraper.iter_carteirinha(
+            job.carteirinha,
+            job_id=job.job_id,
+            carteirinha_db_id=job.carteirinha_id,
+            watermark=job.watermark.model_dump() if job.watermark else None,
+            keep_popup=keep_popup,
+            checkpoint=job.checkpoint.model_dump() if job.checkpoint else None
+        ):
+            results.append(guia_data)
+            # Without the claim's attempts the job row cannot be checked for ownership
+            if CHECKPOINT_EVERY and scraper.db and job.attempts is not None and len(results) - saved >= CHECKPOINT_EVERY:
+                try:
+                    inserted, updated = save_progress(scraper, job, results[saved:])
+                    saved = len(results)
+                    counts = [counts[0] + inserted, counts[1] + updated]
+                except Exception as e:
+                    # Still returned in "data": the dispatcher saves them with the result
+                    print(f">>> Failed to save progress of Job {job.job_id}: {e}")
+        pool.record_job(time.monotonic() - started)
+        metrics.JOBS_TOTAL.inc(outcome="success")
+        print(f">>> Returning {len(results)} items for Job {job.job_id} (slot {slot.index})")
+        return {"status": "success", "job_id": job.job_id, "data": results[saved:], "saved": counts, "seen_unchanged": scraper.seen_unchanged, "carteirinha_id": job.carteirinha_id}
+    except Exception as e:
+        metrics.JOBS_TOTAL.inc(outcome="error")
+        # Log critical failure to DB if scraper didn't catch it
+        if scraper.db:
+             try:
+                 from models import Log
+                 scraper.db.add(Log(job_id=job.job_id, carteirinha_id=job.carteirinha_id, level="ERROR", message=f"Server Crash: {str(e)}"))
+                 scraper.db.commit()
+             except: pass
+        return {"status": "error", "job_id": job.job_id, "message": str(e), "carteirinha_id": job.carteirinha_id, "data": results[saved:], "saved": counts, "checkpoint": scraper.progress}
 
 @app.post("/process_job")
 def process_job(job: JobRequest):
     print(f">>> Received Job {job.job_id} for Carteirinha {job.carteirinha}")
-    global scraper, last_activity_time
-    
-    if not scraper:
+
+    if not pool:
          raise HTTPException(status_code=503, detail="Scraper not initialized")
 
-    with driver_lock:
-        # Check if driver is alive/open
-        if not scraper.driver:
-            print(">>> Driver is closed (timeout or crash). Restarting...")
+    try:
+        # Each slot is used by one request at a time (Selenium is not thread safe)
+        with pool.checkout(job_id=job.job_id) as slot:
             try:
-                scraper.start_driver()
-                scraper.login()
+                slot.ensure_driver()
             except Exception as e:
+                slot.close_driver()
                 return {"status": "error", "message": f"Failed to restart driver: {e}", "carteirinha_id": job.carteirinha_id}
-        
-        # Check if we should re-login? (Maybe blindly trust it works, if it fails scraping will catch)
-        # We assume if it was idle < 20 mins, it's fine. If > 20 mins it was closed.
-        
-        last_activity_time = datetime.now()
+            return run_job(slot, job)
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
-    # Process
+def stream_job(slot, job: JobRequest):
+    # NDJSON lines: one {"type": "guia", "checkpoint": ...} per scraped guia, then a final "done" or "error".
+    # The slot is held by the SlotStream wrapping this generator.
+    scraper = slot.scraper
+    count = 0
+    started = time.monotonic()
     try:
-        # Scraper methods might need to be thread-safe if we had parallel requests, 
-        # but here we likely have 1 request per worker at a time via dispatcher.
-        # But we holding lock? No, scraping takes time. We shouldn't hold lock during scraping
-        # if we want other status checks (health) to work, but for now single thread logic is safer.
-        # Ideally we release lock, but safeguard 'scraper' instance. 
-        # Since scraper.driver is shared, we should probably keep lock if scraping modifies driver state? 
-        # Selenium is not thread safe. So yes, hold lock or ensure serial execution.
-        
-        with driver_lock:
-             # Double check existence
-             if not scraper.driver:
-                  raise Exception("Driver died unexpectedly before scraping.")
-             
-             results = scraper.process_carteirinha(
-                job.carteirinha, 
-                job_id=job.job_id, 
-                carteirinha_db_id=job.carteirinha_id
-             )
-             last_activity_time = datetime.now()
-             print(f">>> Returning {len(results)} items for Job {job.job_id}")
-             
-        return {"status": "success", "data": results, "carteirinha_id": job.carteirinha_id}
+        slot.ensure_driver()
     except Exception as e:
-        # Log critical failure to DB if scraper didn't catch it
-        if scraper and scraper.db:
-             try:
-                 from models import Log
-                 scraper.db.add(Log(job_id=job.job_id, carteirinha_id=job.carteirinha_id, level="ERROR", message=f"Server Crash: {str(e)}"))
-                 scraper.db.commit()
-             except: pass
-        return {"status": "error", "message": str(e), "carteirinha_id": job.carteirinha_id}
+        slot.close_driver()
+        yield json.dumps({"type": "error", "message": f"Failed to restart driver: {e}"}) + "\n"
+        return
 
-if __name__ == "__main__":
-    # Port will be passed via arg or env, default 8000
-    port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    try:
+        for guia_data in scraper.iter_carteirinha(
+            job.carteirinha,
+            job_id=job.job_id,
+            carteirinha_db_id=job.carteirinha_id,
+            watermark=job.watermark.model_dump() if job.watermark else None,
+            checkpoint=job.checkpoint.model_dump() if job.checkpoint else None,
+        ):
+            count += 1
+            # Checkpoint rides along so the dispatcher saves it with the guia it covers
+            yield json.dumps({"type": "guia", "data": guia_data, "checkpoint": scraper.progress}, default=str) + "\n"
+    except Exception as e:
+        metrics.JOBS_TOTAL.inc(outcome="error")
+        print(f">>> Stream for Job {job.job_id} failed after {count} items: {e}")
+        yield json.dumps({"type": "error", "message": str(e), "checkpoint": scraper.progress}) + "\n"
+        return
+
+    pool.record_job(time.monotonic() - started)
+    metrics.JOBS_TOTAL.inc(outcome="success")
+    print(f">>> Streamed {count} items for Job {job.job_id} (slot {slot.index})")
+    yield json.dumps({"type": "done", "status": "success", "count": count, "seen_unchanged": scraper.seen_unchanged}) + "\n"
+
+class SlotStream:
+    # Response body that owns a pool checkout. The slot is released when the body is
+    # exhausted or closed; close() is idempotent and works even if the body never started
+    # (client gone before the first chunk), which a generator's own finally would not.
+    # A close() while a chunk is being produced waits for that chunk before releasing,
+    # so the slot is never handed out while its driver is still in use.
+    def __init__(self, checkout, body):
+        self.checkout = checkout
+        self.body = body
+        self._lock = threading.Lock()
+        self._running = False
+        self._closed = False
+        self._released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            if self._closed:
+                raise StopIteration
+            self._running = True
+        try:
+            return next(self.body)
+        except BaseException:
+            # Exhausted (StopIteration) or failed: nothing more to send
+            self._closed = True
+            raise
+        finally:
+            with self._lock:
+                self._running = False
+                done = self._closed
+            if done:
+                self._release()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._running:
+                return
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        try:
+            self.body.close()
+        finally:
+            self.checkout.__exit__(None, None, None)
+
+    # Last resort if the server drops the response without closing it
+    __del__ = close
+
+@app.post("/process_job_stream")
+def process_job_stream(job: JobRequest):
+    print(f">>> Received Job {job.job_id} for Carteirinha {job.carteirinha} (stream)")
+
+    if not pool:
+         raise HTTPException(status_code=503, detail="Scraper not initialized")
+
+    # Slot is taken before the response starts so a full pool still answers 503
+    checkout = pool.checkout(job_id=job.job_id)
+    try:
+        slot = checkout.__enter__()
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    body = SlotStream(checkout, stream_job(slot, job))
+    # Runs once the response is over, also when it was cancelled before the first chunk
+    return StreamingResponse(body, media_type="application/x-ndjson", background=BackgroundTask(body.close))
+
+@app.post("/process_batch")
+def process_batch(batch: BatchRequest):
+    # Several carteirinhas on one slot, keeping the popup and session open between them.
+    # Each job gets its own result entry; one failure does not fail the batch.
+    job_ids = [job.job_id for job in batch.jobs]
+    print(f">>> Received Batch of {len(job_ids)} jobs: {job_ids}")
+
+    if not pool:
+         raise HTTPException(status_code=503, detail="Scraper not initialized")
+
+    try:
+        with pool.checkout(job_id=job_ids[0] if job_ids else None) as slot:
+            try:
+                slot.ensure_driver()
+            except Exception as e:
+                slot.close_driver()
+                return {"status": "error", "message": f"Failed to restart driver: {e}"}
+
+            results = []
+            for job in batch.jobs:
+                slot.job_id = job.job_id
+                result = run_job(slot, job, keep_popup=True)
+                if result["status"] != "success":
+                    # Page state is unknown after a failure: next job reopens the popup
+                    slot.scraper.close_popup()
+                results.append(result)
+            slot.scraper.close_popup()
+            return {"status": "success", "results": results}
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
 if __name__ == "__main__":
     # Port will be passed via arg or env, default 8000
@@ -0,0 +1,385 @@
+"""
+Browserless replay of recorded scraper runs (recorded with SCRAPER_RECORD_DIR, see snapshots.py)
+SnapshotDriver serves a saved page through the subset of the WebDriver API the
+extraction code uses (find_element(s), execute_script with the scraper's own
+scripts, window_handles), so read_result_rows / read_detail and the row
+selection logic run on recorded pages at parsing speed, without Chrome.
+Navigation is not replayed: listing and detail pages are loaded in the order
+the scraper reaches them, and each run's guias are checked against the ones
+recorded live.
+
+    python snapshot_replay.py recordings/ --mode element --repeat 50
+    python snapshot_replay.py recordings/ --profile
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+
+import lxml.html
+from selenium.webdriver.common.by import By
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+
+from ImportBaseGuias import UnimedScraper, LIST_ROWS_JS, DETAIL_JS, CLICK_ROW_LINK_JS, RESULTS_TABLE_XPATH, DETAIL_XPATHS
+from http_scraper import parse_document
+
+# Fields compared with the recorded results. list_fingerprint is left out: it
+# hashes the live listing row, which redaction may have changed.
+COMPARED_FIELDS = tuple(DETAIL_XPATHS)
+
+# Elements that start a new line in innerText
+BLOCK_TAGS = {"br", "div", "p", "table", "tbody", "thead", "tr", "td", "th", "form", "li", "ul", "h1", "h2", "h3", "h4"}
+
+
+def inner_text(node):
+    # Approximation of innerText / WebElement.text: text with block boundaries, collapsed whitespace
+    if node is None:
+        return None
+    parts = []
+
+    def walk(el):
+        if not isinstance(el.tag, str) or el.tag in ("script", "style"):
+            return
+        block = el.tag in BLOCK_TAGS
+        if block:
+            parts.append(" ")
+        if el.text:
+            parts.append(el.text)
+        for child in el:
+            walk(child)
+            if child.tail:
+                parts.append(child.tail)
+        if block:
+            parts.append(" ")
+
+    walk(node)
+    return " ".join("".join(parts).split())
+
+
+def _locator(by, value):
+    # Selenium locator -> XPath relative to the search context
+    if by == By.XPATH:
+        return value
+    if by == By.ID:
+        return f'.//*[@id="{value}"]'
+    if by == By.NAME:
+        return f'.//*[@name="{value}"]'
+    if by == By.TAG_NAME:
+        return f".//{value}"
+    if by == By.CLASS_NAME:
+        return f'.//*[contains(concat(" ", normalize-space(@class), " "), " {value} ")]'
+    if by == By.LINK_TEXT:
+        return f'.//a[normalize-space(.)="{value}"]'
+    if by == By.PARTIAL_LINK_TEXT:
+        return f'.//a[contains(., "{value}")]'
+    raise NotImplementedError(f"Locator not supported in replay: {by}")
+
+
+def _first(node, path):
+    found = node.xpath(path)
+    return found[0] if found else None
+
+
+class SnapshotElement:
+    def __init__(self, driver, node):
+        self.driver = driver
+        self.node = node
+
+    def _check(self):
+        # Elements of a previously loaded page are stale, as in the browser
+        if self.node.getroottree().getroot() is not self.driver.doc:
+            raise StaleElementReferenceException("Element belongs to a previous snapshot")
+
+    @property
+    def text(self):
+        self._check()
+        return inner_text(self.node)
+
+    @property
+    def tag_name(self):
+        return self.node.tag
+
+    def get_attribute(self, name):
+        self._check()
+        if name in ("innerText", "textContent"):
+            return inner_text(self.node)
+        return self.node.get(name)
+
+    get_dom_attribute = get_attribute
+
+    def is_displayed(self):
+        self._check()
+        return True
+
+    def is_enabled(self):
+        self._check()
+        return True
+
+    def find_element(self, by=By.ID, value=None):
+        return self.driver._find_one(self.node, by, value)
+
+    def find_elements(self, by=By.ID, value=None):
+        return self.driver._find_all(self.node, by, value)
+
+    def click(self):
+        self._check()
+        self.driver.clicks.append(self)
+
+    def clear(self):
+        self.node.set("value", "")
+
+    def send_keys(self, *values):
+        self.node.set("value", (self.node.get("value") or "") + "".join(str(value) for value in values))
+
+
+class _SwitchTo:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def window(self, handle):
+        if handle not in self.driver.window_handles:
+            raise NoSuchElementException(f"No window {handle}")
+
+    def new_window(self, type_hint=None):
+        raise NotImplementedError("Tabs are not replayed")
+
+
+class SnapshotDriver:
+    # Stands in for webdriver.Chrome on one page at a time (load() switches pages)
+    def __init__(self):
+        self.doc = None
+        self.current_url = ""
+        self.window_handles = ["snapshot"]
+        self.current_window_handle = "snapshot"
+        self.switch_to = _SwitchTo(self)
+        self.clicks = []
+
+    def load(self, doc, url=""):
+        self.doc = doc
+        self.current_url = url
+
+    @property
+    def page_source(self):
+        return lxml.html.tostring(self.doc, encoding="unicode")
+
+    @property
+    def title(self):
+        return inner_text(_first(self.doc, "//title")) or ""
+
+    def _find_all(self, context, by, value):
+        return [SnapshotElement(self, node) for node in context.xpath(_locator(by, value)) if not isinstance(node, str)]
+
+    def _find_one(self, context, by, value):
+        found = self._find_all(context, by, value)
+        if not found:
+            raise NoSuchElementException(f"{by}={value}")
+        return found[0]
+
+    def find_element(self, by=By.ID, value=None):
+        return self._find_one(self.doc, by, value)
+
+    def find_elements(self, by=By.ID, value=None):
+        return self._find_all(self.doc, by, value)
+
+    def execute_script(self, script, *args):
+        # The scraper's own scripts, evaluated on the snapshot with the same XPaths
+        if script == LIST_ROWS_JS:
+            return self._list_rows()
+        if script == DETAIL_JS:
+            return self._detail()
+        if script == CLICK_ROW_LINK_JS:
+            link = _first(self.doc, f"{RESULTS_TABLE_XPATH}/tbody/tr[{args[0] + 1}]/td[4]/a")
+            if link is None:
+                return False
+            self.clicks.append(SnapshotElement(self, link))
+            return True
+        if "scrollIntoView" in script:
+            return None
+        if "setAttribute('type'" in script:
+            args[0].node.set("type", "text")
+            return None
+        if "navigator.userAgent" in script:
+            return "SnapshotDriver"
+        raise NotImplementedError(f"Script not supported in replay: {script.strip()[:80]}")
+
+    def _list_rows(self):
+        # Python version of LIST_ROWS_JS
+        table = _first(self.doc, RESULTS_TABLE_XPATH)
+        if table is None:
+            return []
+        total = len(table.xpath(".//tr"))
+        rows = []
+        for idx in range(1, total - 1):
+            row = _first(table, f"tbody/tr[{idx + 1}]")
+            if row is None:
+                continue
+            status = _first(row, "td[6]/span")
+            if status is None:
+                continue
+            link = _first(row, "td[4]/a")
+            rows.append({
+                "index": idx,
+                "status": inner_text(status),
+                "date": inner_text(_first(row, "td[1]")) or "",
+                "guia": inner_text(link),
+                "href": link.get("href") if link is not None else None,
+                "text": inner_text(row),
+            })
+        return rows
+
+    def _detail(self):
+        # Python version of DETAIL_JS
+        fields = {"loaded": _first(self.doc, '//*[@id="Button_Voltar"]') is not None}
+        for name, path in DETAIL_XPATHS.items():
+            node = _first(self.doc, path)
+            if name == "codigo_terapia":
+                fields[name] = node.get("value") if node is not None else None
+            else:
+                fields[name] = inner_text(node)
+        return fields
+
+    def get_cookies(self):
+        return []
+
+    def back(self):
+        pass
+
+    def quit(self):
+        pass
+
+
+# Recordings
+
+def load_recordings(root):
+    # [(directory, manifest, {file: parsed page})], parsed once so replays measure extraction only
+    recordings = []
+    for directory, _, files in sorted(os.walk(root)):
+        if "manifest.json" not in files:
+            continue
+        with open(os.path.join(directory, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        pages = {}
+        for entry in manifest["pages"]:
+            with open(os.path.join(directory, entry["file"]), "rb") as f:
+                pages[entry["file"]] = parse_document(f.read(), entry["url"] or None)
+        recordings.append((directory, manifest, pages))
+    return recordings
+
+
+def replay_scraper(mode=None):
+    # UnimedScraper on a SnapshotDriver: no browser, no DB writes, no log output
+    os.environ.setdefault("SCRAPER_LOG_MODE", "print")
+    scraper = UnimedScraper()
+    scraper.log = lambda *args, **kwargs: None
+    scraper.recorder = None
+    scraper.driver = SnapshotDriver()
+    if mode:
+        scraper.extract_mode = mode
+    return scraper
+
+
+def replay(scraper, manifest, pages):
+    # Per-page flow of UnimedScraper.iter_carteirinha minus the navigation.
+    # Returns (guias, pages read).
+    context = manifest["context"]
+    cutoff = datetime.datetime.strptime(context["cutoff_date"], "%d/%m/%Y").date()
+    scraper.cutoff_date = lambda: cutoff  # Decide as on the recording day
+    watermark = scraper.prepare_watermark(context.get("watermark"))
+    checkpoint = context.get("checkpoint")
+    scraper.seen_unchanged = []
+
+    details = {(entry["page"], entry["row"]): entry for entry in manifest["pages"] if entry["kind"] == "detail"}
+    results, read = [], 0
+    for entry in manifest["pages"]:
+        if entry["kind"] != "listing":
+            continue
+        scraper.driver.load(pages[entry["file"]], entry["url"])
+        rows = scraper.read_result_rows()
+        read += 1
+        targets, stop = scraper.select_targets(rows, watermark)
+        targets = scraper.resume_targets(rows, targets, entry["page"], checkpoint)
+        for row in targets:
+            detail = details.get((entry["page"], row["index"]))
+            if not detail:
+                continue
+            scraper.driver.load(pages[detail["file"]], detail["url"])
+            guia_data = scraper.read_detail()
+            read += 1
+            if guia_data:
+                guia_data["list_fingerprint"] = row["fingerprint"]
+                results.append(guia_data)
+        if stop:
+            break
+    return results, read
+
+
+def differences(expected, actual):
+    # Field-level differences between the recorded and replayed guias, in order
+    diffs = []
+    if len(expected) != len(actual):
+        diffs.append(f"{len(expected)} guias recorded, {len(actual)} replayed")
+    for i, (want, got) in enumerate(zip(expected, actual)):
+        for field in COMPARED_FIELDS:
+            if want.get(field) != got.get(field):
+                diffs.append(f"guia #{i + 1} {field}: recorded {want.get(field)!r}, replayed {got.get(field)!r}")
+    return diffs
+
+
+def run(args):
+    recordings = load_recordings(args.root)
+    if not recordings:
+        sys.exit(f"No recordings (manifest.json) under {args.root}")
+    scrapers = {}
+    mismatches = {}
+    pages_read = 0
+    started = time.monotonic()
+    for _ in range(args.repeat):
+        for directory, manifest, pages in recordings:
+            mode = args.mode or manifest["context"].get("extract_mode") or "js"
+            if mode not in scrapers:
+                scrapers[mode] = replay_scraper(mode)
+            scraper = scrapers[mode]
+            results, read = replay(scraper, manifest, pages)
+            pages_read += read
+            if manifest.get("error"):
+                # Runs that failed live are replayed for profiling, not compared
+                continue
+            diffs = differences(manifest["results"], results)
+            if diffs:
+                mismatches[directory] = diffs
+    elapsed = time.monotonic() - started
+    return {
+        "recordings": len(recordings),
+        "repeat": args.repeat,
+        "pages": pages_read,
+        "seconds": round(elapsed, 3),
+        "pages_per_second": round(pages_read / elapsed, 1) if elapsed else None,
+        "mismatches": mismatches,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded scraper runs without a browser")
+    parser.add_argument("root", help="Directory with recordings (SCRAPER_RECORD_DIR)")
+    parser.add_argument("--mode", choices=["js", "element"], help="Extraction mode (default: the recorded one)")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--profile", action="store_true", help="Print the top functions by cumulative time")
+    args = parser.parse_args()
+
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        report = profiler.runcall(run, args)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    else:
+        report = run(args)
+
+    print(f"{report['recordings']} recordings x {report['repeat']}: {report['pages']} pages in {report['seconds']}s ({report['pages_per_second']} pages/s)")
+    for directory, diffs in report["mismatches"].items():
+        print(f"MISMATCH {directory}:")
+        for diff in diffs[:20]:
+            print(f"  {diff}")
+    sys.exit(1 if report["mismatches"] else 0)
@@ -0,0 +1,152 @@
+"""
+Recording of scraper runs as DOM snapshots
+With SCRAPER_RECORD_DIR set, UnimedScraper saves the page source of the popup
+form, every listing page and every detail page it reads, plus the guias it
+returned, in one directory per carteirinha. Redaction is an allowlist: every
+text node and attribute value is masked before anything is written, except the
+nodes the extraction reads (listing cells and detail fields, senha excluded);
+the carteirinha and session ids are masked everywhere. snapshot_replay.py
+feeds the recordings back to the extraction code without a browser.
+"""
+import os
+import re
+import json
+import hashlib
+import datetime
+
+import lxml.html
+
+RECORD_DIR = os.environ.get("SCRAPER_RECORD_DIR")
+# XPath masked even inside kept nodes (can be a union: "path1 | path2")
+EXTRA_REDACT_XPATH = os.environ.get("SNAPSHOT_REDACT_XPATH")
+# Attributes left as they are on every element: what XPaths and the page structure rely on
+STRUCTURAL_ATTRIBUTES = ("id", "class", "name", "type", "colspan", "rowspan")
+# Attributes extraction reads from kept nodes (guia link, codigo_terapia input)
+KEPT_ATTRIBUTES = ("href", "value")
+# Guia fields masked in the recorded results, to match the masked pages
+REDACT_RESULT_FIELDS = ("senha",)
+SESSION_ID = re.compile(r"(jsessionid=)[^&;?#\"'\s]+", re.IGNORECASE)
+
+
+def mask(text):
+    # Same length and shape: digits -> 0, letters -> X
+    return re.sub(r"[^\W\d_]", "X", re.sub(r"\d", "0", text))
+
+
+def carteirinha_variants(carteirinha):
+    # Forms the number takes on the portal: formatted, all digits (nr_via),
+    # without the prefix (DS_CARTAO) and the long middle block (CD_DEPENDENCIA)
+    parts = [part for part in re.split(r"[.-]", carteirinha) if part]
+    variants = {carteirinha, "".join(parts), "".join(parts[1:])}
+    variants.update(part for part in parts if len(part) >= 6)
+    return sorted((variant for variant in variants if variant), key=len, reverse=True)
+
+
+def redact_text(text, carteirinha):
+    text = SESSION_ID.sub(lambda m: m.group(1) + "redacted", text)
+    for variant in carteirinha_variants(carteirinha):
+        text = text.replace(variant, mask(variant))
+    return text
+
+
+def _matched_elements(doc, paths):
+    # Elements matched by the XPaths, with everything inside them
+    found = set()
+    for path in paths:
+        for node in doc.xpath(path):
+            if isinstance(node, lxml.html.HtmlElement):
+                found.update(node.iter())
+    return found
+
+
+def redact_html(html, carteirinha, keep_xpaths=(), redact_xpaths=()):
+    # Masks text in place so the structure (and every XPath the scraper uses) is unchanged.
+    # Only the content of keep_xpaths survives, minus redact_xpaths / SNAPSHOT_REDACT_XPATH.
+    doc = lxml.html.fromstring(html)
+    kept = _matched_elements(doc, keep_xpaths)
+    kept -= _matched_elements(doc, list(redact_xpaths) + ([EXTRA_REDACT_XPATH] if EXTRA_REDACT_XPATH else []))
+    for el in doc.iter():
+        parent = el.getparent()
+        # An element's tail is text of its parent
+        if el.tail and parent not in kept:
+            el.tail = mask(el.tail)
+        if not isinstance(el.tag, str):
+            # Comments and processing instructions
+            if el.text:
+                el.text = mask(el.text)
+            continue
+        if el.text and el not in kept:
+            el.text = mask(el.text)
+        for name, value in el.attrib.items():
+            if not value or name in STRUCTURAL_ATTRIBUTES or (el in kept and name in KEPT_ATTRIBUTES):
+                continue
+            el.set(name, mask(value))
+    # Inline scripts may embed session or beneficiary data; extraction never reads them
+    for script in doc.xpath("//script"):
+        script.text = None
+    return redact_text(lxml.html.tostring(doc, encoding="unicode"), carteirinha)
+
+
+def redact_value(value, carteirinha):
+    # JSON-able value (watermark, checkpoint, guia dicts) with the carteirinha masked
+    return json.loads(redact_text(json.dumps(value, ensure_ascii=False, default=str), carteirinha))
+
+
+class SnapshotRecorder:
+    # One recording per carteirinha run: NNNN_<kind>.html files plus manifest.json.
+    # keep_xpaths: nodes left readable in the pages (see redact_html)
+    def __init__(self, root, keep_xpaths=(), redact_xpaths=()):
+        self.root = root
+        self.keep_xpaths = tuple(keep_xpaths)
+        self.redact_xpaths = tuple(redact_xpaths)
+        self.path = None
+
+    def begin(self, carteirinha, **context):
+        # context: what a replay needs to take the same decisions (extract_mode,
+        # watermark, checkpoint, cutoff_date)
+        label = hashlib.sha1(carteirinha.encode("utf-8")).hexdigest()[:10]
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        self.path = os.path.join(self.root, f"{stamp}_{label}")
+        os.makedirs(self.path, exist_ok=True)
+        self.carteirinha = carteirinha
+        self.page = 0
+        self.manifest = {
+            "recorded_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "context": redact_value(context, carteirinha),
+            "pages": [],
+            "results": [],
+            "error": None,
+        }
+
+    def capture(self, kind, html, url, row=None):
+        # kind: form, listing or detail (row: the listing row the detail page was opened from)
+        if not self.path:
+            return
+        if kind == "listing":
+            self.page += 1
+        name = f"{len(self.manifest['pages']) + 1:04d}_{kind}.html"
+        with open(os.path.join(self.path, name), "w", encoding="utf-8") as f:
+            f.write(redact_html(html, self.carteirinha, self.keep_xpaths, self.redact_xpaths))
+        entry = {"kind": kind, "file": name, "page": self.page, "url": redact_text(url or "", self.carteirinha)}
+        if row:
+            entry["row"] = row["index"]
+            entry["guia"] = redact_text(row.get("guia") or "", self.carteirinha)
+        self.manifest["pages"].append(entry)
+
+    def result(self, guia_data):
+        if not self.path:
+            return
+        guia = redact_value(guia_data, self.carteirinha)
+        for field in REDACT_RESULT_FIELDS:
+            if guia.get(field):
+                guia[field] = mask(guia[field])
+        self.manifest["results"].append(guia)
+
+    def finish(self, error=None):
+        # No-op when nothing is being recorded (or this run was already finished)
+        if not self.path:
+            return
+        self.manifest["error"] = str(error) if error else None
+        with open(os.path.join(self.path, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2, ensure_ascii=False)
+        self.path = None
@@ -0,0 +1,100 @@
+"""
+Condition-based waits for the SGUCard pages
+Named readiness conditions on top of WebDriverWait, each with its own timeout
+(WAIT_TIMEOUT_<NAME> env var, in seconds) and a record of how long every wait
+actually took.
+"""
+import os
+import time
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+
+DEFAULT_TIMEOUTS = {
+    "login_done": 20,
+    "table_rerendered": 8,
+    "popup_opened": 15,
+    "form_ready": 15,
+    "results_loaded": 20,
+    "detail_loaded": 15,
+    "back_done": 15,
+    "page_changed": 15,
+}
+POLL_FREQUENCY = float(os.environ.get("WAIT_POLL_SECONDS", 0.2))
+
+RESULTS_TABLE = (By.XPATH, '//*[@id="conteudo-submenu"]/table[2]')
+
+
+def timeout_for(name):
+    return float(os.environ.get(f"WAIT_TIMEOUT_{name.upper()}", DEFAULT_TIMEOUTS.get(name, 10)))
+
+
+def _all_of(*conditions):
+    def check(driver):
+        for condition in conditions:
+            if not condition(driver):
+                return False
+        return True
+    return check
+
+
+class PageWaiter:
+    def __init__(self, driver):
+        self.driver = driver
+        self.timings = {}  # condition name -> list of waited seconds
+
+    def until(self, name, condition, timeout=None):
+        # Raises TimeoutException like WebDriverWait; the time spent is recorded either way
+        start = time.monotonic()
+        try:
+            return WebDriverWait(self.driver, timeout or timeout_for(name), poll_frequency=POLL_FREQUENCY).until(condition)
+        finally:
+            self.timings.setdefault(name, []).append(time.monotonic() - start)
+
+    def stats(self):
+        return {
+            name: {
+                "count": len(values),
+                "total": round(sum(values), 3),
+                "avg": round(sum(values) / len(values), 3),
+                "max": round(max(values), 3),
+            }
+            for name, values in self.timings.items() if values
+        }
+
+    def reset(self):
+        self.timings = {}
+
+    # Named readiness conditions
+
+    def login_done(self, password_field):
+        # Login form submitted and replaced by the next page
+        return self.until("login_done", EC.staleness_of(password_field))
+
+    def table_rerendered(self, old_element):
+        # Sort header click re-rendered the results table
+        return self.until("table_rerendered", _all_of(EC.staleness_of(old_element), EC.presence_of_element_located(RESULTS_TABLE)))
+
+    def popup_opened(self, handles_before):
+        return self.until("popup_opened", EC.number_of_windows_to_be(handles_before + 1))
+
+    def form_ready(self):
+        return self.until("form_ready", EC.presence_of_element_located((By.NAME, "nr_via")))
+
+    def results_loaded(self, previous=None):
+        # previous: results element of the last carteirinha when the popup is reused
+        present = EC.presence_of_element_located((By.XPATH, '//*[@id="s_NR_GUIA"]'))
+        if previous is not None:
+            return self.until("results_loaded", _all_of(EC.staleness_of(previous), present))
+        return self.until("results_loaded", present)
+
+    def detail_loaded(self):
+        return self.until("detail_loaded", EC.presence_of_element_located((By.XPATH, '//*[@id="Button_Voltar"]')))
+
+    def back_done(self, voltar_button):
+        # Detail view left and the listing is back
+        return self.until("back_done", _all_of(EC.staleness_of(voltar_button), EC.presence_of_element_located(RESULTS_TABLE)))
+
+    def page_changed(self, old_table):
+        # Pagination replaced the listing table
+        return self.until("page_changed", _all_of(EC.staleness_of(old_table), EC.presence_of_element_located(RESULTS_TABLE)))